@@ -0,0 +1,388 @@
+# -*- coding: utf8 -*-
+"""
+Пакетная обработка без Telegram: распознавание папки с аудио
+и озвучивание списка текстов на всех ядрах.
+
+Файлы обрабатываются пулом процессов, у каждого процесса свои модели.
+Результат каждого файла записывается сразу, как только он готов,
+а имя файла дописывается в checkpoint. После прерывания повторный
+запуск с теми же аргументами пропускает уже готовые файлы.
+
+Примеры:
+    python batch.py stt audio/ --output out/ --format srt
+    python batch.py stt manifest.txt --output out/ --processes 8 --vad
+    python batch.py tts texts.txt --output voices/
+    python batch.py tts texts/ --output voices/ --optimize inference
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from signals import ignore_interrupt
+from transcript import FORMATS, to_segment
+
+logger = logging.getLogger(__name__)
+
+AUDIO_EXTENSIONS = (
+    ".ogg", ".oga", ".opus", ".wav", ".mp3", ".m4a", ".flac", ".aac", ".webm", ".mp4",
+)
+CHECKPOINT_NAME = ".checkpoint"
+# Папка внутри --output для результатов файлов манифеста вне его папки
+EXTERNAL_FOLDER = "_external"
+
+# Модель процесса-воркера, создается в _init_worker
+_engine = None
+
+
+def _external_name(path: str) -> str:
+    """
+    Имя результата для файла вне root: полный путь внутри папки
+    EXTERNAL_FOLDER, /data/calls/a.ogg -> _external/data/calls/a.ogg.
+    Полный путь у каждого файла свой, поэтому имена не совпадают.
+    """
+    drive, tail = os.path.splitdrive(os.path.abspath(path))
+    parts = [drive.strip(":\\/").replace(":", "")] if drive else []
+    parts += [part for part in tail.split(os.sep) if part]
+    return os.path.join(EXTERNAL_FOLDER, *parts)
+
+
+def _relative_name(path: str, root: str, keep_extension: bool = False) -> str:
+    """
+    Имя результата: путь относительно root, для файлов вне root -
+    см. _external_name. Расширение оставляется, если в одной папке
+    могут быть a.wav и a.mp3, иначе их результаты совпали бы.
+    """
+    try:
+        name = os.path.relpath(path, root)
+    except ValueError:
+        # Windows: другой диск
+        name = _external_name(path)
+    if name == os.pardir or name.startswith(os.pardir + os.sep):
+        name = _external_name(path)
+    if not keep_extension:
+        name = os.path.splitext(name)[0]
+    return name.replace(os.sep, "/")
+
+
+def output_path(output: str, name: str) -> str:
+    """
+    Путь результата внутри папки output.
+
+    :raises ValueError: имя указывает за пределы output, например ../a
+    """
+    path = os.path.normpath(os.path.join(output, name))
+    relative = os.path.relpath(path, output)
+    if os.path.isabs(name) or relative == os.pardir or relative.startswith(os.pardir + os.sep):
+        raise ValueError(f"имя {name} указывает за пределы папки {output}")
+    return path
+
+
+def _walk(directory: str, extensions: tuple):
+    """
+    Файлы папки и подпапок с нужными расширениями, в алфавитном порядке.
+    """
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for file_name in sorted(files):
+            if file_name.lower().endswith(extensions):
+                yield os.path.join(root, file_name)
+
+
+def iter_audio(source: str):
+    """
+    Аудио для распознавания: файлы папки или список путей
+    в файле-манифесте, по одному на строку.
+
+    :arg source: str  папка или манифест
+    :return: generator[(str, str)]  имя результата и путь к аудио
+    """
+    if os.path.isdir(source):
+        for path in _walk(source, AUDIO_EXTENSIONS):
+            yield _relative_name(path, source, keep_extension=True), path
+        return
+
+    base = os.path.dirname(os.path.abspath(source))
+    with open(source, "rt", encoding="utf8") as file:
+        for line in file:
+            path = line.strip()
+            if not path or path.startswith("#"):
+                continue
+            if not os.path.isabs(path):
+                path = os.path.join(base, path)
+            yield _relative_name(path, base, keep_extension=True), path
+
+
+def iter_texts(source: str):
+    """
+    Тексты для озвучивания: файлы .txt папки целиком или строки файла.
+    Строка вида "имя<TAB>текст" задает имя результата,
+    иначе имя - номер строки.
+
+    :arg source: str  папка или файл с текстами
+    :return: generator[(str, str)]  имя результата и текст
+    """
+    if os.path.isdir(source):
+        for path in _walk(source, (".txt",)):
+            with open(path, "rt", encoding="utf8") as file:
+                yield _relative_name(path, source), file.read()
+        return
+
+    with open(source, "rt", encoding="utf8") as file:
+        for number, line in enumerate(file, 1):
+            line = line.strip()
+            if not line:
+                continue
+            name, separator, text = line.partition("\t")
+            if not separator:
+                name, text = f"{number:06d}", line
+            yield name, text
+
+
+def read_checkpoint(path: str) -> set:
+    """
+    Имена уже готовых результатов.
+    """
+    if not os.path.exists(path):
+        return set()
+    with open(path, "rt", encoding="utf8") as file:
+        return {line.rstrip("\n") for line in file if line.strip()}
+
+
+def _init_worker(target: str, kwargs: dict) -> None:
+    """
+    Загружает модель в процессе-воркере один раз.
+    """
+    global _engine
+    ignore_interrupt()
+    if target == "stt":
+        from stt import STT
+        from vad import VAD
+
+        kwargs = dict(kwargs)
+        vad = VAD() if kwargs.pop("vad", False) else None
+        _engine = STT(vad=vad, **kwargs)
+    else:
+        from tts import TTS
+
+        _engine = TTS(**kwargs)
+
+
+def _write_atomic(out_filename: str, write) -> None:
+    """
+    Пишет во временный файл и переименовывает его, чтобы после
+    прерывания на диске не оставалось недописанных результатов.
+    """
+    os.makedirs(os.path.dirname(out_filename) or ".", exist_ok=True)
+    part_filename = out_filename + ".part"
+    try:
+        write(part_filename)
+        os.replace(part_filename, out_filename)
+    finally:
+        if os.path.exists(part_filename):
+            os.remove(part_filename)
+
+
+def _transcribe(audio_file_name: str, out_filename: str, output_format: str) -> float:
+    """
+    Распознает один файл, фразы пишутся в результат по мере распознавания.
+
+    :return: float  время обработки в секундах
+    """
+    start = time.perf_counter()
+
+    def write(part_filename):
+        with open(part_filename, "wt", encoding="utf8", newline="") as stream:
+            writer = FORMATS[output_format](stream)
+            for result in _engine.iter_segments(audio_file_name):
+                writer.write(to_segment(result))
+            writer.close()
+
+    _write_atomic(out_filename, write)
+    return time.perf_counter() - start
+
+
+def _synthesize(text: str, out_filename: str) -> float:
+    """
+    Озвучивает один текст в ogg.
+
+    :return: float  время обработки в секундах
+    """
+    start = time.perf_counter()
+    ogg_bytes = _engine.text_to_ogg_bytes(text)
+
+    def write(part_filename):
+        with open(part_filename, "wb") as file:
+            file.write(ogg_bytes)
+
+    _write_atomic(out_filename, write)
+    return time.perf_counter() - start
+
+
+def make_jobs(args):
+    """
+    Задачи в виде (имя, функция, аргументы) для всех файлов источника.
+    Если имя текста указывает за пределы --output (например ../a),
+    вместо функции None, а вместо аргументов - текст ошибки.
+    """
+    if args.target == "stt":
+        extension = FORMATS[args.format].extension
+        for name, path in iter_audio(args.source):
+            try:
+                out_filename = output_path(args.output, f"{name}.{extension}")
+            except ValueError as error:
+                yield name, None, str(error)
+                continue
+            yield name, _transcribe, (path, out_filename, args.format)
+    else:
+        for name, text in iter_texts(args.source):
+            try:
+                out_filename = output_path(args.output, f"{name}.ogg")
+            except ValueError as error:
+                yield name, None, str(error)
+                continue
+            yield name, _synthesize, (text, out_filename)
+
+
+def worker_kwargs(args) -> dict:
+    """
+    Параметры модели для каждого процесса-воркера.
+    """
+    if args.target == "stt":
+        kwargs = {"recognizers": 1, "vad": args.vad}
+        if args.model:
+            kwargs["model_path"] = args.model
+        return kwargs
+
+    # Ядра делятся между процессами, синтез внутри процесса последовательный
+    kwargs = {
+        "threads": max(1, (os.cpu_count() or 1) // args.processes),
+        "synth_workers": 1,
+        "optimize": args.optimize,
+        "audio_codec": args.audio_codec,
+    }
+    if args.bitrate:
+        kwargs["bitrate"] = args.bitrate
+    if args.model:
+        kwargs["model_path"] = args.model
+    if args.speaker:
+        kwargs["speaker_voice"] = args.speaker
+    if args.sample_rate:
+        kwargs["sample_rate"] = args.sample_rate
+    return kwargs
+
+
+def run(args) -> dict:
+    """
+    Обрабатывает все файлы источника, кроме отмеченных в checkpoint.
+
+    :return: dict  сводка: сколько готово, пропущено и с ошибками
+    """
+    os.makedirs(args.output, exist_ok=True)
+    checkpoint_path = args.checkpoint or os.path.join(args.output, CHECKPOINT_NAME)
+    finished = read_checkpoint(checkpoint_path)
+    summary = {"done": 0, "skipped": 0, "failed": 0, "processing_time": 0.0}
+    failed = []
+    start = time.perf_counter()
+
+    executor = ProcessPoolExecutor(
+        max_workers=args.processes,
+        # spawn: модели и потоки torch не копируются через fork
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_worker,
+        initargs=(args.target, worker_kwargs(args)),
+    )
+    pending = {}
+    try:
+        with open(checkpoint_path, "at", encoding="utf8") as checkpoint:
+            jobs = make_jobs(args)
+            exhausted = False
+            while pending or not exhausted:
+                # В очереди не больше двух задач на процесс, манифест читается лениво
+                while not exhausted and len(pending) < args.processes * 2:
+                    job = next(jobs, None)
+                    if job is None:
+                        exhausted = True
+                        break
+                    name, func, func_args = job
+                    if name in finished:
+                        summary["skipped"] += 1
+                        continue
+                    if func is None:
+                        logger.error("%s: %s", name, func_args)
+                        summary["failed"] += 1
+                        failed.append(name)
+                        continue
+                    pending[executor.submit(func, *func_args)] = name
+                if not pending:
+                    break
+
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = pending.pop(future)
+                    try:
+                        summary["processing_time"] += future.result()
+                    except Exception as error:
+                        logger.error("%s: %s", name, error)
+                        summary["failed"] += 1
+                        failed.append(name)
+                        continue
+                    checkpoint.write(name + "\n")
+                    checkpoint.flush()
+                    finished.add(name)
+                    summary["done"] += 1
+                    logger.info("%s готов, всего %s", name, summary["done"])
+    except KeyboardInterrupt:
+        logger.warning("Прервано, при следующем запуске обработка продолжится")
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=False)
+        raise
+    executor.shutdown()
+
+    summary["processing_time"] = round(summary["processing_time"], 3)
+    summary["wall_time"] = round(time.perf_counter() - start, 3)
+    summary["failed_names"] = failed
+    return summary
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Пакетное распознавание и озвучивание")
+    parser.add_argument("target", choices=["stt", "tts"], help="распознавание или озвучивание")
+    parser.add_argument("source",
+                        help="stt: папка с аудио или файл со списком путей; "
+                             "tts: папка с .txt или файл, текст на строку")
+    parser.add_argument("--output", required=True, help="папка для результатов")
+    parser.add_argument("--processes", type=int, default=os.cpu_count() or 1,
+                        help="количество процессов с моделями")
+    parser.add_argument("--checkpoint",
+                        help="файл со списком готовых результатов, по умолчанию OUTPUT/.checkpoint")
+    parser.add_argument("--format", choices=list(FORMATS), default="text",
+                        help="формат распознанного текста")
+    parser.add_argument("--vad", action="store_true", help="вырезать паузы перед распознаванием")
+    parser.add_argument("--model", help="путь к модели Vosk или Silero")
+    parser.add_argument("--speaker", help="голос Silero")
+    parser.add_argument("--sample-rate", type=int, help="частота выборки Silero")
+    parser.add_argument("--optimize", choices=["none", "inference", "int8"], default="none",
+                        help="оптимизация Silero")
+    parser.add_argument("--audio-codec", choices=["opus", "vorbis"], default="opus",
+                        help="кодек ogg")
+    parser.add_argument("--bitrate", type=int, help="битрейт Opus в бит/с")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr, format="%(asctime)s %(message)s")
+    summary = run(args)
+    print(json.dumps(summary, ensure_ascii=False, indent=2))
+    if summary["failed"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
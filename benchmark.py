@@ -0,0 +1,514 @@
+# -*- coding: utf8 -*-
+"""
+Бенчмарк STT и TTS: задержка, real-time factor, пропускная способность
+и пиковая память. Результат печатается в формате JSON.
+
+Примеры:
+    python benchmark.py tts --lengths 50 500 5000 --concurrency 1 4
+    python benchmark.py tts --optimize none inference int8
+    python benchmark.py stt --seconds 5 30 120 --repeat 5
+    python benchmark.py codec --repeat 50
+    python benchmark.py stress --concurrency 16 --calls 200
+    python benchmark.py all --output bench.json
+"""
+import argparse
+import array
+import asyncio
+import json
+import math
+import multiprocessing
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+import wave
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from codec import Codec, scratch_root
+from inference import Inference
+from stt import STT
+
+try:
+    import resource  # нет в Windows
+except ImportError:
+    resource = None
+
+# Слова для синтетических текстов
+WORDS = (
+    "привет как дела сегодня хорошая погода мы идем гулять в парк "
+    "вечером будет дождь поэтому возьми зонт завтра утром встреча "
+    "с коллегами обсудим новый проект и планы на следующую неделю"
+).split()
+CHARS_PER_SECOND = 15  # примерная скорость речи диктора, для длины текста STT
+# Стресс-тест: базовая длина текстов, методы TTS по кругу и допуск длительности
+STRESS_LENGTH = 150
+STRESS_METHODS = ("text_to_wav", "text_to_ogg", "_get_ogg")
+STRESS_TOLERANCE = 0.05
+
+
+def make_text(length: int, seed: int = 0) -> str:
+    """
+    Генерирует текст из предложений примерно заданной длины.
+
+    :arg length: int  длина текста в символах
+    :arg seed:   int  зерно генератора, для повторяемости
+    :return: str
+    """
+    rnd = random.Random(seed)
+    sentences = []
+    size = 0
+    while size < length:
+        words = rnd.choices(WORDS, k=rnd.randint(4, 12))
+        sentence = " ".join(words).capitalize() + rnd.choice([".", "!", "?"])
+        sentences.append(sentence)
+        size += len(sentence) + 1
+    return " ".join(sentences)[:length]
+
+
+def wav_duration(file_name: str) -> float:
+    """
+    Длительность wav файла в секундах.
+    """
+    with wave.open(file_name, "rb") as file:
+        return file.getnframes() / file.getframerate()
+
+
+def peak_rss_mb():
+    """
+    Пиковая память процесса в Мб или None, если узнать нельзя.
+    Это максимум за всю жизнь процесса, поэтому каждая конфигурация
+    запускается в своем процессе, см. in_subprocess.
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # В macOS значение в байтах, в Linux - в Кб
+    if sys.platform == "darwin":
+        return round(peak / 1024 / 1024, 1)
+    return round(peak / 1024, 1)
+
+
+def percentile(values: list, percent: float) -> float:
+    """
+    Перцентиль с линейной интерполяцией.
+    """
+    values = sorted(values)
+    if not values:
+        return 0.0
+    position = (len(values) - 1) * percent / 100
+    low = int(position)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (position - low)
+
+
+def summarize(latencies: list, wall_time: float, media_seconds: float, items: int) -> dict:
+    """
+    Сводка по одному прогону.
+
+    :arg latencies:     list[float]  время каждой задачи в секундах
+    :arg wall_time:     float  общее время прогона
+    :arg media_seconds: float  суммарная длительность аудио
+    :arg items:         int    количество задач
+    """
+    return {
+        "items": items,
+        "wall_time": round(wall_time, 3),
+        "latency_p50": round(percentile(latencies, 50), 3),
+        "latency_p95": round(percentile(latencies, 95), 3),
+        "latency_p99": round(percentile(latencies, 99), 3),
+        # Сколько секунд обработки на секунду аудио, меньше - лучше
+        "real_time_factor": round(sum(latencies) / media_seconds, 3) if media_seconds else None,
+        "throughput_items_per_second": round(items / wall_time, 3),
+        "throughput_audio_seconds_per_second": round(media_seconds / wall_time, 3),
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+async def timed(coroutine):
+    """
+    Выполняет корутину и возвращает (результат, время в секундах).
+    """
+    start = time.perf_counter()
+    result = await coroutine
+    return result, time.perf_counter() - start
+
+
+async def bench_tts(inference: Inference, lengths: list, repeat: int, workdir: str) -> list:
+    """
+    Бенчмарк TTS.text_to_ogg и TTS.text_to_wav.
+    """
+    results = []
+    for length in lengths:
+        texts = [make_text(length, seed) for seed in range(repeat)]
+        durations = None
+        # Сначала wav: по нему узнаем длительность речи для RTF обоих методов
+        for method in ("text_to_wav", "text_to_ogg"):
+            calls = []
+            for index, text in enumerate(texts):
+                out_filename = os.path.join(workdir, f"tts_{length}_{index}.{method[-3:]}")
+                calls.append(timed(inference.run_tts(method, text, out_filename)))
+
+            start = time.perf_counter()
+            timings = await asyncio.gather(*calls)
+            wall_time = time.perf_counter() - start
+
+            if durations is None:
+                durations = [wav_duration(path) for path, _ in timings]
+            latencies = [elapsed for _, elapsed in timings]
+            summary = summarize(latencies, wall_time, sum(durations), len(texts))
+            summary.update({"stage": f"tts.{method}", "text_length": length})
+            results.append(summary)
+    return results
+
+
+async def make_audio(inference: Inference, seconds: list, repeat: int, workdir: str) -> dict:
+    """
+    Синтезирует речь нужной длительности для бенчмарка STT.
+
+    :return: dict[int, list[str]]  длительность -> wav файлы
+    """
+    corpus = {}
+    for duration in seconds:
+        files = []
+        for index in range(repeat):
+            text = make_text(duration * CHARS_PER_SECOND, seed=index)
+            out_filename = os.path.join(workdir, f"stt_{duration}_{index}.wav")
+            files.append(await inference.run_tts("text_to_wav", text, out_filename))
+        corpus[duration] = files
+    return corpus
+
+
+async def bench_stt(inference: Inference, corpus: dict) -> list:
+    """
+    Бенчмарк STT.audio_to_text.
+
+    :arg corpus: dict[int, list[str]]  длительность -> аудио файлы
+    """
+    results = []
+    for duration, files in corpus.items():
+        start = time.perf_counter()
+        timings = await asyncio.gather(
+            *(timed(inference.audio_to_text(file_name)) for file_name in files)
+        )
+        wall_time = time.perf_counter() - start
+
+        latencies = [elapsed for _, elapsed in timings]
+        media_seconds = sum(
+            wav_duration(file_name) if file_name.endswith(".wav") else duration
+            for file_name in files
+        )
+        summary = summarize(latencies, wall_time, media_seconds, len(files))
+        summary.update({"stage": "stt.audio_to_text", "audio_seconds": duration})
+        results.append(summary)
+    return results
+
+
+def make_tone(seconds: float, sample_rate: int) -> bytes:
+    """
+    PCM s16le моно с тоном 440 Гц для бенчмарка кодеков.
+    """
+    samples = array.array("h", (
+        int(10000 * math.sin(2 * math.pi * 440 * index / sample_rate))
+        for index in range(int(seconds * sample_rate))
+    ))
+    return samples.tobytes()
+
+
+def bench_codec(ffmpeg_path: str, seconds: list, repeat: int) -> list:
+    """
+    Накладные расходы на одно сообщение: ffmpeg в отдельном процессе
+    против PyAV внутри процесса, для декодирования и кодирования.
+    """
+    backends = {}
+    for backend in ("ffmpeg", "pyav"):
+        try:
+            backends[backend] = Codec(ffmpeg_path, backend=backend)
+        except Exception as error:
+            backends[backend] = error
+
+    sample_rate = 24000
+    results = []
+    for duration in seconds:
+        pcm = make_tone(duration, sample_rate)
+        ogg = None
+        for codec in backends.values():
+            if isinstance(codec, Codec):
+                try:
+                    ogg = codec.encode_ogg(pcm, sample_rate)
+                    break
+                except Exception:
+                    continue
+
+        for backend, codec in backends.items():
+            if not isinstance(codec, Codec):
+                results.append({"stage": "codec", "backend": backend, "error": str(codec)})
+                continue
+            stages = {
+                "codec.encode_ogg": lambda: codec.encode_ogg(pcm, sample_rate),
+                "codec.decode": lambda: b"".join(codec.decode(ogg, STT.default_init["sample_rate"])),
+            }
+            if backend == "pyav" and not codec.pyav_encode:
+                # Кодирование все равно ушло бы в ffmpeg
+                del stages["codec.encode_ogg"]
+            for stage, func in stages.items():
+                if stage == "codec.decode" and ogg is None:
+                    continue
+                latencies = []
+                try:
+                    start_all = time.perf_counter()
+                    for _ in range(repeat):
+                        start = time.perf_counter()
+                        func()
+                        latencies.append(time.perf_counter() - start)
+                    wall_time = time.perf_counter() - start_all
+                except Exception as error:
+                    results.append({"stage": stage, "backend": backend, "error": str(error)})
+                    continue
+                summary = summarize(latencies, wall_time, duration * repeat, repeat)
+                summary.update({"stage": stage, "backend": backend, "audio_seconds": duration})
+                results.append(summary)
+    return results
+
+
+def wav_frames(file_name: str) -> int:
+    """
+    Количество сэмплов в wav файле.
+    """
+    with wave.open(file_name, "rb") as file:
+        return file.getnframes()
+
+
+def check_output(tts, method: str, path: str, expected: int) -> None:
+    """
+    Проверяет результат одного вызова стресс-теста: файл того формата
+    и той длительности, что у эталона для этого текста. Если вызовы
+    перезаписали файлы друг друга, длительность не совпадет.
+
+    :arg expected: int  количество сэмплов эталона
+    :raises Exception: результат не совпал с эталоном
+    """
+    if method == "text_to_wav":
+        frames = wav_frames(path)
+    else:
+        with open(path, "rb") as file:
+            if file.read(4) != b"OggS":
+                raise Exception(f"{method}: не ogg")
+        frames = len(b"".join(tts.codec.decode(path, tts.sample_rate))) // 2
+    if abs(frames - expected) > expected * STRESS_TOLERANCE:
+        raise Exception(f"{method}: {frames} сэмплов вместо {expected}")
+
+
+def bench_stress(threads: int, calls: int, workdir: str) -> dict:
+    """
+    Стресс-тест TTS: один объект TTS вызывается из многих потоков
+    одновременно, каждый результат сверяется с эталоном, а после
+    теста не должно остаться временных файлов.
+
+    :arg threads: int  количество потоков
+    :arg calls:   int  количество вызовов
+    """
+    from tts import TTS
+
+    tts = TTS()
+    # Тексты заметно разной длины, чтобы перепутанные файлы не совпали по длительности
+    texts = [make_text(STRESS_LENGTH * (index + 1), seed=index) for index in range(4)]
+    expected = [
+        wav_frames(tts.text_to_wav(text, os.path.join(workdir, f"reference_{index}.wav")))
+        for index, text in enumerate(texts)
+    ]
+    scratch = scratch_root(tts.scratch_root)
+    scratch_before = set(os.listdir(scratch))
+    cwd_before = set(os.listdir("."))
+
+    def call(number: int):
+        index = number % len(texts)
+        method = STRESS_METHODS[number % len(STRESS_METHODS)]
+        start = time.perf_counter()
+        try:
+            if method == "_get_ogg":
+                # Временный wav и ogg в своей папке вызова
+                path = tts._get_ogg(texts[index])
+            else:
+                extension = method[-3:]
+                path = getattr(tts, method)(
+                    texts[index], os.path.join(workdir, f"stress_{number}.{extension}")
+                )
+            elapsed = time.perf_counter() - start
+            check_output(tts, method, path, expected[index])
+            if method == "_get_ogg":
+                os.remove(path)
+            return elapsed, None
+        except Exception as error:
+            return time.perf_counter() - start, f"{number} {error}"
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        results = list(executor.map(call, range(calls)))
+    wall_time = time.perf_counter() - start
+
+    errors = [error for _, error in results if error is not None]
+    leftovers = sorted(
+        [name for name in set(os.listdir(scratch)) - scratch_before if name.startswith("tts_")]
+        + list(set(os.listdir(".")) - cwd_before)
+    )
+    media_seconds = sum(expected[number % len(texts)] for number in range(calls)) / tts.sample_rate
+    summary = summarize([elapsed for elapsed, _ in results], wall_time, media_seconds, calls)
+    summary.update({
+        "stage": "stress.tts",
+        "threads": threads,
+        "errors": len(errors),
+        "error_samples": errors[:5],
+        "leftover_files": leftovers,
+        "ok": not errors and not leftovers,
+    })
+    return summary
+
+
+def in_subprocess(func, *args):
+    """
+    Выполняет func в новом процессе и возвращает ее результат.
+    ru_maxrss не сбрасывается внутри процесса, поэтому без этого
+    peak_rss_mb каждого прогона включал бы модели всех предыдущих.
+    """
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+        return executor.submit(func, *args).result()
+
+
+async def _run_tts(args, concurrency: int, optimize: str, workdir: str) -> list:
+    inference = Inference(workers=concurrency, tts_kwargs={"optimize": optimize})
+    try:
+        runs = await bench_tts(inference, args.lengths, args.repeat, workdir)
+    finally:
+        inference.shutdown()
+    for item in runs:
+        item["optimize"] = optimize
+    return runs
+
+
+def run_tts(args, concurrency: int, optimize: str, workdir: str) -> list:
+    """
+    Бенчмарк TTS одной конфигурации, выполняется в отдельном процессе.
+    """
+    return asyncio.run(_run_tts(args, concurrency, optimize, workdir))
+
+
+async def _make_corpus(args, workdir: str) -> dict:
+    inference = Inference(workers=1, use_stt=False)
+    try:
+        return await make_audio(inference, args.seconds, args.repeat, workdir)
+    finally:
+        inference.shutdown()
+
+
+def make_corpus(args, workdir: str) -> dict:
+    """
+    Синтетические аудио для STT, выполняется в отдельном процессе,
+    чтобы модель Silero не попала в память бенчмарка STT.
+    """
+    return asyncio.run(_make_corpus(args, workdir))
+
+
+async def _run_stt(concurrency: int, corpus: dict) -> list:
+    inference = Inference(workers=concurrency, use_tts=False)
+    try:
+        return await bench_stt(inference, corpus)
+    finally:
+        inference.shutdown()
+
+
+def run_stt(concurrency: int, corpus: dict) -> list:
+    """
+    Бенчмарк STT одной конфигурации, выполняется в отдельном процессе.
+    """
+    return asyncio.run(_run_stt(concurrency, corpus))
+
+
+def run(args) -> dict:
+    report = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "runs": [],
+    }
+    # Каждая конфигурация в своем процессе: peak_rss_mb только ее
+    if args.target in ("codec", "all"):
+        ffmpeg_path = os.path.join(STT.default_init["ffmpeg_path"], "ffmpeg")
+        report["runs"] += in_subprocess(
+            bench_codec, args.ffmpeg or ffmpeg_path, args.seconds, args.repeat
+        )
+    if args.target == "codec":
+        return report
+    if args.target == "stress":
+        with tempfile.TemporaryDirectory(prefix="stress_") as workdir:
+            for threads in args.concurrency:
+                report["runs"].append(in_subprocess(bench_stress, threads, args.calls, workdir))
+        return report
+
+    with tempfile.TemporaryDirectory(prefix="bench_") as workdir:
+        corpus = None
+        if args.target in ("stt", "all"):
+            if args.audio_dir:
+                files = sorted(
+                    os.path.join(args.audio_dir, name)
+                    for name in os.listdir(args.audio_dir)
+                )
+                corpus = {0: files}
+            else:
+                corpus = in_subprocess(make_corpus, args, workdir)
+
+        for concurrency in args.concurrency:
+            runs = []
+            if args.target in ("tts", "all"):
+                # Каждый режим оптимизации Silero со своими моделями
+                for optimize in args.optimize:
+                    runs += in_subprocess(run_tts, args, concurrency, optimize, workdir)
+            if corpus is not None:
+                runs += in_subprocess(run_stt, concurrency, corpus)
+            for item in runs:
+                item["concurrency"] = concurrency
+            report["runs"] += runs
+    return report
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Бенчмарк STT и TTS")
+    parser.add_argument("target", choices=["stt", "tts", "codec", "stress", "all"], help="что измерять")
+    parser.add_argument("--lengths", type=int, nargs="+", default=[50, 500, 5000],
+                        help="длины текстов для TTS в символах")
+    parser.add_argument("--seconds", type=int, nargs="+", default=[5, 30, 120],
+                        help="длительности аудио для STT в секундах")
+    parser.add_argument("--audio-dir",
+                        help="папка с готовыми аудио для STT вместо синтетических")
+    parser.add_argument("--repeat", type=int, default=4,
+                        help="количество задач каждого размера")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1],
+                        help="количество воркеров, можно несколько значений")
+    parser.add_argument("--optimize", nargs="+", default=["none"],
+                        choices=["none", "inference", "int8"],
+                        help="режимы оптимизации Silero для сравнения TTS")
+    parser.add_argument("--calls", type=int, default=100,
+                        help="количество вызовов TTS в стресс-тесте")
+    parser.add_argument("--ffmpeg", help="путь к ffmpeg для бенчмарка кодеков")
+    parser.add_argument("--output", help="файл для JSON отчета, по умолчанию stdout")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    report = run(args)
+    data = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "wt", encoding="utf8") as file:
+            file.write(data)
+    else:
+        print(data)
+    # Стресс-тест нашел ошибки
+    if any(item.get("ok") is False for item in report["runs"]):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,25 +2,143 @@
 Telegram бот для конвертации голосового/аудио сообщения в текст и
 создания аудио из текста.
 """
+import asyncio
+import functools
 import logging
 import os
-from pathlib import Path
+import tempfile
+from contextlib import nullcontext
+from io import BytesIO
 
 from aiogram import Bot, Dispatcher, executor, types
 from aiogram.types.input_file import InputFile
 from dotenv import load_dotenv
 
-from stt import STT
-from tts import TTS
+import metrics
+from cache import TranscriptCache, TTSCache
+from inference import Inference
+from scheduler import QueueFull, Scheduler
+from signals import exit_on_terminate, ignore_interrupt
+from transcript import FORMATS, TranscriptFile
+from vad import VAD
+from workers import ShardMiddleware, WorkerPool, serve
 
 load_dotenv()
 
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
+WORKERS = int(os.getenv("WORKERS", Inference.default_init["workers"]))
+# Показывать распознанный текст по частям, редактируя одно сообщение
+STREAMING = os.getenv("STREAMING", "0") == "1"
+STREAM_EDIT_INTERVAL = 2  # секунд между редактированиями сообщения
+MESSAGE_LIMIT = 4096  # максимальная длина сообщения Telegram
+# Формат распознанного текста: text, srt, vtt или json.
+# Все форматы кроме text отправляются файлом
+TRANSCRIPT_FORMAT = os.getenv("TRANSCRIPT_FORMAT", "text")
+if TRANSCRIPT_FORMAT not in FORMATS:
+    raise Exception(f"TRANSCRIPT_FORMAT: доступны {', '.join(FORMATS)}")
+# Текст длиннее отправляется файлом, а не сообщениями
+TEXT_DOCUMENT_CHARS = int(os.getenv("TEXT_DOCUMENT_CHARS", MESSAGE_LIMIT * 4))
+# Кэш TTS: количество ogg в памяти и размер на диске в Мб (0 - без диска)
+TTS_CACHE_ITEMS = int(os.getenv("TTS_CACHE_ITEMS", TTSCache.default_init["items"]))
+TTS_CACHE_DISK_MB = int(os.getenv(
+    "TTS_CACHE_DISK_MB", TTSCache.default_init["disk_size"] // (1024 * 1024)
+))
+TTS_CACHE_PATH = os.getenv("TTS_CACHE_PATH", TTSCache.default_init["path"])
+# Запоминать file_id отправленных голосовых и не загружать их повторно
+TTS_CACHE_FILE_ID = os.getenv("TTS_CACHE_FILE_ID", "1") == "1"
+# Отправлять длинный ответ несколькими голосовыми по мере синтеза:
+# первое приходит через время синтеза одного предложения
+TTS_STREAMING = os.getenv("TTS_STREAMING", "0") == "1"
+# Кодек голосовых: opus - формат голосовых Telegram, vorbis - как раньше.
+# Битрейт Opus в бит/с, 0 - подходящий для речи по частоте выборки
+TTS_CODEC = os.getenv("TTS_CODEC", "opus")
+TTS_BITRATE = int(os.getenv("TTS_BITRATE", 0))
+# Оптимизация Silero: none, inference или int8
+TTS_OPTIMIZE = os.getenv("TTS_OPTIMIZE", "none")
+# Потоков torch на одну модель Silero, 0 - поделить ядра между потоками пула
+TTS_THREADS = int(os.getenv("TTS_THREADS", 0))
+# Кэш распознанного текста: файл SQLite, время жизни в часах, количество записей
+STT_CACHE_PATH = os.getenv("STT_CACHE_PATH", TranscriptCache.default_init["path"])
+STT_CACHE_TTL_HOURS = int(os.getenv(
+    "STT_CACHE_TTL_HOURS", TranscriptCache.default_init["ttl"] // 3600
+))
+STT_CACHE_ITEMS = int(os.getenv("STT_CACHE_ITEMS", TranscriptCache.default_init["items"]))
+# Очередь задач: размер, количество одновременных задач одного пользователя
+QUEUE_SIZE = int(os.getenv("QUEUE_SIZE", Scheduler.default_init["max_queue"]))
+USER_JOBS = int(os.getenv("USER_JOBS", Scheduler.default_init["per_user"]))
+# Ограничения на длину текста и длительность аудио в секундах
+MAX_TEXT_LENGTH = int(os.getenv("MAX_TEXT_LENGTH", 5000))
+MAX_AUDIO_SECONDS = int(os.getenv("MAX_AUDIO_SECONDS", 3600))
+# Максимальный размер документа в Мб. Документ скачивается на диск,
+# его формат и длительность проверяются до распознавания
+MAX_DOCUMENT_MB = int(os.getenv("MAX_DOCUMENT_MB", 20))
+# Аудио от этой длительности распознается частями параллельно, 0 - никогда
+LONG_AUDIO_SECONDS = int(os.getenv("LONG_AUDIO_SECONDS", 300))
+# Сколько частей длинного аудио распознается одновременно
+STT_PARALLEL = int(os.getenv("STT_PARALLEL", os.cpu_count() or 4))
+# Таймаут одного вызова ffmpeg в секундах, 0 - без таймаута
+FFMPEG_TIMEOUT = float(os.getenv("FFMPEG_TIMEOUT", 0)) or None
+# Порт HTTP сервера с метриками Prometheus, 0 - не запускать
+METRICS_PORT = int(os.getenv("METRICS_PORT", 0))
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+# Писать в лог строку JSON со временем этапов для каждого запроса
+METRICS_LOG = os.getenv("METRICS_LOG", "0") == "1"
+# Вырезать паузы перед распознаванием: порог громкости речи в dBFS
+# и минимальная длина паузы, которая вырезается
+VAD_ENABLED = os.getenv("VAD", "0") == "1"
+VAD_THRESHOLD_DB = float(os.getenv("VAD_THRESHOLD_DB", VAD.default_init["threshold_db"]))
+VAD_MIN_SILENCE_MS = int(os.getenv("VAD_MIN_SILENCE_MS", VAD.default_init["min_silence_ms"]))
+# Режим: all - распознавание и синтез, stt - только распознавание, tts - только синтез
+MODE = os.getenv("MODE", "all")
+if MODE not in ("all", "stt", "tts"):
+    raise Exception("MODE: доступны all, stt, tts")
+# Загружать модели в фоне сразу после запуска, а не на первом запросе
+WARMUP = os.getenv("WARMUP", "1") == "1"
+# Количество процессов с моделями, 1 - все в одном процессе
+PROCESSES = int(os.getenv("PROCESSES", 1))
+DRAIN_TIMEOUT = int(os.getenv("DRAIN_TIMEOUT", WorkerPool.default_init["drain_timeout"]))
+# Режим webhook включается, если задан публичный адрес, например https://example.com
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBAPP_HOST = os.getenv("WEBAPP_HOST", "0.0.0.0")
+WEBAPP_PORT = int(os.getenv("WEBAPP_PORT", 8080))
 
 bot = Bot(token=TELEGRAM_TOKEN)  # Объект бота
 dp = Dispatcher(bot)  # Диспетчер для бота
-tts = TTS()
-stt = STT()
+tts_cache = TTSCache(
+    items=TTS_CACHE_ITEMS,
+    path=TTS_CACHE_PATH,
+    disk_size=TTS_CACHE_DISK_MB * 1024 * 1024
+)
+# Распознавателей хватает и на задачи из очереди, и на части длинного аудио
+stt_kwargs = {"recognizers": max(WORKERS, STT_PARALLEL), "parallel": STT_PARALLEL}
+if VAD_ENABLED:
+    stt_kwargs["vad"] = VAD(threshold_db=VAD_THRESHOLD_DB, min_silence_ms=VAD_MIN_SILENCE_MS)
+tts_kwargs = {"optimize": TTS_OPTIMIZE, "audio_codec": TTS_CODEC}
+if TTS_BITRATE:
+    tts_kwargs["bitrate"] = TTS_BITRATE
+if TTS_THREADS:
+    tts_kwargs["threads"] = TTS_THREADS
+inference = Inference(  # Пул воркеров для STT и TTS
+    workers=WORKERS,
+    stt_kwargs=stt_kwargs,
+    tts_kwargs=tts_kwargs,
+    tts_cache=tts_cache,
+    timeout=FFMPEG_TIMEOUT,
+    use_stt=MODE in ("all", "stt"),
+    use_tts=MODE in ("all", "tts"),
+    processes=PROCESSES
+)
+stt_cache = TranscriptCache(
+    path=STT_CACHE_PATH,
+    ttl=STT_CACHE_TTL_HOURS * 3600,
+    items=STT_CACHE_ITEMS
+)
+# Очередь задач перед пулом воркеров
+scheduler = Scheduler(workers=WORKERS, max_queue=QUEUE_SIZE, per_user=USER_JOBS)
+metrics.gauge("queue_pending", lambda: scheduler.pending, "Задачи в очереди")
+metrics.gauge("queue_in_flight", lambda: scheduler.in_flight, "Выполняемые задачи")
+metrics.gauge("ready", lambda: int(is_ready()), "Модели загружены")
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(
@@ -29,6 +147,49 @@ logging.basicConfig(
 )
 
 
+def tracked(kind: str):
+    """
+    Замеряет время хэндлера и, если включен METRICS_LOG,
+    пишет в лог время всех этапов запроса.
+    """
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def wrapper(message: types.Message):
+            if METRICS_LOG:
+                request = metrics.request_log(kind, chat_id=message.chat.id)
+            else:
+                request = nullcontext()
+            with request, metrics.timer(f"handler_{kind}"):
+                return await handler(message)
+        return wrapper
+    return decorator
+
+
+async def run_job(message: types.Message, factory, priority: int = 0):
+    """
+    Выполняет тяжелую задачу через очередь. Сообщает позицию в очереди,
+    если задача не запустилась сразу.
+
+    :return: результат задачи или None, если очередь заполнена
+        или задача не уложилась в таймаут
+    """
+    async def on_queued(position: int):
+        await message.reply(f"Вы в очереди, позиция {position}")
+
+    try:
+        return await scheduler.submit(
+            message.from_user.id, factory, priority=priority, on_queued=on_queued
+        )
+    except QueueFull:
+        await message.reply("Бот перегружен, попробуйте позже")
+        return None
+    except asyncio.TimeoutError:
+        # ffmpeg или распознавание не уложились в FFMPEG_TIMEOUT
+        logger.warning("Задача чата %s прервана по таймауту", message.chat.id)
+        await message.reply("Не удалось обработать за отведенное время, попробуйте файл покороче")
+        return None
+
+
 # Хэндлер на команду /start , /help
 @dp.message_handler(commands=["start", "help"])
 async def cmd_start(message: types.Message):
@@ -49,22 +210,211 @@ async def cmd_test(message: types.Message):
 
 # Хэндлер на получение текста
 @dp.message_handler(content_types=[types.ContentType.TEXT])
+@tracked("text")
 async def cmd_text(message: types.Message):
     """
     Обработчик на получение текста
     """
+    if not inference.use_tts:
+        await message.reply("Озвучивание текста отключено")
+        return
+    if len(message.text) > MAX_TEXT_LENGTH:
+        await message.reply(
+            f"Текст слишком длинный, максимум {MAX_TEXT_LENGTH} символов"
+        )
+        return
     await message.reply("Текст получен")
 
-    out_filename = tts.text_to_ogg(message.text)
+    # Голосовое с таким текстом уже загружено в Telegram.
+    # Кэш TTS читает и пишет файлы, поэтому не в цикле событий
+    loop = asyncio.get_running_loop()
+    key = inference.tts_cache_key(message.text)
+    if TTS_CACHE_FILE_ID:
+        file_id = await loop.run_in_executor(None, tts_cache.get_file_id, key)
+        metrics.inc(
+            "cache_requests_total",
+            cache="file_id", result="miss" if file_id is None else "hit"
+        )
+        if file_id is not None:
+            await bot.send_voice(message.from_user.id, file_id,
+                                 caption="Ответ от бота")
+            return
+
+    if TTS_STREAMING and await loop.run_in_executor(None, tts_cache.get, key) is None:
+        await run_job(message, lambda: send_voice_parts(message, key))
+        return
+
+    ogg_bytes = await run_job(
+        message, lambda: inference.text_to_ogg_bytes(message.text)
+    )
+    if ogg_bytes is None:
+        return
+    sent = await send_voice(message, ogg_bytes)
+    if TTS_CACHE_FILE_ID and sent.voice:
+        await loop.run_in_executor(None, tts_cache.put_file_id, key, sent.voice.file_id)
+
+
+async def send_voice(message: types.Message, ogg_bytes: bytes, caption: str = "Ответ от бота"):
+    """
+    Отправляет голосовое сообщение.
+
+    :return: types.Message  отправленное сообщение
+    """
+    voice = InputFile(BytesIO(ogg_bytes), filename="voice.ogg")
+    with metrics.timer("tg_upload"):
+        return await bot.send_voice(message.from_user.id, voice, caption=caption)
+
+
+async def send_voice_parts(message: types.Message, key: str) -> int:
+    """
+    Озвучивает текст по частям и отправляет каждую часть отдельным
+    голосовым, как только она готова. Текст из одной части
+    кэшируется как обычно.
+
+    :arg key: str  ключ кэша TTS для текста
+    :return: int  количество отправленных голосовых
+    """
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    count = 0
+    async for ogg_bytes in inference.iter_text_to_ogg(message.text):
+        if not count:
+            metrics.observe("tts_first_audio", loop.time() - started)
+        count += 1
+        sent = await send_voice(message, ogg_bytes, "Ответ от бота" if count == 1 else None)
+
+    if count == 1:
+        await loop.run_in_executor(None, tts_cache.put, key, ogg_bytes)
+        if TTS_CACHE_FILE_ID and sent.voice:
+            await loop.run_in_executor(None, tts_cache.put_file_id, key, sent.voice.file_id)
+    return count
 
-    # Отправка голосового сообщения
-    path = Path("", out_filename)
-    voice = InputFile(path)
-    await bot.send_voice(message.from_user.id, voice,
-                         caption="Ответ от бота")
 
-    # Удаление временного файла
-    os.remove(out_filename)
+async def send_text(message: types.Message, text: str):
+    """
+    Отправляет текст, разбивая его на сообщения допустимой длины.
+    """
+    for start in range(0, len(text), MESSAGE_LIMIT):
+        await message.answer(text[start:start + MESSAGE_LIMIT])
+
+
+async def download_chunks(file_path: str, chunk_size: int = 64 * 1024):
+    """
+    Скачивает файл из Telegram и выдает его кусками по мере загрузки.
+    """
+    session = await bot.get_session()
+    async with session.get(bot.get_file_url(file_path)) as response:
+        response.raise_for_status()
+        async for chunk in response.content.iter_chunked(chunk_size):
+            yield chunk
+
+
+async def download_to_file(file_path: str, out_filename: str):
+    """
+    Скачивает файл из Telegram на диск кусками, не держа его в памяти.
+    """
+    with open(out_filename, "wb") as file:
+        async for chunk in download_chunks(file_path):
+            file.write(chunk)
+
+
+def file_hash(file_name: str) -> str:
+    """
+    Ключ кэша по содержимому файла, файл читается кусками.
+    """
+    with open(file_name, "rb") as file:
+        return TranscriptCache.content_hash(iter(lambda: file.read(1024 * 1024), b""))
+
+
+async def collect_text(segments, limit: int) -> tuple:
+    """
+    Собирает распознанный текст не длиннее limit символов.
+    Остальные фразы только проходят дальше, например в документ,
+    поэтому память не растет с длиной аудио.
+
+    :arg segments: async iterator[dict]  фразы Vosk
+    :return: tuple[str, bool]  текст и признак, что он полный
+    """
+    texts = []
+    size = 0
+    complete = True
+    async for segment in segments:
+        if not complete or not segment["text"]:
+            continue
+        size += len(segment["text"]) + 1
+        if size > limit:
+            complete = False
+            continue
+        texts.append(segment["text"])
+    return " ".join(texts), complete
+
+
+async def record(segments, document: TranscriptFile):
+    """
+    Дописывает фразы в документ по мере распознавания и выдает их дальше.
+    """
+    async for segment in segments:
+        document.write(segment)
+        yield segment
+
+
+async def send_document(message: types.Message, document: TranscriptFile):
+    """
+    Отправляет распознанный текст файлом.
+    """
+    file = document.finish()
+    with metrics.timer("tg_upload"):
+        await message.answer_document(InputFile(file, filename=document.filename))
+
+
+async def stream_transcript(message: types.Message, segments, limit: int) -> tuple:
+    """
+    Показывает распознанный текст по частям в одном сообщении.
+    Если текст не помещается в сообщение, продолжает в новом.
+    Для кэша собирается не больше limit символов, как в collect_text,
+    поэтому память не растет с длиной аудио.
+
+    :arg segments: async iterator[dict]  фразы Vosk
+    :return: tuple[str, bool]  текст и признак, что он полный
+    """
+    loop = asyncio.get_running_loop()
+    reply = await message.answer("Распознавание...")
+    texts = []
+    size = 0
+    complete = True
+    text = ""
+    shown_text = ""
+    last_edit = loop.time()
+
+    async for segment in segments:
+        if complete:
+            size += len(segment["text"]) + 1
+            if size > limit:
+                complete = False
+                texts = []
+            else:
+                texts.append(segment["text"])
+        if len(text) + 1 + len(segment["text"]) > MESSAGE_LIMIT:
+            # Дописываем текущее сообщение и начинаем новое
+            if text != shown_text:
+                await reply.edit_text(text)
+            text = segment["text"]
+            reply = await message.answer(text)
+            shown_text = text
+            last_edit = loop.time()
+            continue
+
+        text = f"{text} {segment['text']}".strip()
+        if loop.time() - last_edit >= STREAM_EDIT_INTERVAL:
+            await reply.edit_text(text)
+            shown_text = text
+            last_edit = loop.time()
+
+    if not text:
+        text = "Формат документа не поддерживается"
+    if text != shown_text:
+        await reply.edit_text(text)
+    return " ".join(texts), complete
 
 
 # Хэндлер на получение голосового и аудио сообщения
@@ -74,38 +424,257 @@ async def cmd_text(message: types.Message):
     types.ContentType.DOCUMENT
     ]
 )
+@tracked("voice")
 async def voice_message_handler(message: types.Message):
     """
     Обработчик на получение голосового и аудио сообщения.
     """
+    if not inference.use_stt:
+        await message.reply("Распознавание аудио отключено")
+        return
     if message.content_type == types.ContentType.VOICE:
-        file_id = message.voice.file_id
+        media = message.voice
     elif message.content_type == types.ContentType.AUDIO:
-        file_id = message.audio.file_id
+        media = message.audio
     elif message.content_type == types.ContentType.DOCUMENT:
-        file_id = message.document.file_id
+        media = message.document
     else:
         await message.reply("Формат документа не поддерживается")
         return
+    file_id = media.file_id
+
+    # Это аудио уже распознавали, например, пересланное сообщение.
+    # В кэше только текст, для субтитров аудио распознается заново
+    cache_keys = [media.file_unique_id]
+    text = None
+    if TRANSCRIPT_FORMAT == "text":
+        # SQLite пишет на диск, поэтому не в цикле событий
+        loop = asyncio.get_running_loop()
+        text = await loop.run_in_executor(None, stt_cache.get, media.file_unique_id)
+    metrics.inc("cache_requests_total", cache="stt", result="hit" if text else "miss")
+    if text:
+        await send_text(message, text)
+        return
+
+    file_size = getattr(media, "file_size", None)
+    if file_size and file_size > MAX_DOCUMENT_MB * 1024 * 1024:
+        await message.reply(f"Файл слишком большой, максимум {MAX_DOCUMENT_MB} Мб")
+        return
+
+    duration = getattr(media, "duration", None)
+    if duration and duration > MAX_AUDIO_SECONDS:
+        await message.reply(
+            f"Аудио слишком длинное, максимум {MAX_AUDIO_SECONDS} секунд"
+        )
+        return
+
+    # Длинное аудио режется на части, которые распознаются параллельно.
+    # Длительность документа узнается после загрузки, см. transcribe_document
+    long = bool(LONG_AUDIO_SECONDS) and (duration is None or duration >= LONG_AUDIO_SECONDS)
+
+    # Голосовые распознаются раньше длинных аудио и документов
+    priority = 0 if message.content_type == types.ContentType.VOICE else 1
+    await run_job(
+        message,
+        lambda: transcribe(message, file_id, cache_keys, long),
+        priority=priority
+    )
+
 
+async def transcribe(message: types.Message, file_id: str, cache_keys: list, long: bool = False):
+    """
+    Скачивает и распознает аудио, отправляет текст и сохраняет его в кэш.
+    """
     file = await bot.get_file(file_id)
-    file_path = file.file_path
-    file_on_disk = Path("", f"{file_id}.tmp")
-    await bot.download_file(file_path, destination=file_on_disk)
+    if message.content_type == types.ContentType.DOCUMENT:
+        await transcribe_document(message, file.file_path, cache_keys)
+        return
+
+    # Распознавание начинается, не дожидаясь конца загрузки
+    audio = download_chunks(file.file_path)
     await message.reply("Аудио получено")
+    await recognize(message, audio, cache_keys, long)
+
+
+async def transcribe_document(message: types.Message, file_path: str, cache_keys: list):
+    """
+    Документ скачивается во временный файл, затем проверяются его
+    формат и длительность. Память не зависит от размера файла.
+    """
+    loop = asyncio.get_running_loop()
+    with tempfile.TemporaryDirectory(prefix="document_") as workdir:
+        audio_path = os.path.join(workdir, "audio")
+        with metrics.timer("tg_download"):
+            await download_to_file(file_path, audio_path)
+        await message.reply("Аудио получено")
+
+        # Документ могли загрузить заново, проверяем по содержимому
+        content_key = await loop.run_in_executor(None, file_hash, audio_path)
+        cache_keys.append(content_key)
+        text = None
+        if TRANSCRIPT_FORMAT == "text":
+            text = await loop.run_in_executor(None, stt_cache.get, content_key)
+        metrics.inc("cache_requests_total", cache="stt_content", result="hit" if text else "miss")
+        if text:
+            await loop.run_in_executor(None, stt_cache.put, cache_keys, text)
+            await send_text(message, text)
+            return
+
+        info = await inference.probe(audio_path)
+        if not info["audio"]:
+            await message.answer("Формат документа не поддерживается")
+            return
+        duration = info["duration"]
+        if duration and duration > MAX_AUDIO_SECONDS:
+            await message.answer(
+                f"Аудио слишком длинное, максимум {MAX_AUDIO_SECONDS} секунд"
+            )
+            return
+
+        long = bool(LONG_AUDIO_SECONDS) and (duration is None or duration >= LONG_AUDIO_SECONDS)
+        await recognize(message, audio_path, cache_keys, long)
+
+
+async def recognize(message: types.Message, audio, cache_keys: list, long: bool = False):
+    """
+    Распознает аудио, отправляет текст и сохраняет его в кэш.
+
+    :arg audio: путь к файлу или асинхронный итератор кусков bytes
+    """
+    # Фразы сразу пишутся в файл, большой текст не собирается в памяти
+    with TranscriptFile(TRANSCRIPT_FORMAT) as document:
+        segments = record(inference.iter_segments(audio, long=long), document)
+        if STREAMING:
+            text, complete = await stream_transcript(message, segments, TEXT_DOCUMENT_CHARS)
+        else:
+            text, complete = await collect_text(segments, TEXT_DOCUMENT_CHARS)
+
+        if not text and complete:
+            if not STREAMING:
+                await message.answer("Формат документа не поддерживается")
+        elif TRANSCRIPT_FORMAT != "text" or (not complete and not STREAMING):
+            await send_document(message, document)
+        elif not STREAMING:
+            # При STREAMING текст уже показан сообщениями
+            await send_text(message, text)
+
+    # Текст длиннее TEXT_DOCUMENT_CHARS целиком не собирается и не кэшируется
+    if text and complete:
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, stt_cache.put, cache_keys, text)
+
+
+metrics_runner = None
+warm_up_task = None
+ready_task = None
+worker_index = None  # номер процесса-воркера, None - фронт или единственный процесс
+worker_ready = None  # multiprocessing.Event воркера, фронт видит по нему готовность
+
+
+def is_ready() -> bool:
+    """
+    Бот готов принимать запросы: модели загружены. Фронт при PROCESSES > 1
+    моделей не держит, он готов, когда все воркеры живы и загрузили модели.
+    """
+    if pool is not None:
+        return pool.ready
+    return inference.ready
+
+
+async def report_ready():
+    """
+    Воркер сообщает фронту, что модели загружены.
+    """
+    while not inference.ready:
+        await asyncio.sleep(1)
+    worker_ready.set()
+
+
+async def warm_up():
+    """
+    Загрузка моделей в фоне, ошибка не останавливает бота:
+    модели загрузятся при первом запросе.
+    """
+    try:
+        await inference.warm_up()
+    except Exception:
+        logger.exception("Не удалось загрузить модели заранее")
+
+
+async def on_startup(dp: Dispatcher):
+    """
+    Запуск HTTP сервера с метриками, загрузка моделей и установка webhook
+    """
+    global metrics_runner, warm_up_task, ready_task
+    if METRICS_PORT:
+        # У каждого воркера свой порт сразу после порта фронта
+        port = METRICS_PORT if worker_index is None else METRICS_PORT + 1 + worker_index
+        metrics_runner = await metrics.start_server(METRICS_HOST, port, ready=is_ready)
+    if WARMUP and pool is None:
+        warm_up_task = asyncio.ensure_future(warm_up())
+    if worker_ready is not None:
+        ready_task = asyncio.ensure_future(report_ready())
+    if WEBHOOK_HOST and worker_index is None:
+        await bot.set_webhook(WEBHOOK_HOST + WEBHOOK_PATH)
+
+
+async def on_shutdown(dp: Dispatcher):
+    """
+    Остановка воркеров и пула потоков при завершении работы бота
+    """
+    if pool is not None:
+        # Воркеры дорабатывают принятые обновления
+        await asyncio.get_running_loop().run_in_executor(None, pool.drain)
+    if ready_task is not None:
+        ready_task.cancel()
+    if metrics_runner is not None:
+        await metrics_runner.cleanup()
+    inference.shutdown()
+    stt_cache.close()
+
+
+def run_worker(index: int, queue, drain_timeout: float, ready):
+    """
+    Точка входа процесса-воркера: модели и хэндлеры этого процесса
+    обрабатывают обновления, которые передает фронт.
+    """
+    global worker_index, worker_ready
+    worker_index = index
+    worker_ready = ready
+    ignore_interrupt(terminate=True)
+    asyncio.run(serve(dp, queue, drain_timeout, on_startup=on_startup, on_shutdown=on_shutdown))
 
-    text = stt.audio_to_text(file_on_disk)
-    if not text:
-        text = "Формат документа не поддерживается"
-    await message.answer(text)
 
-    os.remove(file_on_disk)  # Удаление временного файла
+pool = None  # процессы-воркеры, если PROCESSES > 1
 
 
 if __name__ == "__main__":
     # Запуск бота
     print("Запуск бота")
+    # SIGTERM от docker или systemd тоже вызывает on_shutdown
+    exit_on_terminate()
+    if PROCESSES > 1:
+        pool = WorkerPool(run_worker, processes=PROCESSES, drain_timeout=DRAIN_TIMEOUT)
+        pool.start()
+        # Фронт только принимает обновления и передает их воркерам
+        dp.middleware.setup(ShardMiddleware(pool))
     try:
-        executor.start_polling(dp, skip_updates=True)
+        if WEBHOOK_HOST:
+            executor.start_webhook(
+                dp,
+                WEBHOOK_PATH,
+                skip_updates=True,
+                on_startup=on_startup,
+                on_shutdown=on_shutdown,
+                host=WEBAPP_HOST,
+                port=WEBAPP_PORT
+            )
+        else:
+            executor.start_polling(
+                dp,
+                skip_updates=True,
+                on_startup=on_startup,
+                on_shutdown=on_shutdown
+            )
     except (KeyboardInterrupt, SystemExit):
         pass
@@ -0,0 +1,302 @@
+# -*- coding: utf8 -*-
+"""
+Кэш результатов TTS и STT
+"""
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTSCache:
+    """
+    Кэш ogg файлов TTS с ключом по нормализованному тексту, голосу
+    и частоте выборки. Первый уровень - LRU в памяти, второй - файлы
+    на диске с ограничением общего размера. Дополнительно хранит
+    file_id голосовых сообщений Telegram, чтобы не загружать их повторно.
+    Методы читают и пишут файлы, из асинхронного кода их нужно
+    вызывать через run_in_executor.
+    """
+    default_init = {
+        "items": 256,                     # количество ogg в памяти
+        "path": "cache/tts",              # папка для кэша на диске
+        "disk_size": 512 * 1024 * 1024,   # размер кэша на диске в байтах, 0 - без диска
+    }
+
+    def __init__(self, items=None, path=None, disk_size=None) -> None:
+        """
+        Настройка кэша.
+
+        :arg items:     int  количество ogg в памяти
+        :arg path:      str  папка для кэша на диске
+        :arg disk_size: int  размер кэша на диске в байтах, 0 - без диска
+        """
+        self.items = items if items else TTSCache.default_init["items"]
+        self.path = path if path else TTSCache.default_init["path"]
+        self.disk_size = disk_size if disk_size is not None else TTSCache.default_init["disk_size"]
+
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()
+        self._file_ids = OrderedDict()
+        self._disk_used = 0
+
+        if self.disk_size:
+            os.makedirs(self.path, exist_ok=True)
+            self._disk_used = sum(
+                entry.stat().st_size for entry in os.scandir(self.path) if entry.is_file()
+            )
+
+    @staticmethod
+    def make_key(text: str, speaker_voice: str, sample_rate: int) -> str:
+        """
+        Ключ кэша для нормализованного текста, голоса и частоты выборки.
+
+        :arg text:          str  нормализованный текст
+        :arg speaker_voice: str  голос диктора
+        :arg sample_rate:   int  частота выборки
+        :return: str  sha256 в hex
+        """
+        data = "\0".join((text.strip(), speaker_voice, str(sample_rate)))
+        return hashlib.sha256(data.encode("utf8")).hexdigest()
+
+    def _disk_path(self, key: str, extension: str) -> str:
+        return os.path.join(self.path, f"{key}.{extension}")
+
+    def _remember(self, storage: OrderedDict, key: str, value, limit: int) -> None:
+        """
+        Кладет значение в LRU словарь и вытесняет самые старые записи.
+        """
+        storage[key] = value
+        storage.move_to_end(key)
+        while len(storage) > limit:
+            storage.popitem(last=False)
+
+    def _read_disk(self, key: str, extension: str):
+        if not self.disk_size:
+            return None
+        path = self._disk_path(key, extension)
+        try:
+            with open(path, "rb") as file:
+                data = file.read()
+            # Обновляем время доступа, по нему идет вытеснение
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return data
+
+    def _write_disk(self, key: str, extension: str, data: bytes) -> None:
+        if not self.disk_size:
+            return
+        path = self._disk_path(key, extension)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as file:
+            file.write(data)
+        os.replace(tmp_path, path)
+        with self._lock:
+            self._disk_used += len(data)
+            if self._disk_used > self.disk_size:
+                self._evict_disk()
+
+    def _evict_disk(self) -> None:
+        """
+        Удаляет самые давно использованные файлы, пока кэш больше лимита.
+        Вызывается под self._lock.
+        """
+        entries = sorted(
+            (entry for entry in os.scandir(self.path)
+             if entry.is_file() and not entry.name.endswith(".tmp")),
+            key=lambda entry: entry.stat().st_mtime
+        )
+        self._disk_used = sum(entry.stat().st_size for entry in entries)
+        for entry in entries:
+            if self._disk_used <= self.disk_size:
+                break
+            try:
+                size = entry.stat().st_size
+                os.remove(entry.path)
+            except FileNotFoundError:
+                continue
+            self._disk_used -= size
+
+    def get(self, key: str):
+        """
+        Возвращает ogg из кэша.
+
+        :arg key: str  ключ кэша
+        :return: bytes | None  ogg файл в байтах
+        """
+        with self._lock:
+            data = self._memory.get(key)
+            if data is not None:
+                self._memory.move_to_end(key)
+                return data
+
+        data = self._read_disk(key, "ogg")
+        if data is not None:
+            with self._lock:
+                self._remember(self._memory, key, data, self.items)
+        return data
+
+    def put(self, key: str, data: bytes) -> None:
+        """
+        Сохраняет ogg в кэш.
+
+        :arg key:  str    ключ кэша
+        :arg data: bytes  ogg файл в байтах
+        """
+        with self._lock:
+            self._remember(self._memory, key, data, self.items)
+        self._write_disk(key, "ogg", data)
+
+    def get_file_id(self, key: str):
+        """
+        Возвращает file_id голосового сообщения Telegram из кэша.
+
+        :arg key: str  ключ кэша
+        :return: str | None  file_id
+        """
+        with self._lock:
+            file_id = self._file_ids.get(key)
+            if file_id is not None:
+                self._file_ids.move_to_end(key)
+                return file_id
+
+        data = self._read_disk(key, "file_id")
+        if data is None:
+            return None
+        file_id = data.decode("utf8")
+        with self._lock:
+            self._remember(self._file_ids, key, file_id, self.items * 16)
+        return file_id
+
+    def put_file_id(self, key: str, file_id: str) -> None:
+        """
+        Сохраняет file_id голосового сообщения Telegram в кэш.
+
+        :arg key:     str  ключ кэша
+        :arg file_id: str  file_id
+        """
+        with self._lock:
+            self._remember(self._file_ids, key, file_id, self.items * 16)
+        self._write_disk(key, "file_id", file_id.encode("utf8"))
+
+
+class TranscriptCache:
+    """
+    Кэш распознанного текста в SQLite. Ключ - file_unique_id Telegram
+    или хэш содержимого файла. Записи удаляются по истечении ttl
+    и при превышении количества записей.
+    get и put пишут в базу и ждут диск, из асинхронного кода
+    их нужно вызывать через run_in_executor.
+    """
+    default_init = {
+        "path": "cache/stt.sqlite3",  # файл базы SQLite
+        "ttl": 30 * 24 * 60 * 60,     # время жизни записи в секундах
+        "items": 100000,              # максимальное количество записей
+    }
+
+    def __init__(self, path=None, ttl=None, items=None) -> None:
+        """
+        Настройка кэша.
+
+        :arg path:  str  файл базы SQLite
+        :arg ttl:   int  время жизни записи в секундах
+        :arg items: int  максимальное количество записей
+        """
+        self.path = path if path else TranscriptCache.default_init["path"]
+        self.ttl = ttl if ttl else TranscriptCache.default_init["ttl"]
+        self.items = items if items else TranscriptCache.default_init["items"]
+
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS transcripts ("
+            " key TEXT PRIMARY KEY,"
+            " text TEXT NOT NULL,"
+            " created REAL NOT NULL,"
+            " used REAL NOT NULL)"
+        )
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS transcripts_used ON transcripts (used)"
+        )
+        self._db.commit()
+
+    @staticmethod
+    def content_hash(data) -> str:
+        """
+        Хэш содержимого файла для ключа кэша.
+
+        :arg data: bytes  содержимое файла или итератор его кусков bytes
+        :return: str  ключ кэша
+        """
+        if isinstance(data, (bytes, bytearray, memoryview)):
+            data = [data]
+        digest = hashlib.sha256()
+        for chunk in data:
+            digest.update(chunk)
+        return f"sha256:{digest.hexdigest()}"
+
+    def get(self, key: str):
+        """
+        Возвращает распознанный текст из кэша.
+
+        :arg key: str  ключ кэша
+        :return: str | None  распознанный текст
+        """
+        now = time.time()
+        with self._lock:
+            row = self._db.execute(
+                "SELECT text FROM transcripts WHERE key = ? AND created > ?",
+                (key, now - self.ttl)
+            ).fetchone()
+            if row is None:
+                return None
+            self._db.execute(
+                "UPDATE transcripts SET used = ? WHERE key = ?", (now, key)
+            )
+            self._db.commit()
+        return row[0]
+
+    def put(self, keys: list, text: str) -> None:
+        """
+        Сохраняет распознанный текст в кэш под всеми ключами.
+
+        :arg keys: list[str]  ключи кэша
+        :arg text: str        распознанный текст
+        """
+        now = time.time()
+        with self._lock:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO transcripts (key, text, created, used)"
+                " VALUES (?, ?, ?, ?)",
+                [(key, text, now, now) for key in keys if key]
+            )
+            self._evict(now)
+            self._db.commit()
+
+    def _evict(self, now: float) -> None:
+        """
+        Удаляет устаревшие записи и самые давно использованные сверх лимита.
+        Вызывается под self._lock.
+        """
+        self._db.execute(
+            "DELETE FROM transcripts WHERE created <= ?", (now - self.ttl,)
+        )
+        self._db.execute(
+            "DELETE FROM transcripts WHERE key IN ("
+            " SELECT key FROM transcripts ORDER BY used DESC LIMIT -1 OFFSET ?)",
+            (self.items,)
+        )
+
+    def close(self) -> None:
+        """
+        Закрывает базу SQLite.
+        """
+        with self._lock:
+            self._db.close()
@@ -0,0 +1,622 @@
+# -*- coding: utf8 -*-
+"""
+Декодирование аудио в PCM и кодирование PCM в ogg.
+
+По умолчанию ogg кодируется в Opus с битрейтом для голоса: такой
+формат ожидает плеер голосовых Telegram, а файлы в несколько раз
+меньше, чем Vorbis. Vorbis оставлен для совместимости.
+
+Если установлен PyAV (pip install av), основные преобразования
+выполняются внутри процесса без запуска ffmpeg на каждое сообщение.
+Без PyAV, а также для форматов, которые PyAV не открыл,
+используется ffmpeg в отдельном процессе.
+
+У всех вызовов ffmpeg есть асинхронные варианты на
+asyncio.create_subprocess_exec: при отмене задачи или по таймауту
+процесс ffmpeg завершается.
+"""
+import asyncio
+import io
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import threading
+from contextlib import contextmanager
+
+try:
+    import av  # PyAV, необязательная зависимость
+    import numpy as np
+    from av.error import FFmpegError
+except ImportError:
+    av = None
+
+# Кодеки ogg: имя в настройках -> кодировщик ffmpeg
+ENCODERS = {"opus": "libopus", "vorbis": "libvorbis"}
+# Частоты, которые Opus кодирует без пересчета
+OPUS_RATES = (8000, 12000, 16000, 24000, 48000)
+# Битрейт Opus для речи по частоте выборки, бит/с
+VOICE_BITRATES = {8000: 12000, 12000: 16000, 16000: 20000, 24000: 24000, 48000: 32000}
+# Временные файлы в памяти (tmpfs), если она есть
+SHM_PATH = "/dev/shm"
+
+
+def scratch_root(root: str = None) -> str:
+    """
+    Папка для временных файлов: root, tmpfs /dev/shm или
+    системная временная папка.
+    """
+    if root:
+        return root
+    if os.path.isdir(SHM_PATH) and os.access(SHM_PATH, os.W_OK):
+        return SHM_PATH
+    return tempfile.gettempdir()
+
+
+@contextmanager
+def scratch_dir(root: str = None, prefix: str = "audio_"):
+    """
+    Отдельная временная папка для одного вызова, удаляется при выходе.
+    Одновременные вызовы не перезаписывают файлы друг друга.
+
+    :arg root: str  где создать папку, см. scratch_root
+    :return: str  путь к папке
+    """
+    path = tempfile.mkdtemp(prefix=prefix, dir=scratch_root(root))
+    try:
+        yield path
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def scratch_file(extension: str, root: str = None, prefix: str = "audio_") -> str:
+    """
+    Уникальное имя выходного файла, если вызывающий его не задал.
+    Файл не удаляется автоматически, он принадлежит вызывающему.
+
+    :arg extension: str  расширение без точки
+    :return: str  путь к пустому файлу
+    """
+    handle, path = tempfile.mkstemp(suffix=f".{extension}", prefix=prefix, dir=scratch_root(root))
+    os.close(handle)
+    return path
+
+
+async def run_ffmpeg_async(command: list, input_bytes: bytes = None, timeout: float = None) -> bytes:
+    """
+    Запускает ffmpeg и ждет завершения, не блокируя цикл событий.
+    При отмене или по таймауту процесс ffmpeg завершается.
+
+    :arg command:     list[str]  команда ffmpeg
+    :arg input_bytes: bytes      данные для stdin, None - без stdin
+    :arg timeout:     float      таймаут в секундах, None - без таймаута
+    :return: bytes  данные из stdout
+    :raises asyncio.TimeoutError: ffmpeg не завершился за timeout
+    """
+    process = await asyncio.create_subprocess_exec(
+        *command,
+        stdin=subprocess.DEVNULL if input_bytes is None else subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL
+    )
+    try:
+        out_bytes, _ = await asyncio.wait_for(process.communicate(input_bytes), timeout)
+    finally:
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+    return out_bytes
+
+
+class _IterReader(io.RawIOBase):
+    """
+    Файловый объект поверх итератора кусков bytes.
+    Пока включена запись, прочитанные куски сохраняются,
+    чтобы их можно было передать в ffmpeg, если PyAV не справился.
+    Ошибка источника сохраняется в error: PyAV может принять ее
+    за конец файла.
+    """
+    def __init__(self, chunks) -> None:
+        self._chunks = iter(chunks)
+        self._buffer = b""
+        self.recorded = []
+        self.recording = True
+        self.error = None
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        while not self._buffer:
+            try:
+                chunk = next(self._chunks, None)
+            except Exception as error:
+                self.error = error
+                raise
+            if chunk is None:
+                return 0
+            chunk = bytes(chunk)
+            if self.recording:
+                self.recorded.append(chunk)
+            self._buffer = chunk
+        size = min(len(buffer), len(self._buffer))
+        buffer[:size] = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return size
+
+    def rest(self):
+        """
+        Записанные и еще не прочитанные куски для повторного чтения.
+        """
+        yield from self.recorded
+        self.recorded = []
+        yield from self._chunks
+
+
+class Codec:
+    """
+    Преобразования аудио для STT и TTS.
+    """
+    default_init = {
+        "backend": "auto",  # "auto" - PyAV если установлен, "pyav", "ffmpeg"
+        "audio_codec": "opus",  # кодек ogg: "opus" или "vorbis"
+        "bitrate": None,  # битрейт Opus в бит/с, None - по частоте выборки
+    }
+
+    def __init__(self, ffmpeg_path: str, backend=None, audio_codec=None, bitrate=None) -> None:
+        """
+        Настройка кодека.
+
+        :arg ffmpeg_path: str  путь к ffmpeg
+        :arg backend:     str  "auto", "pyav" или "ffmpeg"
+        :arg audio_codec: str  кодек ogg: "opus" или "vorbis"
+        :arg bitrate:     int  битрейт Opus в бит/с, None - по частоте выборки
+        """
+        self.ffmpeg_path = ffmpeg_path
+        self.backend = backend if backend else Codec.default_init["backend"]
+        self.audio_codec = audio_codec if audio_codec else Codec.default_init["audio_codec"]
+        self.bitrate = bitrate if bitrate else Codec.default_init["bitrate"]
+        if self.audio_codec not in ENCODERS:
+            raise Exception(f"audio_codec: доступны {', '.join(ENCODERS)}")
+        self.encoder = ENCODERS[self.audio_codec]
+
+        if self.backend == "pyav" and av is None:
+            raise Exception("PyAV не установлен: pip install av")
+        self.use_pyav = av is not None and self.backend in ("auto", "pyav")
+        # Не во всех сборках PyAV есть libopus и libvorbis
+        self.pyav_encode = self.use_pyav and self.encoder in av.codecs_available
+
+    @staticmethod
+    def iter_chunks(audio, chunk_size: int = 64 * 1024):
+        """
+        Выдает аудио в памяти кусками bytes.
+
+        :arg audio: bytes, файловый объект или итератор кусков bytes
+        :return: generator[bytes]
+        """
+        if isinstance(audio, (bytes, bytearray, memoryview)):
+            yield audio
+        elif hasattr(audio, "read"):
+            for chunk in iter(lambda: audio.read(chunk_size), b""):
+                yield chunk
+        else:
+            yield from audio
+
+    @staticmethod
+    def _is_path(audio) -> bool:
+        return isinstance(audio, (str, os.PathLike))
+
+    def decode(self, audio, sample_rate: int, chunk_size: int = 4000):
+        """
+        Декодирует аудио в PCM s16le моно.
+
+        :arg audio: путь к файлу, bytes, файловый объект или итератор bytes
+        :arg sample_rate: int  частота выборки PCM
+        :arg chunk_size:  int  размер кусков PCM в байтах
+        :return: generator[bytes]  куски PCM
+        :raises Exception: ошибка источника, например обрыв загрузки
+        """
+        if self.use_pyav:
+            if self._is_path(audio):
+                source = os.fspath(audio)
+            elif isinstance(audio, (bytes, bytearray, memoryview)):
+                source = io.BytesIO(audio)
+            else:
+                source = _IterReader(self.iter_chunks(audio))
+
+            try:
+                container = av.open(source, mode="r")
+            except (FFmpegError, ValueError):
+                # PyAV не открыл формат, пробуем ffmpeg
+                if isinstance(source, _IterReader) and source.error is not None:
+                    # Формат ни при чем, оборвался источник
+                    raise source.error
+                if isinstance(source, _IterReader):
+                    audio = source.rest()
+                elif isinstance(source, io.BytesIO):
+                    source.seek(0)
+                    audio = source
+                container = None
+
+            if container is not None:
+                if isinstance(source, _IterReader):
+                    source.recording = False
+                    source.recorded = []
+                yield from self._rechunk(
+                    self._decode_pyav(container, sample_rate), chunk_size
+                )
+                if isinstance(source, _IterReader) and source.error is not None:
+                    # Аудио обрезано, результат не полный
+                    raise source.error
+                return
+
+        yield from self._decode_ffmpeg(audio, sample_rate, chunk_size)
+
+    @staticmethod
+    def _rechunk(blocks, chunk_size: int):
+        """
+        Перекладывает PCM в куски одинакового размера.
+        """
+        buffer = b""
+        for block in blocks:
+            buffer += block
+            while len(buffer) >= chunk_size:
+                yield buffer[:chunk_size]
+                buffer = buffer[chunk_size:]
+        if buffer:
+            yield buffer
+
+    @staticmethod
+    def _decode_pyav(container, sample_rate: int):
+        """
+        Декодирование через PyAV внутри процесса.
+        """
+        resampler = None
+        try:
+            stream = container.streams.audio[0]
+            for frame in container.decode(stream):
+                if resampler is None:
+                    if Codec._is_pcm(frame, sample_rate):
+                        # Уже нужный формат (wav 16 кГц моно): без ресемплера
+                        yield frame.to_ndarray().tobytes()
+                        continue
+                    resampler = av.AudioResampler(format="s16", layout="mono", rate=sample_rate)
+                frame.pts = None
+                for out in Codec._as_list(resampler.resample(frame)):
+                    yield out.to_ndarray().tobytes()
+            if resampler is not None:
+                # Остаток в буфере ресемплера
+                for out in Codec._as_list(resampler.resample(None)):
+                    yield out.to_ndarray().tobytes()
+        finally:
+            container.close()
+
+    @staticmethod
+    def _is_pcm(frame, sample_rate: int) -> bool:
+        """
+        Кадр уже в PCM s16 моно с нужной частотой.
+        """
+        return (
+            frame.format.name == "s16"
+            and frame.layout.name == "mono"
+            and frame.sample_rate == sample_rate
+        )
+
+    @staticmethod
+    def _as_list(frames) -> list:
+        # PyAV < 9 возвращает один кадр или None, новые версии - список
+        if frames is None:
+            return []
+        if isinstance(frames, list):
+            return frames
+        return [frames]
+
+    def _feed_stdin(self, process: subprocess.Popen, audio, errors: list) -> None:
+        """
+        Передает аудио в stdin ffmpeg и закрывает его в конце.
+        Если источник оборвался, ошибка добавляется в errors
+        и ffmpeg завершается, чтобы он не принял обрыв за конец аудио.
+        """
+        try:
+            for chunk in self.iter_chunks(audio):
+                process.stdin.write(chunk)
+        except (BrokenPipeError, ValueError):
+            # ffmpeg завершился или декодирование прервано
+            pass
+        except Exception as error:
+            # Ошибка записывается до kill, поэтому она видна к концу stdout
+            errors.append(error)
+            process.kill()
+        finally:
+            try:
+                process.stdin.close()
+            except BrokenPipeError:
+                pass
+
+    def probe(self, in_filename: str) -> dict:
+        """
+        Формат и длительность файла без декодирования аудио.
+
+        :arg in_filename: str  путь к файлу
+        :return: dict  {"format": str | None, "duration": float | None,
+            "audio": bool - в файле есть звуковая дорожка}
+        """
+        if self.use_pyav:
+            try:
+                container = av.open(os.fspath(in_filename), mode="r")
+            except (FFmpegError, ValueError):
+                container = None
+            if container is not None:
+                try:
+                    duration = container.duration
+                    return {
+                        "format": container.format.name,
+                        # Длительность в микросекундах (AV_TIME_BASE)
+                        "duration": duration / 1000000 if duration else None,
+                        "audio": bool(container.streams.audio),
+                    }
+                finally:
+                    container.close()
+        return self._probe_ffmpeg(in_filename)
+
+    def _probe_ffmpeg(self, in_filename: str) -> dict:
+        """
+        Разбирает описание файла, которое ffmpeg печатает без выходного файла.
+        """
+        process = subprocess.run(
+            [self.ffmpeg_path, "-hide_banner", "-i", os.fspath(in_filename)],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE
+        )
+        info = process.stderr.decode("utf8", errors="replace")
+        input_format = re.search(r"^Input #0, ([^ ]+), from", info, re.MULTILINE)
+        duration = re.search(r"Duration: (\d+):(\d+):(\d+(?:\.\d+)?)", info)
+        return {
+            "format": input_format.group(1).rstrip(",") if input_format else None,
+            "duration": (
+                int(duration.group(1)) * 3600 + int(duration.group(2)) * 60 + float(duration.group(3))
+                if duration else None
+            ),
+            "audio": re.search(r"Stream #\S+.*: Audio:", info) is not None,
+        }
+
+    def _decode_command(self, in_filename, sample_rate: int) -> list:
+        """
+        Команда ffmpeg для декодирования в PCM s16le моно в stdout.
+        """
+        return [
+            self.ffmpeg_path,
+            "-loglevel", "quiet",
+            "-i", in_filename,              # имя входного файла или pipe:0
+            "-ar", str(sample_rate),        # частота выборки
+            "-ac", "1",                     # кол-во каналов
+            "-f", "s16le",                  # кодек для перекодирования, у нас wav
+            "-"                             # имя выходного файла нет, тк читаем из stdout
+        ]
+
+    def _decode_ffmpeg(self, audio, sample_rate: int, chunk_size: int):
+        """
+        Декодирование через ffmpeg в отдельном процессе.
+        """
+        is_path = self._is_path(audio)
+        # Конвертация аудио в wav и результат в process.stdout
+        process = subprocess.Popen(
+            self._decode_command(audio if is_path else "pipe:0", sample_rate),
+            stdin=None if is_path else subprocess.PIPE,
+            stdout=subprocess.PIPE
+                                   )
+        errors = []
+        if not is_path:
+            # Пишем в ffmpeg из отдельного потока, чтобы декодирование
+            # шло одновременно с получением данных
+            threading.Thread(
+                target=self._feed_stdin,
+                args=(process, audio, errors),
+                daemon=True
+            ).start()
+        try:
+            while True:
+                data = process.stdout.read(chunk_size)
+                if len(data) == 0:
+                    break
+                yield data
+            process.wait()
+            if errors:
+                # Аудио обрезано, результат не полный
+                raise errors[0]
+        finally:
+            # Декодирование прервано, ffmpeg больше не нужен
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+
+    def _is_native_rate(self, sample_rate: int) -> bool:
+        return self.audio_codec != "opus" or sample_rate in OPUS_RATES
+
+    def _bitrate(self, sample_rate: int) -> int:
+        """
+        Битрейт Opus: заданный или достаточный для речи на этой частоте.
+        """
+        if self.bitrate:
+            return self.bitrate
+        return VOICE_BITRATES.get(sample_rate, VOICE_BITRATES[48000])
+
+    def encode_args(self, sample_rate: int) -> list:
+        """
+        Параметры ffmpeg для кодирования в выбранный кодек ogg.
+
+        :arg sample_rate: int  частота выборки входного аудио
+        :return: list[str]
+        """
+        args = ["-acodec", self.encoder]
+        if self.audio_codec == "opus":
+            if not self._is_native_rate(sample_rate):
+                # Opus принимает только свои частоты
+                sample_rate = 48000
+                args += ["-ar", str(sample_rate)]
+            args += ["-b:a", str(self._bitrate(sample_rate)), "-application", "voip"]
+        return args
+
+    def encode_ogg(self, pcm: bytes, sample_rate: int) -> bytes:
+        """
+        Кодирует PCM s16le моно в ogg: Opus или Vorbis.
+
+        :arg pcm: bytes  PCM 16 бит, моно
+        :arg sample_rate: int  частота выборки PCM
+        :return: bytes  ogg файл в байтах
+        """
+        if self.pyav_encode and self._is_native_rate(sample_rate):
+            return self._encode_pyav(pcm, sample_rate)
+        return self._encode_ffmpeg(pcm, sample_rate)
+
+    def _encode_pyav(self, pcm: bytes, sample_rate: int) -> bytes:
+        """
+        Кодирование через PyAV внутри процесса.
+        """
+        output = io.BytesIO()
+        container = av.open(output, mode="w", format="ogg")
+        if self.audio_codec == "opus":
+            stream = container.add_stream(self.encoder, rate=sample_rate, options={"application": "voip"})
+            stream.bit_rate = self._bitrate(sample_rate)
+        else:
+            stream = container.add_stream(self.encoder, rate=sample_rate)
+        stream.codec_context.layout = "mono"
+
+        samples = np.frombuffer(pcm, dtype=np.int16).reshape(1, -1)
+        frame = av.AudioFrame.from_ndarray(samples, format="s16", layout="mono")
+        frame.sample_rate = sample_rate
+
+        for packet in stream.encode(frame):
+            container.mux(packet)
+        for packet in stream.encode(None):
+            container.mux(packet)
+        container.close()
+        return output.getvalue()
+
+    def _encode_command(self, sample_rate: int) -> list:
+        """
+        Команда ffmpeg для кодирования PCM s16le моно из stdin в ogg в stdout.
+        """
+        return [
+            self.ffmpeg_path,
+            "-loglevel", "quiet",
+            "-f", "s16le",
+            "-ar", str(sample_rate),
+            "-ac", "1",
+            "-i", "pipe:0",          # stdin
+            "-f", "ogg",             # format
+            *self.encode_args(sample_rate),  # codec
+            "pipe:1"                 # stdout
+        ]
+
+    def _encode_ffmpeg(self, pcm: bytes, sample_rate: int) -> bytes:
+        """
+        Кодирование через ffmpeg в отдельном процессе.
+        """
+        proc = subprocess.Popen(
+            self._encode_command(sample_rate),
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE
+        )
+        out_bytes, err = proc.communicate(input=pcm)
+        return out_bytes
+
+    async def encode_ogg_async(self, pcm: bytes, sample_rate: int, timeout: float = None) -> bytes:
+        """
+        Асинхронный вариант encode_ogg.
+
+        :arg pcm: bytes  PCM 16 бит, моно
+        :arg sample_rate: int  частота выборки PCM
+        :arg timeout: float  таймаут в секундах
+        :return: bytes  ogg файл в байтах
+        """
+        if self.pyav_encode and self._is_native_rate(sample_rate):
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(None, self._encode_pyav, pcm, sample_rate)
+        return await run_ffmpeg_async(self._encode_command(sample_rate), pcm, timeout)
+
+    @staticmethod
+    async def _feed_stdin_async(process, audio) -> None:
+        """
+        Передает аудио в stdin ffmpeg и закрывает его в конце.
+        Принимает bytes, файловый объект, итератор или асинхронный итератор bytes.
+        Если источник оборвался, ffmpeg завершается, чтобы он не принял
+        обрыв за конец аудио, а ошибка остается в задаче.
+        """
+        try:
+            if hasattr(audio, "__aiter__"):
+                async for chunk in audio:
+                    process.stdin.write(chunk)
+                    await process.stdin.drain()
+            else:
+                for chunk in Codec.iter_chunks(audio):
+                    process.stdin.write(chunk)
+                    await process.stdin.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            # ffmpeg завершился раньше
+            pass
+        except Exception:
+            try:
+                process.kill()
+            except ProcessLookupError:
+                pass
+            raise
+        finally:
+            process.stdin.close()
+
+    async def decode_async(self, audio, sample_rate: int, chunk_size: int = 4000, timeout: float = None):
+        """
+        Асинхронный вариант decode через ffmpeg.
+        Данные читаются и пишутся без блокировки цикла событий.
+        При отмене или по таймауту процесс ffmpeg завершается.
+
+        :arg audio: путь к файлу, bytes, файловый объект,
+            итератор или асинхронный итератор bytes
+        :arg sample_rate: int  частота выборки PCM
+        :arg chunk_size:  int  размер кусков PCM в байтах
+        :arg timeout:     float  таймаут на все декодирование в секундах
+        :return: async generator[bytes]  куски PCM
+        :raises asyncio.TimeoutError: декодирование не уложилось в timeout
+        :raises Exception: ошибка источника, например обрыв загрузки
+        """
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        is_path = self._is_path(audio)
+
+        process = await asyncio.create_subprocess_exec(
+            *self._decode_command(audio if is_path else "pipe:0", sample_rate),
+            stdin=subprocess.DEVNULL if is_path else subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL
+        )
+        feeder = None
+        if not is_path:
+            feeder = asyncio.ensure_future(self._feed_stdin_async(process, audio))
+        try:
+            while True:
+                remaining = None if deadline is None else max(deadline - loop.time(), 0)
+                try:
+                    # Куски ровного размера, чтобы не разрезать отсчет PCM
+                    data = await asyncio.wait_for(
+                        process.stdout.readexactly(chunk_size), remaining
+                    )
+                except asyncio.IncompleteReadError as error:
+                    data = error.partial
+                if not data:
+                    break
+                yield data
+            await process.wait()
+            if feeder is not None and feeder.done():
+                # Ошибка источника: аудио обрезано, результат не полный
+                feeder.result()
+        finally:
+            if feeder is not None:
+                feeder.cancel()
+                # Задача дожидается, чтобы ее ошибка не потерялась молча
+                await asyncio.gather(feeder, return_exceptions=True)
+            if process.returncode is None:
+                process.kill()
+                await process.wait()
@@ -0,0 +1,469 @@
+# -*- coding: utf8 -*-
+"""
+Асинхронный слой для запуска STT и TTS в пуле потоков, чтобы тяжелые
+вычисления не блокировали цикл событий aiogram.
+
+Модули stt и tts импортируются при первом использовании: импорт torch
+и загрузка моделей не задерживают запуск, а сервер только с STT
+не тратит память на torch.
+"""
+import asyncio
+import contextvars
+import logging
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+
+import metrics
+from cache import TTSCache
+from codec import Codec
+from normalizer import normalize
+
+logger = logging.getLogger(__name__)
+
+# Сколько поток прогрева ждет загрузки моделей в остальных потоках, сек
+WARM_UP_WAIT = 120
+# Сколько готовых частей синтеза ждут кодирования, дальше синтез ждет
+TTS_PARTS_AHEAD = 2
+# Как часто поток синтеза, ждущий места в очереди, проверяет отмену, сек
+PUT_POLL = 0.5
+
+# Значения TTS.default_init, от которых зависит ключ кэша TTS.
+# Они здесь, чтобы ключ считался в цикле событий без импорта torch,
+# и должны совпадать с tts.TTS.default_init
+TTS_KEY_DEFAULTS = {
+    "speaker_voice": "kseniya",
+    "optimize": "none",
+    "sample_rate": 24000,
+}
+
+
+class Inference:
+    """
+    Пул воркеров для распознавания и генерации аудио.
+    Модель Vosk загружается один раз и общая для всех потоков,
+    каждый поток пула держит собственную модель Silero,
+    поэтому N одновременных чатов обрабатываются параллельно.
+    """
+    default_init = {
+        "workers": 2,  # количество потоков в пуле
+        "timeout": None,  # таймаут ffmpeg в секундах, None - без таймаута
+        "use_stt": True,  # распознавание включено
+        "use_tts": True,  # синтез включен
+        "processes": 1,  # процессов с таким пулом на машине, для деления ядер
+    }
+
+    def __init__(self,
+                 workers=None,
+                 stt_kwargs=None,
+                 tts_kwargs=None,
+                 tts_cache: TTSCache = None,
+                 timeout=None,
+                 use_stt=None,
+                 use_tts=None,
+                 processes=None
+                 ) -> None:
+        """
+        Настройка пула воркеров. Модели загружаются при первом
+        использовании или заранее через warm_up.
+
+        :arg workers:    int       количество потоков в пуле
+        :arg stt_kwargs: dict      параметры для создания STT
+        :arg tts_kwargs: dict      параметры для создания TTS
+        :arg tts_cache:  TTSCache  кэш результатов TTS, None - без кэша
+        :arg timeout:    float     таймаут ffmpeg в секундах
+        :arg use_stt:    bool      распознавание включено
+        :arg use_tts:    bool      синтез включен
+        :arg processes:  int       процессов с таким пулом на машине,
+            ядра делятся между всеми, см. TTS.threads_per_worker
+        """
+        self.workers = workers if workers else Inference.default_init["workers"]
+        self.stt_kwargs = stt_kwargs if stt_kwargs else {}
+        self.tts_kwargs = tts_kwargs if tts_kwargs else {}
+        self.tts_cache = tts_cache
+        self.timeout = timeout if timeout else Inference.default_init["timeout"]
+        self.use_stt = use_stt if use_stt is not None else Inference.default_init["use_stt"]
+        self.use_tts = use_tts if use_tts is not None else Inference.default_init["use_tts"]
+        self.processes = processes if processes else Inference.default_init["processes"]
+
+        self._local = threading.local()
+        self._stt = None
+        self._stt_lock = threading.Lock()
+        self._tts_lock = threading.Lock()
+        self._tts_loaded = 0  # сколько потоков пула уже загрузили Silero
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.workers,
+            thread_name_prefix="inference"
+        )
+
+    @property
+    def ready(self) -> bool:
+        """
+        Модели всех включенных режимов загружены, для TTS - во всех
+        потоках пула, поэтому ни один запрос не ждет загрузки.
+        """
+        stt_ready = not self.use_stt or self._stt is not None
+        tts_ready = not self.use_tts or self._tts_loaded >= self.workers
+        return stt_ready and tts_ready
+
+    def _get_stt(self):
+        """
+        Возвращает общий для всех потоков STT, создает его при первом вызове.
+        """
+        if not self.use_stt:
+            raise Exception("Распознавание отключено")
+        with self._stt_lock:
+            if self._stt is None:
+                from stt import STT
+
+                stt_kwargs = {"recognizers": self.workers, **self.stt_kwargs}
+                with metrics.timer("load_stt"):
+                    self._stt = STT(**stt_kwargs)
+        return self._stt
+
+    def _get_tts(self):
+        """
+        Возвращает TTS текущего потока, создает его при первом вызове.
+        """
+        if not self.use_tts:
+            raise Exception("Синтез отключен")
+        tts = getattr(self._local, "tts", None)
+        if tts is None:
+            from tts import TTS
+
+            # Потоки torch делятся между всеми моделями всех процессов
+            threads = TTS.threads_per_worker(
+                self.workers, self.tts_kwargs.get("synth_workers"), self.processes
+            )
+            tts_kwargs = {"threads": threads, **self.tts_kwargs}
+            with metrics.timer("load_tts"):
+                tts = self._local.tts = TTS(**tts_kwargs)
+            with self._tts_lock:
+                self._tts_loaded += 1
+        return tts
+
+    def _warm_up_stt(self) -> None:
+        stt = self._get_stt()
+        # Проверяем, что распознаватель для модели создается
+        stt._release_recognizer(stt._acquire_recognizer())
+
+    def _warm_up_tts(self, barrier: threading.Barrier) -> None:
+        try:
+            self._get_tts()
+        except BaseException:
+            # Остальные потоки не ждут этот и освобождают пул
+            barrier.abort()
+            raise
+        try:
+            # Поток ждет остальных, чтобы каждая модель загрузилась в своем потоке
+            barrier.wait(timeout=WARM_UP_WAIT)
+        except threading.BrokenBarrierError:
+            pass
+
+    async def warm_up(self) -> None:
+        """
+        Загружает модели включенных режимов во всех потоках пула,
+        чтобы первые запросы не ждали загрузки.
+        """
+        jobs = []
+        if self.use_stt:
+            jobs.append(self._run(self._warm_up_stt))
+        if self.use_tts:
+            barrier = threading.Barrier(self.workers)
+            jobs += [self._run(self._warm_up_tts, barrier) for _ in range(self.workers)]
+        await asyncio.gather(*jobs)
+        logger.info("Модели загружены")
+
+    def _audio_to_text(self, audio_file_name, long: bool = False) -> str:
+        if long:
+            return self._get_stt().audio_to_text_parallel(audio_file_name)
+        return self._get_stt().audio_to_text(audio_file_name)
+
+    def _text_to_ogg(self, text: str, out_filename: str = None) -> str:
+        return self._get_tts().text_to_ogg(text, out_filename)
+
+    def _text_to_pcm(self, text: str) -> tuple:
+        tts = self._get_tts()
+        return tts, tts.text_to_pcm(text)
+
+    async def _run(self, func, *args):
+        """
+        Выполняет func в пуле потоков и ждет результат.
+        """
+        loop = asyncio.get_running_loop()
+        # Контекст копируется, чтобы время этапов попало в лог запроса
+        context = contextvars.copy_context()
+        return await loop.run_in_executor(self._executor, context.run, func, *args)
+
+    @staticmethod
+    def _iter_queue(chunks: queue.Queue):
+        """
+        Выдает куски из очереди до None, исключения пробрасывает.
+        """
+        while True:
+            chunk = chunks.get()
+            if chunk is None:
+                return
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield chunk
+
+    def _sync_source(self, audio):
+        """
+        Асинхронный поток кусков bytes превращает в обычный итератор,
+        который можно читать из потока пула. Остальное возвращает как есть.
+
+        :arg audio: путь, bytes, файловый объект или (async) итератор bytes
+        :return: tuple[source, asyncio.Task | None]  источник для STT и
+            задача, которая перекладывает куски в очередь
+        """
+        if not hasattr(audio, "__aiter__"):
+            return audio, None
+
+        chunks = queue.Queue()
+
+        async def pump():
+            try:
+                async for chunk in audio:
+                    chunks.put_nowait(chunk)
+            except Exception as error:
+                chunks.put_nowait(error)
+            finally:
+                chunks.put_nowait(None)
+
+        return self._iter_queue(chunks), asyncio.ensure_future(pump())
+
+    async def audio_to_text(self, audio_file_name, long: bool = False) -> str:
+        """
+        Распознает аудио в текст в пуле потоков.
+
+        :arg audio_file_name: str  путь и имя аудио файла, bytes,
+            файловый объект или асинхронный итератор кусков bytes
+        :arg long: bool  длинное аудио, части распознаются параллельно
+        :return: str  распознанный текст
+        """
+        stt = await self._run(self._get_stt)
+        if not stt.codec.use_pyav and not long:
+            # ffmpeg через asyncio: при отмене запроса процесс завершается
+            return await stt.audio_to_text_async(
+                audio_file_name, self.timeout, self._executor
+            )
+
+        source, pump = self._sync_source(audio_file_name)
+        try:
+            return await self._run(self._audio_to_text, source, long)
+        finally:
+            if pump is not None:
+                pump.cancel()
+
+    async def probe(self, audio_file_name: str) -> dict:
+        """
+        Формат и длительность файла в пуле потоков, см. Codec.probe.
+
+        :arg audio_file_name: str  путь к файлу
+        :return: dict  {"format", "duration", "audio"}
+        """
+        return await self._run(lambda: self._get_stt().codec.probe(audio_file_name))
+
+    async def text_to_ogg(self, text: str, out_filename: str = None) -> str:
+        """
+        Конвертирует текст в файл ogg в пуле потоков.
+
+        :arg text:         str  текст кирилицей
+        :arg out_filename: str  имя выходного файла
+        :return: str  имя выходного файла
+        """
+        return await self._run(self._text_to_ogg, text, out_filename)
+
+    async def run_tts(self, method: str, *args):
+        """
+        Вызывает метод TTS в пуле потоков, например text_to_wav.
+
+        :arg method: str  имя метода TTS
+        :return: результат метода
+        """
+        return await self._run(
+            lambda: getattr(self._get_tts(), method)(*args)
+        )
+
+    async def _text_to_ogg_bytes(self, text: str) -> bytes:
+        """
+        Синтез в пуле потоков, кодирование в ogg через asyncio,
+        чтобы при отмене запроса ffmpeg завершался.
+        """
+        tts, pcm = await self._run(self._text_to_pcm, text)
+        return await tts.pcm_to_ogg_bytes_async(pcm, timeout=self.timeout)
+
+    def tts_cache_key(self, text: str) -> str:
+        """
+        Ключ кэша TTS для текста с учетом голоса и частоты выборки.
+
+        :arg text: str  текст кирилицей
+        :return: str  ключ кэша
+        """
+        speaker_voice = self.tts_kwargs.get("speaker_voice") or TTS_KEY_DEFAULTS["speaker_voice"]
+        optimize = self.tts_kwargs.get("optimize") or TTS_KEY_DEFAULTS["optimize"]
+        if optimize == "int8":
+            # Квантизованная модель звучит немного иначе
+            speaker_voice = f"{speaker_voice}:{optimize}"
+        audio_codec = self.tts_kwargs.get("audio_codec") or Codec.default_init["audio_codec"]
+        bitrate = self.tts_kwargs.get("bitrate") or Codec.default_init["bitrate"]
+        if audio_codec != "vorbis":
+            # Ogg в другом кодеке - другой файл
+            speaker_voice = f"{speaker_voice}:{audio_codec}:{bitrate or 'voice'}"
+        return TTSCache.make_key(
+            normalize(text),
+            speaker_voice,
+            self.tts_kwargs.get("sample_rate") or TTS_KEY_DEFAULTS["sample_rate"],
+        )
+
+    async def text_to_ogg_bytes(self, text: str) -> bytes:
+        """
+        Конвертирует текст в ogg в пуле потоков без временных файлов.
+        Если задан кэш, повторный текст берется из кэша.
+
+        :arg text: str  текст кирилицей
+        :return: bytes  ogg файл в байтах
+        """
+        if self.tts_cache is None:
+            return await self._text_to_ogg_bytes(text)
+
+        key = self.tts_cache_key(text)
+        # Кэш читает и пишет файлы, поэтому не в цикле событий.
+        # Пул по умолчанию, чтобы не ждать занятые моделями потоки
+        loop = asyncio.get_running_loop()
+        ogg_bytes = await loop.run_in_executor(None, self.tts_cache.get, key)
+        metrics.inc(
+            "cache_requests_total",
+            cache="tts", result="miss" if ogg_bytes is None else "hit"
+        )
+        if ogg_bytes is None:
+            ogg_bytes = await self._text_to_ogg_bytes(text)
+            await loop.run_in_executor(None, self.tts_cache.put, key, ogg_bytes)
+        return ogg_bytes
+
+    async def iter_text_to_ogg(self, text: str):
+        """
+        Синтезирует текст по частям и выдает ogg каждой части, как только
+        она готова, см. TTS.iter_text_to_pcm. Пока часть кодируется и
+        отправляется, следующие уже синтезируются, но не больше
+        TTS_PARTS_AHEAD частей вперед.
+
+        :arg text: str  текст кирилицей
+        :return: async generator[bytes]  ogg файлы частей текста
+        """
+        loop = asyncio.get_running_loop()
+        parts = asyncio.Queue(maxsize=TTS_PARTS_AHEAD)
+        done = object()
+        stop = threading.Event()
+
+        def put(item) -> bool:
+            # Поток синтеза ждет, пока часть заберут, но не дольше отмены
+            future = asyncio.run_coroutine_threadsafe(parts.put(item), loop)
+            while True:
+                try:
+                    future.result(timeout=PUT_POLL)
+                    return True
+                except FutureTimeoutError:
+                    if stop.is_set():
+                        future.cancel()
+                        return False
+
+        def produce():
+            # Модель потока, в котором идет синтез, а не того, где ее получили
+            tts = self._get_tts()
+            pcm_parts = tts.iter_text_to_pcm(text)
+            try:
+                for pcm in pcm_parts:
+                    if stop.is_set() or not put((tts, pcm)):
+                        break
+            except Exception as error:
+                put(error)
+            finally:
+                pcm_parts.close()
+                put(done)
+
+        context = contextvars.copy_context()
+        future = loop.run_in_executor(self._executor, context.run, produce)
+        try:
+            while True:
+                part = await parts.get()
+                if part is done:
+                    break
+                if isinstance(part, Exception):
+                    raise part
+                tts, pcm = part
+                yield await tts.pcm_to_ogg_bytes_async(pcm, timeout=self.timeout)
+            await future
+        finally:
+            # Запрос отменен: поток пула перестает синтезировать
+            stop.set()
+
+    async def iter_segments(self, audio_file_name, long: bool = False):
+        """
+        Распознает аудио в пуле потоков и выдает части текста по мере
+        готовности, см. STT.iter_segments.
+
+        :arg audio_file_name: str  путь и имя аудио файла, bytes,
+            файловый объект или асинхронный итератор кусков bytes
+        :arg long: bool  длинное аудио, части распознаются параллельно,
+            см. STT.iter_segments_parallel
+        :return: async generator[dict]  части распознанного текста
+        :raises asyncio.TimeoutError: распознавание не уложилось в timeout
+        """
+        stt = await self._run(self._get_stt)
+        if not stt.codec.use_pyav and not long:
+            # ffmpeg через asyncio: при отмене запроса процесс завершается
+            async for segment in stt.iter_segments_async(
+                audio_file_name, self.timeout, self._executor
+            ):
+                yield segment
+            return
+
+        loop = asyncio.get_running_loop()
+        deadline = None if self.timeout is None else loop.time() + self.timeout
+        segments = asyncio.Queue()
+        done = object()
+        stop = threading.Event()
+        source, pump = self._sync_source(audio_file_name)
+
+        def produce():
+            if long:
+                source_segments = stt.iter_segments_parallel(source, stop)
+            else:
+                source_segments = stt.iter_segments(source, stop)
+            try:
+                for segment in source_segments:
+                    if stop.is_set():
+                        break
+                    loop.call_soon_threadsafe(segments.put_nowait, segment)
+            except Exception as error:
+                loop.call_soon_threadsafe(segments.put_nowait, error)
+            finally:
+                source_segments.close()
+                loop.call_soon_threadsafe(segments.put_nowait, done)
+
+        context = contextvars.copy_context()
+        future = loop.run_in_executor(self._executor, context.run, produce)
+        try:
+            while True:
+                remaining = None if deadline is None else max(deadline - loop.time(), 0)
+                segment = await asyncio.wait_for(segments.get(), remaining)
+                if segment is done:
+                    break
+                if isinstance(segment, Exception):
+                    raise segment
+                yield segment
+            await future
+        finally:
+            # Запрос отменен, упал или не уложился в timeout:
+            # поток пула и распознаватели частей освобождаются
+            stop.set()
+            if pump is not None:
+                pump.cancel()
+
+    def shutdown(self, wait: bool = True) -> None:
+        """
+        Останавливает пул воркеров.
+        """
+        self._executor.shutdown(wait=wait)
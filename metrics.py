@@ -0,0 +1,186 @@
+# -*- coding: utf8 -*-
+"""
+Метрики в формате Prometheus и замер времени этапов обработки.
+
+Время этапов пишется в гистограмму stage_seconds{stage="..."}.
+Если этап выполняется внутри request_log(), его время также
+попадает в структурированную строку лога по этому запросу.
+"""
+import contextvars
+import json
+import logging
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+_lock = threading.Lock()
+_histograms = {}  # stage -> [counts по бакетам, сумма, количество]
+_counters = {}    # (name, labels) -> значение
+_gauges = {}      # name -> (help, функция без аргументов)
+_request = contextvars.ContextVar("request", default=None)
+
+
+def observe(stage: str, seconds: float) -> None:
+    """
+    Записывает время этапа в гистограмму и в лог текущего запроса.
+
+    :arg stage:   str    название этапа, например "stt_inference"
+    :arg seconds: float  время в секундах
+    """
+    with _lock:
+        histogram = _histograms.get(stage)
+        if histogram is None:
+            histogram = _histograms[stage] = [[0] * len(BUCKETS), 0.0, 0]
+        index = bisect_left(BUCKETS, seconds)
+        if index < len(BUCKETS):
+            histogram[0][index] += 1
+        histogram[1] += seconds
+        histogram[2] += 1
+
+    request = _request.get()
+    if request is not None:
+        stages = request["stages"]
+        stages[stage] = round(stages.get(stage, 0) + seconds, 4)
+
+
+@contextmanager
+def timer(stage: str):
+    """
+    Замеряет время блока кода как этап stage.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(stage, time.perf_counter() - start)
+
+
+def inc(name: str, value: float = 1, **labels) -> None:
+    """
+    Увеличивает счетчик.
+
+    :arg name:  str  название счетчика, например "cache_requests_total"
+    :arg value: float  на сколько увеличить
+    :arg labels: метки счетчика
+    """
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def gauge(name: str, func, help_text: str = "") -> None:
+    """
+    Регистрирует показатель, значение которого берется при каждом запросе.
+
+    :arg name: str  название показателя
+    :arg func: функция без аргументов, возвращает число
+    :arg help_text: str  описание
+    """
+    with _lock:
+        _gauges[name] = (help_text, func)
+
+
+@contextmanager
+def request_log(kind: str, **fields):
+    """
+    Собирает время этапов одного запроса и пишет его в лог одной
+    JSON строкой, когда запрос завершен.
+
+    :arg kind: str  тип запроса, например "voice" или "text"
+    :arg fields: дополнительные поля строки лога
+    """
+    request = {"request": kind, **fields, "stages": {}}
+    token = _request.set(request)
+    start = time.perf_counter()
+    try:
+        yield request
+    except BaseException as error:
+        request["error"] = type(error).__name__
+        raise
+    finally:
+        _request.reset(token)
+        request["total"] = round(time.perf_counter() - start, 4)
+        logger.info(json.dumps(request, ensure_ascii=False))
+
+
+def _format_labels(labels) -> str:
+    if not labels:
+        return ""
+    items = ",".join(f'{key}="{value}"' for key, value in labels)
+    return "{" + items + "}"
+
+
+def render() -> str:
+    """
+    Возвращает все метрики в текстовом формате Prometheus.
+    """
+    lines = []
+    with _lock:
+        histograms = {
+            stage: (list(counts), total, count)
+            for stage, (counts, total, count) in _histograms.items()
+        }
+        counters = dict(_counters)
+        gauges = dict(_gauges)
+
+    if histograms:
+        lines.append("# HELP stage_seconds Время этапов обработки")
+        lines.append("# TYPE stage_seconds histogram")
+    for stage, (counts, total, count) in sorted(histograms.items()):
+        cumulative = 0
+        for bucket, bucket_count in zip(BUCKETS, counts):
+            cumulative += bucket_count
+            lines.append(f'stage_seconds_bucket{{stage="{stage}",le="{bucket}"}} {cumulative}')
+        lines.append(f'stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {count}')
+        lines.append(f'stage_seconds_sum{{stage="{stage}"}} {total}')
+        lines.append(f'stage_seconds_count{{stage="{stage}"}} {count}')
+
+    typed = set()
+    for (name, labels), value in sorted(counters.items()):
+        if name not in typed:
+            lines.append(f"# TYPE {name} counter")
+            typed.add(name)
+        lines.append(f"{name}{_format_labels(labels)} {value}")
+
+    for name, (help_text, func) in sorted(gauges.items()):
+        if help_text:
+            lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} gauge")
+        lines.append(f"{name} {func()}")
+
+    return "\n".join(lines) + "\n"
+
+
+async def start_server(host: str = "127.0.0.1", port: int = 9100, ready=None):
+    """
+    Запускает HTTP сервер с метриками по адресу /metrics
+    и проверкой готовности по адресу /ready.
+
+    :arg host:  str  адрес
+    :arg port:  int  порт
+    :arg ready: функция без аргументов, True - сервис готов принимать
+        запросы, None - всегда готов
+    :return: aiohttp.web.AppRunner  для остановки сервера через cleanup()
+    """
+    from aiohttp import web
+
+    async def handle(request):
+        return web.Response(text=render(), content_type="text/plain", charset="utf-8")
+
+    async def handle_ready(request):
+        if ready is None or ready():
+            return web.Response(text="ok")
+        return web.Response(text="loading", status=503)
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    app.router.add_get("/ready", handle_ready)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
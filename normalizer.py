@@ -0,0 +1,257 @@
+# -*- coding: utf8 -*-
+"""
+Нормализация русского текста перед синтезом речи.
+
+Модель Silero читает только кириллицу: цифры, даты, телефоны
+и латиница без нормализации пропадают из речи. Все шаблоны
+собраны в одно заранее скомпилированное регулярное выражение,
+текст обрабатывается за один проход, разворот чисел кэшируется.
+"""
+import re
+from functools import lru_cache
+
+from num2words import num2words
+
+MONTHS = (
+    "января", "февраля", "марта", "апреля", "мая", "июня",
+    "июля", "августа", "сентября", "октября", "ноября", "декабря",
+)
+
+# Названия латинских букв для аббревиатур: USB -> ю эс би
+LETTER_NAMES = {
+    "a": "эй", "b": "би", "c": "си", "d": "ди", "e": "и", "f": "эф", "g": "джи",
+    "h": "эйч", "i": "ай", "j": "джей", "k": "кей", "l": "эл", "m": "эм", "n": "эн",
+    "o": "оу", "p": "пи", "q": "кью", "r": "ар", "s": "эс", "t": "ти", "u": "ю",
+    "v": "ви", "w": "дабл ю", "x": "экс", "y": "уай", "z": "зед",
+}
+
+# Транслитерация латиницы, сочетания букв раньше одиночных
+TRANSLIT = {
+    "shch": "щ", "sch": "ш", "sh": "ш", "ch": "ч", "zh": "ж", "kh": "х", "ts": "ц",
+    "th": "т", "ph": "ф", "ck": "к", "qu": "кв", "oo": "у", "ee": "и",
+    "ya": "я", "yu": "ю", "yo": "ё", "ye": "е",
+    "a": "а", "b": "б", "c": "к", "d": "д", "e": "е", "f": "ф", "g": "г", "h": "х",
+    "i": "и", "j": "дж", "k": "к", "l": "л", "m": "м", "n": "н", "o": "о", "p": "п",
+    "q": "к", "r": "р", "s": "с", "t": "т", "u": "у", "v": "в", "w": "в", "x": "кс",
+    "y": "и", "z": "з",
+}
+TRANSLIT_PATTERN = re.compile("|".join(sorted(TRANSLIT, key=len, reverse=True)))
+
+# Окончание после дефиса у порядкового числительного -> падежная форма
+ORDINAL_ENDINGS = {
+    "й": "", "ый": "", "ий": "", "ой": "",
+    "го": "го", "ого": "го", "его": "го",
+    "му": "му", "ому": "му", "ему": "му",
+    "м": "м", "ом": "м", "ем": "м",
+    "ым": "ым", "им": "ым",
+    "я": "я", "ая": "я", "яя": "я",
+    "ю": "ю", "ую": "ю", "юю": "ю",
+    "е": "е", "ое": "е", "ее": "е", "ые": "е", "ие": "е",
+    "х": "х", "ых": "х", "их": "х",
+    "ыми": "ми", "ими": "ми",
+}
+# Окончания для основы на -ый/-ой и для "третий"
+CASE_ENDINGS = {
+    "го": ("ого", "его"), "му": ("ому", "ему"), "м": ("ом", "ем"), "ым": ("ым", "им"),
+    "я": ("ая", "я"), "ю": ("ую", "ю"), "е": ("ое", "е"), "х": ("ых", "их"),
+    "ми": ("ыми", "ими"),
+}
+
+# "2-х дней" - это количество, а не порядок, в отличие от "90-х"
+GENITIVE = {"2": "двух", "3": "трех", "4": "четырех"}
+
+# "8-ми лет", "5-ти минут" - всегда количество: восьми, пяти
+CARDINAL_ENDINGS = ("ми", "ти")
+# Родительный падеж слов количественного числительного: двадцать восемь -> двадцати восьми
+GENITIVE_WORDS = {
+    "один": "одного", "одна": "одной", "два": "двух", "две": "двух", "три": "трех",
+    "четыре": "четырех", "пять": "пяти", "шесть": "шести", "семь": "семи",
+    "восемь": "восьми", "девять": "девяти", "десять": "десяти",
+    "одиннадцать": "одиннадцати", "двенадцать": "двенадцати", "тринадцать": "тринадцати",
+    "четырнадцать": "четырнадцати", "пятнадцать": "пятнадцати", "шестнадцать": "шестнадцати",
+    "семнадцать": "семнадцати", "восемнадцать": "восемнадцати", "девятнадцать": "девятнадцати",
+    "двадцать": "двадцати", "тридцать": "тридцати", "сорок": "сорока",
+    "пятьдесят": "пятидесяти", "шестьдесят": "шестидесяти", "семьдесят": "семидесяти",
+    "восемьдесят": "восьмидесяти", "девяносто": "девяноста",
+    "сто": "ста", "двести": "двухсот", "триста": "трехсот", "четыреста": "четырехсот",
+    "пятьсот": "пятисот", "шестьсот": "шестисот", "семьсот": "семисот",
+    "восемьсот": "восьмисот", "девятьсот": "девятисот",
+    "тысяча": "тысячи", "тысячи": "тысяч",
+}
+
+SYMBOLS = {"№": "номер ", "&": "и"}
+
+_ordinal_suffix = "|".join(sorted((*ORDINAL_ENDINGS, *CARDINAL_ENDINGS), key=len, reverse=True))
+PATTERN = re.compile(
+    r"(?P<phone>(?<![\w+])(?:\+7|8)[\s\-]?\(?\d{3}\)?[\s\-]?\d{3}[\s\-]?\d{2}[\s\-]?\d{2}(?!\w))"
+    r"|(?P<date>\b(?P<day>\d{1,2})\.(?P<month>\d{1,2})\.(?P<year>\d{4})\b)"
+    r"|(?P<time>\b(?P<hours>[01]?\d|2[0-3]):(?P<minutes>[0-5]\d)\b)"
+    rf"|(?P<ordinal>\b(?P<ordinal_number>\d+)-(?P<ending>{_ordinal_suffix})\b)"
+    r"|(?P<percent>(?P<percent_number>\d+(?:[.,]\d+)?)\s?%)"
+    r"|(?P<decimal>\b(?P<integer>\d+)[.,](?P<fraction>\d+)\b)"
+    r"|(?P<number>\d+)"
+    r"|(?P<latin>[A-Za-z]+(?:'[A-Za-z]+)?)"
+    r"|(?P<symbol>[№&])"
+)
+# Место, где поток текста можно разрезать, не разрывая число или телефон
+BOUNDARY = re.compile(r"[.!?…\n]\s")
+STREAM_LIMIT = 4096  # если границы предложения нет, режем по пробелу после стольких символов
+
+
+@lru_cache(maxsize=4096)
+def cardinal(number: str) -> str:
+    """
+    Количественное числительное. Очень длинные числа читаются по цифрам.
+
+    :arg number: str  цифры
+    :return: str
+    """
+    if len(number) > 15:
+        return digits(number)
+    return num2words(int(number), lang="ru")
+
+
+@lru_cache(maxsize=1024)
+def ordinal(number: str, ending: str = "") -> str:
+    """
+    Порядковое числительное в нужной форме: ("2", "го") -> второго.
+
+    :arg number: str  цифры
+    :arg ending: str  форма из ORDINAL_ENDINGS, "" - именительный мужского рода
+    :return: str
+    """
+    words = num2words(int(number), lang="ru", to="ordinal")
+    if not ending:
+        return words
+    hard, soft = CASE_ENDINGS[ending]
+    if words.endswith("ий"):
+        # третий -> третьего, третья
+        return words[:-2] + "ь" + soft
+    return words[:-2] + hard
+
+
+@lru_cache(maxsize=1024)
+def genitive(number: str) -> str:
+    """
+    Количественное числительное в родительном падеже: 28 -> двадцати восьми.
+    Слова, которых нет в GENITIVE_WORDS (миллион и выше), остаются как есть.
+
+    :arg number: str  цифры
+    :return: str
+    """
+    return " ".join(GENITIVE_WORDS.get(word, word) for word in cardinal(number).split())
+
+
+def digits(number: str) -> str:
+    """
+    Читает число по цифрам: 0042 -> ноль ноль четыре два.
+    """
+    return " ".join(cardinal(digit) for digit in number)
+
+
+def group(number: str) -> str:
+    """
+    Группа цифр телефона или минут: ведущий ноль читается отдельно.
+    """
+    if number.startswith("0") and len(number) > 1:
+        return f"ноль {group(number[1:])}"
+    return cardinal(number)
+
+
+def plural(number: str, one: str, few: str, many: str) -> str:
+    """
+    Форма слова для количества: 1 процент, 2 процента, 5 процентов.
+    """
+    if not number.isdigit():
+        return few
+    value = int(number)
+    if value % 10 == 1 and value % 100 != 11:
+        return one
+    if 2 <= value % 10 <= 4 and not 12 <= value % 100 <= 14:
+        return few
+    return many
+
+
+def decimal(integer: str, fraction: str) -> str:
+    return f"{cardinal(integer)} запятая {group(fraction)}"
+
+
+def latin(word: str) -> str:
+    """
+    Аббревиатуру читает по буквам, остальное транслитерирует.
+    """
+    if word.isupper() and len(word) <= 5:
+        return " ".join(LETTER_NAMES[letter] for letter in word.lower())
+    return TRANSLIT_PATTERN.sub(lambda match: TRANSLIT[match.group(0)], word.lower().replace("'", ""))
+
+
+def _replace(match: re.Match) -> str:
+    kind = match.lastgroup
+    if kind == "number":
+        return cardinal(match.group("number"))
+    if kind == "latin":
+        return latin(match.group("latin"))
+    if kind == "decimal":
+        return decimal(match.group("integer"), match.group("fraction"))
+    if kind == "ordinal":
+        number = match.group("ordinal_number")
+        if match.group("ending") in CARDINAL_ENDINGS:
+            return genitive(number)
+        ending = ORDINAL_ENDINGS[match.group("ending")]
+        if ending == "х" and number in GENITIVE:
+            return GENITIVE[number]
+        return ordinal(number, ending)
+    if kind == "percent":
+        number = match.group("percent_number")
+        integer, _, fraction = number.replace(",", ".").partition(".")
+        words = decimal(integer, fraction) if fraction else cardinal(integer)
+        return f"{words} {plural(number, 'процент', 'процента', 'процентов')}"
+    if kind == "date":
+        day, month = int(match.group("day")), int(match.group("month"))
+        if 1 <= day <= 31 and 1 <= month <= 12:
+            year = ordinal(match.group("year"), "го")
+            return f"{ordinal(str(day), 'е')} {MONTHS[month - 1]} {year} года"
+        return " ".join(cardinal(part) for part in match.group("date").split("."))
+    if kind == "time":
+        return f"{cardinal(match.group('hours'))} {group(match.group('minutes'))}"
+    if kind == "phone":
+        numbers = re.sub(r"\D", "", match.group("phone"))
+        prefix = "плюс семь" if match.group("phone").startswith("+") else "восемь"
+        parts = (numbers[1:4], numbers[4:7], numbers[7:9], numbers[9:11])
+        return " ".join((prefix, *(group(part) for part in parts)))
+    return SYMBOLS[match.group("symbol")]
+
+
+def normalize(text: str) -> str:
+    """
+    Заменяет числа, даты, время, телефоны, проценты и латиницу словами.
+
+    :arg text: str  текст
+    :return: str  текст, который модель прочитает целиком
+    """
+    return PATTERN.sub(_replace, text)
+
+
+def iter_normalized(chunks):
+    """
+    Нормализует поток кусков текста. Кусок режется по границе
+    предложения, чтобы число или телефон не попали в два куска.
+
+    :arg chunks: iterator[str]  куски текста
+    :return: generator[str]  нормализованные куски
+    """
+    rest = ""
+    for chunk in chunks:
+        text = rest + chunk
+        boundaries = list(BOUNDARY.finditer(text))
+        if boundaries:
+            cut = boundaries[-1].end()
+        elif len(text) > STREAM_LIMIT and " " in text:
+            cut = text.rindex(" ") + 1
+        else:
+            rest = text
+            continue
+        rest = text[cut:]
+        yield normalize(text[:cut])
+    if rest:
+        yield normalize(rest)
@@ -0,0 +1,202 @@
+# -*- coding: utf8 -*-
+"""
+Очередь задач между хэндлерами бота и STT/TTS
+"""
+import asyncio
+import contextvars
+import heapq
+import itertools
+from collections import OrderedDict
+
+
+class QueueFull(Exception):
+    """
+    Очередь заполнена, задача не принята.
+    """
+
+
+class Scheduler:
+    """
+    Ограниченная очередь задач с приоритетами.
+    Одновременно выполняется не больше workers задач и не больше
+    per_user задач одного пользователя. Свободный слот получает задача
+    с наименьшим приоритетом, среди равных - по очереди между пользователями,
+    поэтому пачка файлов от одного пользователя не задерживает остальных.
+    """
+    default_init = {
+        "workers": 2,      # количество одновременно выполняемых задач
+        "max_queue": 100,  # максимальное количество задач в ожидании
+        "per_user": 1,     # количество одновременных задач одного пользователя
+    }
+
+    def __init__(self, workers=None, max_queue=None, per_user=None) -> None:
+        """
+        Настройка очереди.
+
+        :arg workers:   int  количество одновременно выполняемых задач
+        :arg max_queue: int  максимальное количество задач в ожидании
+        :arg per_user:  int  количество одновременных задач одного пользователя
+        """
+        self.workers = workers if workers else Scheduler.default_init["workers"]
+        self.max_queue = max_queue if max_queue else Scheduler.default_init["max_queue"]
+        self.per_user = per_user if per_user else Scheduler.default_init["per_user"]
+
+        self._queues = OrderedDict()  # user_id -> куча задач, порядок для round-robin
+        self._running = {}            # user_id -> количество выполняемых задач
+        self._in_flight = 0
+        self._pending = 0
+        self._counter = itertools.count()
+
+    @property
+    def pending(self) -> int:
+        """
+        Количество задач в ожидании.
+        """
+        return self._pending
+
+    @property
+    def in_flight(self) -> int:
+        """
+        Количество выполняемых задач.
+        """
+        return self._in_flight
+
+    def _next_job(self):
+        """
+        Выбирает следующую задачу или None, если запускать нечего.
+        """
+        if self._in_flight >= self.workers:
+            return None
+
+        best_user = None
+        for user_id, jobs in self._queues.items():
+            if self._running.get(user_id, 0) >= self.per_user:
+                continue
+            if best_user is None or jobs[0][0] < self._queues[best_user][0][0]:
+                best_user = user_id
+        if best_user is None:
+            return None
+
+        jobs = self._queues.pop(best_user)
+        job = heapq.heappop(jobs)
+        if jobs:
+            # Пользователь уходит в конец очереди round-robin
+            self._queues[best_user] = jobs
+        self._pending -= 1
+        return best_user, job
+
+    def _position(self, job) -> int:
+        """
+        Место задачи в порядке, в котором ее выбрал бы _next_job:
+        по приоритету, среди равных - по очереди между пользователями.
+        Считается, что слоты освобождаются для всех пользователей,
+        поэтому это оценка, а не обещание.
+
+        :return: int  позиция с 1, 0 - задачи нет в очереди
+        """
+        queues = OrderedDict(
+            (user_id, sorted(jobs)) for user_id, jobs in self._queues.items()
+        )
+        position = 0
+        while queues:
+            best_user = None
+            for user_id, jobs in queues.items():
+                if best_user is None or jobs[0][0] < queues[best_user][0][0]:
+                    best_user = user_id
+            jobs = queues.pop(best_user)
+            position += 1
+            if jobs.pop(0) is job:
+                return position
+            if jobs:
+                queues[best_user] = jobs
+        return 0
+
+    def _dispatch(self) -> None:
+        """
+        Запускает задачи, пока есть свободные слоты.
+        """
+        while True:
+            selected = self._next_job()
+            if selected is None:
+                return
+            user_id, (_, _, future, factory, context) = selected
+            self._in_flight += 1
+            self._running[user_id] = self._running.get(user_id, 0) + 1
+            # Задача выполняется в контексте того, кто ее поставил
+            context.run(asyncio.ensure_future, self._run(user_id, future, factory))
+
+    async def _run(self, user_id, future: asyncio.Future, factory) -> None:
+        """
+        Выполняет задачу и передает результат в future.
+        """
+        try:
+            if not future.cancelled():
+                task = asyncio.ensure_future(factory())
+                # Отмена ожидающего отменяет и саму задачу
+                future.add_done_callback(
+                    lambda _: task.cancel() if future.cancelled() else None
+                )
+                try:
+                    result = await task
+                except asyncio.CancelledError:
+                    future.cancel()
+                except Exception as error:
+                    if not future.done():
+                        future.set_exception(error)
+                else:
+                    if not future.done():
+                        future.set_result(result)
+        finally:
+            self._in_flight -= 1
+            self._running[user_id] -= 1
+            if not self._running[user_id]:
+                del self._running[user_id]
+            self._dispatch()
+
+    def _remove(self, user_id, future: asyncio.Future) -> None:
+        """
+        Убирает из очереди задачу, которая еще не запущена.
+        """
+        jobs = self._queues.get(user_id)
+        if not jobs:
+            return
+        for index, job in enumerate(jobs):
+            if job[2] is future:
+                jobs.pop(index)
+                heapq.heapify(jobs)
+                self._pending -= 1
+                break
+        if not jobs:
+            del self._queues[user_id]
+
+    async def submit(self, user_id, factory, priority: int = 0, on_queued=None):
+        """
+        Ставит задачу в очередь и ждет ее результат.
+
+        :arg user_id:   int  пользователь или чат, которому принадлежит задача
+        :arg factory:   функция без аргументов, возвращающая корутину задачи
+        :arg priority:  int  приоритет, меньше - раньше
+        :arg on_queued: корутина-функция, вызывается с позицией в очереди,
+            если задача не запустилась сразу
+        :return: результат корутины задачи
+        :raises QueueFull: очередь заполнена
+        """
+        if self._pending >= self.max_queue:
+            raise QueueFull("Очередь заполнена, попробуйте позже")
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        job = (priority, next(self._counter), future, factory, contextvars.copy_context())
+        heapq.heappush(self._queues.setdefault(user_id, []), job)
+        self._pending += 1
+        self._dispatch()
+
+        started = job not in self._queues.get(user_id, [])
+        try:
+            if not started and on_queued is not None:
+                await on_queued(self._position(job))
+            return await future
+        except asyncio.CancelledError:
+            self._remove(user_id, future)
+            future.cancel()
+            raise
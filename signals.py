@@ -0,0 +1,35 @@
+# -*- coding: utf8 -*-
+"""
+Обработка сигналов остановки в процессах бота и пакетной обработки.
+
+Модуль не зависит от aiogram и моделей, поэтому его импортирует
+и офлайн batch.py.
+"""
+import signal
+
+
+def ignore_interrupt(terminate: bool = False) -> None:
+    """
+    Дочерний процесс не реагирует на Ctrl+C: остановкой управляет
+    главный процесс (у бота - фронт через WorkerPool.drain()).
+
+    :arg terminate: bool  игнорировать и SIGTERM: systemd и docker
+        присылают его всем процессам сразу, а воркер должен доработать
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if terminate:
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+
+def exit_on_terminate() -> None:
+    """
+    Фронт завершается по SIGTERM так же, как по Ctrl+C: через SystemExit,
+    который executor aiogram перехватывает и вызывает on_shutdown,
+    поэтому воркеры останавливаются через drain().
+    """
+    def handler(signum, frame):
+        # Повторный SIGTERM не прерывает drain()
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        raise SystemExit(0)
+
+    signal.signal(signal.SIGTERM, handler)
@@ -2,13 +2,24 @@
 """
 Конвертация wav/ogg -> текст
 """
+import asyncio
+import contextvars
 import json
 import os
-import subprocess
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime
 
 from vosk import KaldiRecognizer, Model  # оффлайн-распознавание от Vosk
 
+import metrics
+from codec import Codec
+from transcript import to_segment
+from vad import VAD, Timeline
+
 
 class STT:
     """
@@ -17,32 +28,89 @@ class STT:
     """
     default_init = {
         "model_path": "models/vosk/model",  # путь к папке с файлами STT модели Vosk
-        "sample_rate": 16000,
-        "ffmpeg_path": "models/vosk"  # путь к ffmpeg
+        "sample_rate": 16000,  # если в модели не указана своя частота
+        "ffmpeg_path": "models/vosk",  # путь к ffmpeg
+        "recognizers": 4,  # максимальное количество одновременных распознаваний
+        "codec": "auto",  # декодирование: "auto" - PyAV если установлен, "pyav", "ffmpeg"
+        "parallel": 4,  # сколько частей длинного аудио распознается одновременно
+        "part_seconds": 30,  # примерная длина части длинного аудио
+        "max_phrase_seconds": 30,  # фраза без паузы длиннее завершается принудительно
     }
 
     def __init__(self,
                  model_path=None,
                  sample_rate=None,
-                 ffmpeg_path=None
+                 ffmpeg_path=None,
+                 recognizers=None,
+                 codec=None,
+                 vad=None,
+                 parallel=None,
+                 part_seconds=None,
+                 max_phrase_seconds=None
                  ) -> None:
         """
         Настройка модели Vosk для распознования аудио и
         преобразования его в текст.
 
+        Модель загружается один раз и используется всеми распознавателями.
+        Для каждого запроса создается новый распознаватель: он дешевле
+        модели, а время слов в переиспользованном после Reset()
+        распознавателе продолжает расти. audio_to_text можно вызывать
+        из нескольких потоков.
+
         :arg model_path:  str  путь до модели Vosk
-        :arg sample_rate: int  частота выборки, обычно 16000
+        :arg sample_rate: int  частота выборки, None - частота модели,
+            аудио сразу декодируется в нее и Vosk не пересчитывает его
         :arg ffmpeg_path: str  путь к ffmpeg
+        :arg recognizers: int  максимальное количество распознавателей
+        :arg codec:       str  декодирование: "auto", "pyav" или "ffmpeg"
+        :arg vad:         VAD  вырезать паузы перед распознаванием, None - без VAD
+        :arg parallel:     int  сколько частей длинного аудио распознается одновременно
+        :arg part_seconds: int  примерная длина части длинного аудио в секундах
+        :arg max_phrase_seconds: int  фраза без паузы длиннее завершается
+            принудительно, чтобы память Vosk не росла с длиной аудио
         """
         self.model_path = model_path if model_path else STT.default_init["model_path"]
-        self.sample_rate = sample_rate if sample_rate else STT.default_init["sample_rate"]
+        self.sample_rate = sample_rate if sample_rate else self._model_sample_rate()
         self.ffmpeg_path = ffmpeg_path if ffmpeg_path else STT.default_init["ffmpeg_path"]
+        self.recognizers = recognizers if recognizers else STT.default_init["recognizers"]
+        codec = codec if codec else STT.default_init["codec"]
+        self.vad = vad
+        self.parallel = parallel if parallel else STT.default_init["parallel"]
+        self.part_seconds = part_seconds if part_seconds else STT.default_init["part_seconds"]
+        self.max_phrase_seconds = (
+            max_phrase_seconds if max_phrase_seconds else STT.default_init["max_phrase_seconds"]
+        )
 
         self._check_model()
+        self.codec = Codec(self.ffmpeg_path, backend=codec)
+        if self.vad is not None and self.vad.sample_rate != self.sample_rate:
+            # VAD создается до загрузки модели и не знает ее частоту
+            self.vad = VAD(
+                sample_rate=self.sample_rate,
+                frame_ms=self.vad.frame_ms,
+                threshold_db=self.vad.threshold_db,
+                min_silence_ms=self.vad.min_silence_ms,
+                padding_ms=self.vad.padding_ms
+            )
+
+        self.model = Model(self.model_path)
+        self._recognizers_limit = threading.BoundedSemaphore(self.recognizers)
+        self._parts_executor = None
+        self._parts_lock = threading.Lock()
 
-        model = Model(self.model_path)
-        self.recognizer = KaldiRecognizer(model, self.sample_rate)
-        self.recognizer.SetWords(True)
+    def _model_sample_rate(self) -> int:
+        """
+        Частота, на которой обучена модель Vosk, из conf/mfcc.conf.
+        """
+        conf_path = os.path.join(self.model_path, "conf", "mfcc.conf")
+        if os.path.exists(conf_path):
+            with open(conf_path, "rt") as file:
+                for line in file:
+                    name, _, value = line.partition("=")
+                    if name.strip() == "--sample-frequency" and value.split():
+                        return int(float(value.split()[0]))
+        return STT.default_init["sample_rate"]
 
     def _check_model(self):
         """
@@ -66,42 +134,396 @@ class STT:
                             )
         self.ffmpeg_path = self.ffmpeg_path + '/ffmpeg'
 
-    def audio_to_text(self, audio_file_name=None) -> str:
+    def _create_recognizer(self) -> KaldiRecognizer:
         """
-        Offline-распознавание аудио в текст через Vosk
-        :param audio_file_name: str путь и имя аудио файла
-        :return: str распознанный текст
+        Создает новый распознаватель для общей модели Vosk
+        """
+        recognizer = KaldiRecognizer(self.model, self.sample_rate)
+        recognizer.SetWords(True)
+        return recognizer
+
+    def _acquire_recognizer(self) -> KaldiRecognizer:
+        """
+        Создает новый распознаватель для одного запроса.
+        Если распознавателей уже recognizers, ждет освобождения одного из них.
+        """
+        self._recognizers_limit.acquire()
+        try:
+            return self._create_recognizer()
+        except BaseException:
+            self._recognizers_limit.release()
+            raise
+
+    def _release_recognizer(self, recognizer: KaldiRecognizer) -> None:
+        """
+        Освобождает место распознавателя.
+        Распознаватель не переиспользуется: Reset() не обнуляет
+        счетчик сэмплов Vosk, и время слов следующего запроса
+        сдвинулось бы на все аудио предыдущих.
+        """
+        self._recognizers_limit.release()
+
+    @contextmanager
+    def _recognizer(self):
+        """
+        Выдает новый распознаватель на время блока.
+        """
+        recognizer = self._acquire_recognizer()
+        try:
+            yield recognizer
+        finally:
+            self._release_recognizer(recognizer)
+
+    def _speech_stream(self):
+        """
+        Поток VAD для одного аудио или None, если VAD выключен.
+        """
+        if self.vad is None:
+            return None
+        if self.vad.sample_rate != self.sample_rate:
+            raise Exception("VAD: частота выборки должна совпадать с STT")
+        return self.vad.stream()
+
+    @staticmethod
+    def _speech_pieces(speech, timeline: Timeline, data: bytes) -> list:
+        """
+        Куски PCM для распознавателя со смещением в исходном аудио.
+        Без VAD - весь кусок сразу после предыдущего.
+        """
+        if speech is None:
+            return [(timeline.fed, data)] if data else []
+        return speech.push(data) if data else speech.flush()
+
+    def _accept(self, recognizer: KaldiRecognizer, timeline: Timeline, pieces: list) -> list:
+        """
+        Передает куски PCM распознавателю.
+        На вырезанной паузе и на фразе длиннее max_phrase_seconds
+        фраза завершается принудительно: декодер Vosk держит в памяти
+        всю текущую фразу, и без паузы она росла бы до конца файла.
+
+        :return: list[dict]  законченные фразы со временем исходного аудио
+        """
+        max_phrase = self.max_phrase_seconds * self.sample_rate
+        segments = []
+        for offset, data in pieces:
+            samples = len(data) // 2
+            if timeline.add(offset, samples):
+                segments.append(json.loads(recognizer.FinalResult()))
+                timeline.phrase_start = timeline.fed - samples
+            if recognizer.AcceptWaveform(data):
+                segments.append(json.loads(recognizer.Result()))
+                timeline.phrase_start = timeline.fed
+            elif timeline.fed - timeline.phrase_start >= max_phrase:
+                segments.append(json.loads(recognizer.FinalResult()))
+                timeline.phrase_start = timeline.fed
+                metrics.inc("stt_forced_results_total")
+        return [timeline.remap(segment) for segment in segments if segment.get("text")]
+
+    @staticmethod
+    def _final_result(recognizer: KaldiRecognizer, timeline: Timeline) -> dict:
+        """
+        Завершает последнюю фразу и переводит ее время в исходное аудио.
+        """
+        return timeline.remap(json.loads(recognizer.FinalResult()))
+
+    def iter_segments(self, audio_file_name=None, stop: threading.Event = None):
+        """
+        Offline-распознавание аудио через Vosk с выдачей результата по частям.
+        Каждая часть выдается, как только Vosk закончил фразу,
+        не дожидаясь конца файла.
+
+        :param audio_file_name: str путь и имя аудио файла, либо аудио
+            в памяти: bytes, файловый объект или итератор кусков bytes
+        :param stop: threading.Event  распознавание прекращается,
+            когда событие установлено, None - до конца файла
+        :return: generator[dict] части вида
+            {"text": str, "result": [{"word", "start", "end", "conf"}, ...]}
+        """
+        if audio_file_name is None:
+            raise Exception("Укажите путь и имя файла")
+        is_path = isinstance(audio_file_name, (str, os.PathLike))
+        if is_path and not os.path.exists(audio_file_name):
+            raise Exception("Укажите правильный путь и имя файла")
+
+        with self._recognizer() as recognizer:
+            # Декодирование аудио в PCM, у нас wav
+            pcm_chunks = self.codec.decode(audio_file_name, self.sample_rate)
+            speech = self._speech_stream()
+            timeline = Timeline(self.sample_rate)
+            decode_time = 0.0
+            vad_time = 0.0
+            inference_time = 0.0
+            try:
+                # Чтение данных кусками и распознование через модель
+                while True:
+                    if stop is not None and stop.is_set():
+                        return
+                    start = time.perf_counter()
+                    data = next(pcm_chunks, b"")
+                    decode_time += time.perf_counter() - start
+                    start = time.perf_counter()
+                    pieces = self._speech_pieces(speech, timeline, data)
+                    vad_time += time.perf_counter() - start
+                    start = time.perf_counter()
+                    # Фразы закончены, отдаем их сразу
+                    segments = self._accept(recognizer, timeline, pieces)
+                    inference_time += time.perf_counter() - start
+                    yield from segments
+                    if len(data) == 0:
+                        break
+
+                start = time.perf_counter()
+                segment = timeline.remap(json.loads(recognizer.FinalResult()))
+                inference_time += time.perf_counter() - start
+                if segment.get("text"):
+                    yield segment
+            finally:
+                # Распознавание прервано, декодер больше не нужен
+                pcm_chunks.close()
+                # Время декодирования и время Vosk за весь файл
+                metrics.observe("stt_decode", decode_time)
+                metrics.observe("stt_inference", inference_time)
+                self._observe_vad(speech, vad_time)
+
+    def _observe_vad(self, speech, vad_time: float) -> None:
+        if speech is None:
+            return
+        metrics.observe("stt_vad", vad_time)
+        metrics.inc("vad_skipped_seconds_total", speech.skipped_samples / self.sample_rate)
+
+    async def iter_segments_async(self, audio, timeout: float = None, executor=None):
+        """
+        Асинхронный вариант iter_segments: ffmpeg запускается через
+        asyncio, распознавание выполняется в executor. При отмене задачи
+        или по таймауту ffmpeg завершается.
+
+        :arg audio: путь к файлу, bytes, файловый объект,
+            итератор или асинхронный итератор кусков bytes
+        :arg timeout:  float  таймаут на распознавание в секундах
+        :arg executor: пул потоков для Vosk, None - пул по умолчанию
+        :return: async generator[dict]  части распознанного текста
+        :raises asyncio.TimeoutError: распознавание не уложилось в timeout
+        """
+        if audio is None:
+            raise Exception("Укажите путь и имя файла")
+        is_path = isinstance(audio, (str, os.PathLike))
+        if is_path and not os.path.exists(audio):
+            raise Exception("Укажите правильный путь и имя файла")
+
+        speech = self._speech_stream()
+        loop = asyncio.get_running_loop()
+        recognizer = await loop.run_in_executor(executor, self._acquire_recognizer)
+        # Vosk вызывается реже, кусками примерно по секунде аудио
+        pcm_chunks = self.codec.decode_async(
+            audio, self.sample_rate, chunk_size=self.sample_rate * 2, timeout=timeout
+        )
+        timeline = Timeline(self.sample_rate)
+        vad_time = 0.0
+        inference_time = 0.0
+        pending = None
+        try:
+            while True:
+                try:
+                    data = await pcm_chunks.__anext__()
+                except StopAsyncIteration:
+                    data = b""
+                start = time.perf_counter()
+                pieces = self._speech_pieces(speech, timeline, data)
+                vad_time += time.perf_counter() - start
+                start = time.perf_counter()
+                pending = loop.run_in_executor(
+                    executor, self._accept, recognizer, timeline, pieces
+                )
+                segments = await asyncio.shield(pending)
+                inference_time += time.perf_counter() - start
+                for segment in segments:
+                    yield segment
+                if len(data) == 0:
+                    break
+
+            # Последняя фраза может декодироваться долго, тоже в executor
+            pending = loop.run_in_executor(executor, self._final_result, recognizer, timeline)
+            segment = await asyncio.shield(pending)
+            if segment.get("text"):
+                yield segment
+        finally:
+            await pcm_chunks.aclose()
+            # При отмене Vosk еще может работать в потоке,
+            # распознаватель освобождается только после него
+            if pending is not None and not pending.done():
+                await asyncio.wait([pending])
+            release = loop.run_in_executor(executor, self._release_recognizer, recognizer)
+            await asyncio.wait([release])
+            metrics.observe("stt_inference", inference_time)
+            self._observe_vad(speech, vad_time)
+
+    async def audio_to_text_async(self, audio, timeout: float = None, executor=None) -> str:
+        """
+        Асинхронный вариант audio_to_text, см. iter_segments_async.
+
+        :arg audio: путь к файлу, bytes, файловый объект,
+            итератор или асинхронный итератор кусков bytes
+        :arg timeout:  float  таймаут на распознавание в секундах
+        :arg executor: пул потоков для Vosk, None - пул по умолчанию
+        :return: str  распознанный текст
+        """
+        with metrics.timer("stt_total"):
+            texts = [
+                segment["text"]
+                async for segment in self.iter_segments_async(audio, timeout, executor)
+            ]
+        return " ".join(texts)
+
+    def _get_parts_executor(self) -> ThreadPoolExecutor:
+        """
+        Пул потоков для частей длинного аудио, создается при первом вызове.
+        """
+        with self._parts_lock:
+            if self._parts_executor is None:
+                self._parts_executor = ThreadPoolExecutor(
+                    max_workers=self.parallel,
+                    thread_name_prefix="stt-part"
+                )
+        return self._parts_executor
+
+    def _split_parts(self, pcm_chunks):
+        """
+        Режет PCM на части примерно по part_seconds. Разрез делается
+        в самом тихом месте около границы, чтобы не разрезать слово.
+
+        :arg pcm_chunks: iterator[bytes]  PCM s16le моно
+        :return: generator[(int, bytes)]  (смещение в сэмплах, PCM части)
+        """
+        splitter = self.vad if self.vad is not None else VAD(sample_rate=self.sample_rate)
+        part = self.part_seconds * self.sample_rate * 2
+        # Место разреза ищется в пределах 1/6 длины части с каждой стороны
+        search = part // 12 * 2
+        buffer = bytearray()
+        offset = 0
+        for chunk in pcm_chunks:
+            buffer += chunk
+            while len(buffer) >= part + search:
+                window = bytes(buffer[part - search:part + search])
+                cut = part - search + splitter.quietest_point(window) * 2
+                yield offset, bytes(buffer[:cut])
+                offset += cut // 2
+                del buffer[:cut]
+        if buffer:
+            yield offset, bytes(buffer)
+
+    def _transcribe_part(self, offset: int, pcm: bytes, stop: threading.Event = None) -> list:
+        """
+        Распознает одну часть длинного аудио отдельным распознавателем.
+
+        :arg offset: int    смещение части в исходном аудио в сэмплах
+        :arg pcm:    bytes  PCM s16le моно
+        :arg stop:   threading.Event  прекратить распознавание части
+        :return: list[dict]  фразы со временем исходного аудио
+        """
+        speech = self._speech_stream()
+        timeline = Timeline(self.sample_rate)
+        step = self.sample_rate * 2
+        segments = []
+        with metrics.timer("stt_part"), self._recognizer() as recognizer:
+            for start in range(0, len(pcm) + step, step):
+                if stop is not None and stop.is_set():
+                    return segments
+                data = pcm[start:start + step]
+                if speech is None:
+                    pieces = [(offset + start // 2, data)] if data else []
+                else:
+                    pieces = speech.push(data) if data else speech.flush()
+                    pieces = [(offset + piece_offset, piece) for piece_offset, piece in pieces]
+                segments += self._accept(recognizer, timeline, pieces)
+            if not timeline.fed:
+                return segments
+            segment = timeline.remap(json.loads(recognizer.FinalResult()))
+            if segment.get("text"):
+                segments.append(segment)
+        if speech is not None:
+            metrics.inc("vad_skipped_seconds_total", speech.skipped_samples / self.sample_rate)
+        return segments
+
+    def iter_segments_parallel(self, audio_file_name=None, stop: threading.Event = None):
+        """
+        Распознавание длинного аудио: PCM режется по паузам на части,
+        части распознаются одновременно распознавателями с общей моделью,
+        фразы выдаются по порядку со временем исходного аудио.
+
+        :param audio_file_name: str путь и имя аудио файла, либо аудио
+            в памяти: bytes, файловый объект или итератор кусков bytes
+        :param stop: threading.Event  распознавание прекращается, когда
+            событие установлено: новые части не ставятся, ждущие отменяются
+        :return: generator[dict] части вида
+            {"text": str, "result": [{"word", "start", "end", "conf"}, ...]}
         """
         if audio_file_name is None:
             raise Exception("Укажите путь и имя файла")
-        if not os.path.exists(audio_file_name):
+        is_path = isinstance(audio_file_name, (str, os.PathLike))
+        if is_path and not os.path.exists(audio_file_name):
             raise Exception("Укажите правильный путь и имя файла")
 
-        # Конвертация аудио в wav и результат в process.stdout
-        process = subprocess.Popen(
-            [self.ffmpeg_path,
-             "-loglevel", "quiet",
-             "-i", audio_file_name,          # имя входного файла
-             "-ar", str(self.sample_rate),   # частота выборки
-             "-ac", "1",                     # кол-во каналов
-             "-f", "s16le",                  # кодек для перекодирования, у нас wav
-             "-"                             # имя выходного файла нет, тк читаем из stdout
-             ],
-            stdout=subprocess.PIPE
-                                   )
-
-        # Чтение данных кусками и распознование через модель
-        while True:
-            data = process.stdout.read(4000)
-            if len(data) == 0:
-                break
-            if self.recognizer.AcceptWaveform(data):
-                pass
-
-        # Возвращаем распознанный текст в виде str
-        result_json = self.recognizer.FinalResult()  # это json в виде str
-        result_dict = json.loads(result_json)    # это dict
-        return result_dict["text"]               # текст в виде str
+        executor = self._get_parts_executor()
+        pcm_chunks = self.codec.decode(audio_file_name, self.sample_rate)
+        futures = deque()
+        try:
+            for offset, pcm in self._split_parts(pcm_chunks):
+                if stop is not None and stop.is_set():
+                    return
+                # Контекст копируется, чтобы время попало в лог текущего запроса
+                futures.append(executor.submit(
+                    contextvars.copy_context().run, self._transcribe_part, offset, pcm, stop
+                ))
+                # Готовые части выдаем сразу, в памяти не больше двух частей на поток
+                while futures and (futures[0].done() or len(futures) >= self.parallel * 2):
+                    yield from futures.popleft().result()
+            while futures:
+                if stop is not None and stop.is_set():
+                    return
+                yield from futures.popleft().result()
+        finally:
+            for future in futures:
+                future.cancel()
+            pcm_chunks.close()
+
+    def audio_to_text_parallel(self, audio_file_name=None) -> str:
+        """
+        Распознавание длинного аудио в текст, см. iter_segments_parallel.
+
+        :param audio_file_name: str путь и имя аудио файла, либо аудио
+            в памяти: bytes, файловый объект или итератор кусков bytes
+        :return: str распознанный текст
+        """
+        with metrics.timer("stt_total"):
+            segments = self.iter_segments_parallel(audio_file_name)
+            return " ".join(segment["text"] for segment in segments)
+
+    def transcribe(self, audio_file_name=None, long: bool = False) -> list:
+        """
+        Распознавание аудио с временем и уверенностью каждого слова.
+
+        :param audio_file_name: str путь и имя аудио файла, либо аудио
+            в памяти: bytes, файловый объект или итератор кусков bytes
+        :param long: bool  длинное аудио, см. iter_segments_parallel
+        :return: list[dict]  фразы вида {"start", "end", "text", "words"},
+            см. transcript.to_segment
+        """
+        if long:
+            segments = self.iter_segments_parallel(audio_file_name)
+        else:
+            segments = self.iter_segments(audio_file_name)
+        return [to_segment(segment) for segment in segments]
+
+    def audio_to_text(self, audio_file_name=None) -> str:
+        """
+        Offline-распознавание аудио в текст через Vosk
+        :param audio_file_name: str путь и имя аудио файла, либо аудио
+            в памяти: bytes, файловый объект или итератор кусков bytes
+        :return: str распознанный текст
+        """
+        with metrics.timer("stt_total"):
+            segments = self.iter_segments(audio_file_name)
+            return " ".join(segment["text"] for segment in segments)
 
 
 if __name__ == "__main__":
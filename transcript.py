@@ -0,0 +1,204 @@
+# -*- coding: utf8 -*-
+"""
+Распознанный текст с временем слов и его вывод в форматах
+text, SRT, VTT и JSON.
+
+Фразы записываются в файл по мере распознавания, поэтому память
+не растет с длиной аудио.
+"""
+import io
+import json
+import tempfile
+from datetime import timedelta
+
+import srt
+
+
+def to_segment(result: dict) -> dict:
+    """
+    Фраза Vosk в виде
+    {"start", "end", "text", "words": [{"word", "start", "end", "conf"}, ...]}.
+
+    :arg result: dict  результат Vosk с SetWords(True)
+    :return: dict
+    """
+    words = [
+        {
+            "word": word["word"],
+            "start": word["start"],
+            "end": word["end"],
+            "conf": word.get("conf"),
+        }
+        for word in result.get("result", [])
+    ]
+    return {
+        "start": words[0]["start"] if words else None,
+        "end": words[-1]["end"] if words else None,
+        "text": result.get("text", ""),
+        "words": words,
+    }
+
+
+def iter_cues(segment: dict, max_chars: int = 84, max_seconds: float = 7.0):
+    """
+    Делит фразу на субтитры не длиннее max_chars символов и max_seconds секунд.
+
+    :arg segment: dict  фраза, см. to_segment
+    :return: generator[(float, float, str)]  начало, конец и текст субтитра
+    """
+    cue = []
+    for word in segment["words"]:
+        if cue:
+            text = " ".join(item["word"] for item in cue + [word])
+            if len(text) > max_chars or word["end"] - cue[0]["start"] > max_seconds:
+                yield cue[0]["start"], cue[-1]["end"], " ".join(item["word"] for item in cue)
+                cue = []
+        cue.append(word)
+    if cue:
+        yield cue[0]["start"], cue[-1]["end"], " ".join(item["word"] for item in cue)
+
+
+class TextWriter:
+    """
+    Обычный текст, фраза на строку.
+    """
+    extension = "txt"
+
+    def __init__(self, stream) -> None:
+        self.stream = stream
+
+    def write(self, segment: dict) -> None:
+        self.stream.write(segment["text"] + "\n")
+
+    def close(self) -> None:
+        pass
+
+
+class SRTWriter(TextWriter):
+    """
+    Субтитры SRT.
+    """
+    extension = "srt"
+
+    def __init__(self, stream) -> None:
+        super().__init__(stream)
+        self.index = 0
+
+    def write(self, segment: dict) -> None:
+        for start, end, text in iter_cues(segment):
+            self.index += 1
+            subtitle = srt.Subtitle(
+                self.index, timedelta(seconds=start), timedelta(seconds=end), text
+            )
+            self.stream.write(subtitle.to_srt())
+
+
+class VTTWriter(TextWriter):
+    """
+    Субтитры WebVTT.
+    """
+    extension = "vtt"
+
+    def __init__(self, stream) -> None:
+        super().__init__(stream)
+        self.stream.write("WEBVTT\n\n")
+
+    @staticmethod
+    def _timestamp(seconds: float) -> str:
+        return srt.timedelta_to_srt_timestamp(timedelta(seconds=seconds)).replace(",", ".")
+
+    def write(self, segment: dict) -> None:
+        for start, end, text in iter_cues(segment):
+            self.stream.write(f"{self._timestamp(start)} --> {self._timestamp(end)}\n{text}\n\n")
+
+
+class JSONWriter(TextWriter):
+    """
+    JSON массив фраз со словами, временем и уверенностью.
+    Массив пишется по одной фразе, без сборки в памяти.
+    """
+    extension = "json"
+
+    def __init__(self, stream) -> None:
+        super().__init__(stream)
+        self.count = 0
+        self.stream.write("[")
+
+    def write(self, segment: dict) -> None:
+        separator = "," if self.count else ""
+        self.stream.write(f"{separator}\n{json.dumps(segment, ensure_ascii=False)}")
+        self.count += 1
+
+    def close(self) -> None:
+        self.stream.write("\n]\n")
+
+
+FORMATS = {
+    "text": TextWriter,
+    "srt": SRTWriter,
+    "vtt": VTTWriter,
+    "json": JSONWriter,
+}
+
+
+class TranscriptFile:
+    """
+    Временный файл, в который фразы пишутся по мере распознавания
+    в выбранном формате. Файл удаляется при выходе из with.
+    """
+
+    def __init__(self, output_format: str = "text") -> None:
+        """
+        :arg output_format: str  "text", "srt", "vtt" или "json"
+        """
+        if output_format not in FORMATS:
+            raise Exception(
+                f"Формат {output_format} не поддерживается, доступны: {', '.join(FORMATS)}"
+            )
+        self.format = output_format
+        self.segments = 0
+        self._file = tempfile.TemporaryFile()
+        self._stream = io.TextIOWrapper(self._file, encoding="utf8", newline="")
+        self._writer = FORMATS[output_format](self._stream)
+
+    @property
+    def filename(self) -> str:
+        return f"transcript.{self._writer.extension}"
+
+    def write(self, result: dict) -> dict:
+        """
+        Дописывает фразу Vosk в файл.
+
+        :arg result: dict  результат Vosk
+        :return: dict  фраза, см. to_segment
+        """
+        segment = to_segment(result)
+        self._writer.write(segment)
+        self.segments += 1
+        return segment
+
+    def finish(self):
+        """
+        Завершает запись.
+
+        :return: файловый объект, открытый на чтение с начала
+        """
+        self._writer.close()
+        self._stream.flush()
+        self._stream.detach()
+        self._stream = None
+        self._file.seek(0)
+        return self._file
+
+    def close(self) -> None:
+        if self._stream is not None:
+            # Закрывает и сам файл
+            self._stream.close()
+        else:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
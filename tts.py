@@ -2,13 +2,29 @@
 """
 Конвертация текст -> wav/ogg
 """
+import contextvars
+import hashlib
+import itertools
+import logging
 import os
 import re
 import subprocess
+import threading
+import wave
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime
 
 import torch
-from num2words import num2words
+
+import metrics
+from codec import Codec, run_ffmpeg_async, scratch_dir, scratch_file
+from normalizer import iter_normalized
+
+logger = logging.getLogger(__name__)
+
+# Короткий текст для проверки модели после оптимизации
+SMOKE_TEXT = "Проверка."
 
 
 class TTS:
@@ -16,6 +32,8 @@ class TTS:
     Класс для преобразования текста в аудио.
     Поддерживаются форматы аудио: wav, ogg
     """
+    # speaker_voice, optimize и sample_rate входят в ключ кэша,
+    # их копия для расчета ключа без torch - inference.TTS_KEY_DEFAULTS
     default_init = {
         "sample_rate": 24000,
         "device_init": "cpu",
@@ -23,8 +41,20 @@ class TTS:
         "speaker_voice": "kseniya",
         "model_path": "models/silero/model.pt",  # путь к файлу TTS модели Silero
         "model_url": "https://models.silero.ai/models/tts/ru/v3_1_ru.pt",  # URL к TTS модели Silero
-        "ffmpeg_path": "models/silero"  # путь к ffmpeg
+        "ffmpeg_path": "models/silero",  # путь к ffmpeg
+        "text_limit": 800,  # максимальная длина текста для одного вызова модели
+        "synth_workers": 2,  # количество параллельных вызовов модели для длинного текста
+        "first_chunk_limit": 200,  # длина первого куска при потоковом синтезе
+        "codec": "auto",  # кодирование: "auto" - PyAV если установлен, "pyav", "ffmpeg"
+        "audio_codec": "opus",  # кодек ogg: "opus" - формат голосовых Telegram, "vorbis"
+        "bitrate": None,  # битрейт Opus в бит/с, None - для речи по частоте выборки
+        "optimize": "none",  # "none", "inference" - TorchScript freeze, "int8" - еще и квантизация
+        "optimize_cache": "models/silero/optimized",  # папка для оптимизированной модели
+        "scratch_root": None,  # папка для временных файлов, None - /dev/shm или системная
     }
+    # Модели в разных потоках оптимизируются по очереди:
+    # первая сохраняет результат, остальные загружают его с диска
+    _optimize_lock = threading.Lock()
 
     def __init__(
         self,
@@ -34,7 +64,16 @@ class TTS:
         speaker_voice=None,
         model_path=None,
         model_url=None,
-        ffmpeg_path=None
+        ffmpeg_path=None,
+        text_limit=None,
+        synth_workers=None,
+        first_chunk_limit=None,
+        codec=None,
+        audio_codec=None,
+        bitrate=None,
+        optimize=None,
+        optimize_cache=None,
+        scratch_root=None
     ) -> None:
         """
         Настройка модели Silero для преобразования текста в аудио.
@@ -46,6 +85,15 @@ class TTS:
         :arg model_path: str        # путь до модели silero
         :arg model_url: str         # URL к TTS модели Silero
         :arg ffmpeg_path: str       # путь к ffmpeg
+        :arg text_limit: int        # максимальная длина текста для одного вызова модели
+        :arg synth_workers: int     # количество параллельных вызовов модели
+        :arg first_chunk_limit: int # длина первого куска при потоковом синтезе
+        :arg codec: str             # кодирование: "auto", "pyav" или "ffmpeg"
+        :arg audio_codec: str       # кодек ogg: "opus" или "vorbis"
+        :arg bitrate: int           # битрейт Opus в бит/с
+        :arg optimize: str          # "none", "inference" или "int8"
+        :arg optimize_cache: str    # папка для оптимизированной модели
+        :arg scratch_root: str      # папка для временных файлов
         """
         self.sample_rate = sample_rate if sample_rate else TTS.default_init["sample_rate"]
         self.device_init = device_init if device_init else TTS.default_init["device_init"]
@@ -54,13 +102,170 @@ class TTS:
         self.model_path = model_path if model_path else TTS.default_init["model_path"]
         self.model_url = model_url if model_url else TTS.default_init["model_url"]
         self.ffmpeg_path = ffmpeg_path if ffmpeg_path else TTS.default_init["ffmpeg_path"]
+        self.text_limit = text_limit if text_limit else TTS.default_init["text_limit"]
+        self.synth_workers = synth_workers if synth_workers else TTS.default_init["synth_workers"]
+        self.first_chunk_limit = first_chunk_limit if first_chunk_limit else TTS.default_init["first_chunk_limit"]
+        codec = codec if codec else TTS.default_init["codec"]
+        audio_codec = audio_codec if audio_codec else TTS.default_init["audio_codec"]
+        bitrate = bitrate if bitrate else TTS.default_init["bitrate"]
+        self.optimize = optimize if optimize else TTS.default_init["optimize"]
+        self.optimize_cache = optimize_cache if optimize_cache else TTS.default_init["optimize_cache"]
+        self.scratch_root = scratch_root if scratch_root else TTS.default_init["scratch_root"]
+        if self.optimize not in ("none", "inference", "int8"):
+            raise Exception("optimize: доступны none, inference, int8")
+        # Все частоты Silero - родные для Opus, кодирование идет без пересчета
+        if self.sample_rate not in (8000, 24000, 48000):
+            raise Exception("sample_rate: доступны 8000, 24000, 48000")
 
         self._check_model()
+        self.codec = Codec(self.ffmpeg_path, backend=codec, audio_codec=audio_codec, bitrate=bitrate)
+        self._synth_executor = None
+        self._synth_lock = threading.Lock()
 
         device = torch.device(self.device_init)
         torch.set_num_threads(self.threads)
         self.model = torch.package.PackageImporter(self.model_path).load_pickle("tts_models", "model")
         self.model.to(device)
+        if self.optimize != "none":
+            self._optimize_model()
+
+    @staticmethod
+    def threads_per_worker(workers: int, synth_workers: int = None, processes: int = 1) -> int:
+        """
+        Сколько потоков torch дать одной модели, чтобы все модели
+        всех процессов вместе не занимали больше ядер, чем есть.
+        Каждый поток, вызывающий модель, запускает свои потоки torch.
+
+        :arg workers:       int  количество потоков с моделью Silero в процессе
+        :arg synth_workers: int  параллельные вызовы модели внутри потока
+        :arg processes:     int  количество процессов с моделями на машине
+        :return: int
+        """
+        synth_workers = synth_workers if synth_workers else TTS.default_init["synth_workers"]
+        return max(1, (os.cpu_count() or 1) // (processes * workers * synth_workers))
+
+    def _optimized_path(self, name: str) -> str:
+        """
+        Путь к сохраненной оптимизированной части модели. В имени хэш
+        от файла модели, режима и версии torch, поэтому после обновления
+        модели или torch оптимизация выполняется заново.
+        """
+        stat = os.stat(self.model_path)
+        source = "\0".join((
+            os.path.abspath(self.model_path), str(stat.st_size), str(stat.st_mtime),
+            self.optimize, name, torch.__version__,
+        ))
+        digest = hashlib.sha256(source.encode("utf8")).hexdigest()[:16]
+        return os.path.join(self.optimize_cache, f"{name}.{self.optimize}.{digest}.pt")
+
+    def _optimize_module(self, module: torch.nn.Module) -> torch.nn.Module:
+        """
+        Оптимизирует одну сеть модели: int8 квантизация Linear/LSTM
+        для обычных модулей, freeze и optimize_for_inference для TorchScript.
+        Если квантизованную сеть не удалось перевести в TorchScript,
+        возвращается она же без TorchScript, такая не сохраняется на диск.
+        """
+        module = module.eval()
+        if isinstance(module, torch.jit.ScriptModule):
+            if self.optimize == "int8":
+                # quantize_dynamic меняет только обычные модули nn.Linear/LSTM
+                logger.warning("Silero: сеть уже в TorchScript, int8 недоступна, только freeze")
+            return self._freeze(module)
+        if self.optimize != "int8":
+            # Обычный модуль пробуем перевести в TorchScript, чтобы сохранить на диск
+            return self._freeze(torch.jit.script(module))
+
+        quantized = torch.quantization.quantize_dynamic(
+            module, {torch.nn.Linear, torch.nn.LSTM, torch.nn.GRU}, dtype=torch.qint8
+        )
+        try:
+            return self._freeze(torch.jit.script(quantized))
+        except Exception as error:
+            logger.info("Silero: квантизованная сеть без TorchScript: %s", error)
+            return quantized
+
+    @staticmethod
+    def _freeze(module: torch.jit.ScriptModule) -> torch.jit.ScriptModule:
+        """
+        freeze и optimize_for_inference. Без preserved_attrs у сети после
+        freeze остается только forward, поэтому сохраняются все ее
+        публичные методы. Модель все равно проверяется синтезом,
+        см. _check_optimized.
+        """
+        methods = []
+        for name in dir(module):
+            if name.startswith("_") or name == "forward":
+                continue
+            try:
+                if isinstance(getattr(module, name), torch._C.ScriptMethod):
+                    methods.append(name)
+            except Exception:
+                continue
+        module = torch.jit.freeze(module, preserved_attrs=methods)
+        try:
+            return torch.jit.optimize_for_inference(module, other_methods=methods)
+        except TypeError:
+            # torch < 1.13: оптимизируется только forward
+            return torch.jit.optimize_for_inference(module)
+
+    def _optimize_model(self) -> None:
+        """
+        Заменяет сети внутри модели Silero оптимизированными.
+        Результат сохраняется на диск и при следующем запуске загружается
+        готовым. Если оптимизация не удалась, остается исходная сеть.
+        Несовместимость оптимизированной сети видна только при вызове,
+        поэтому модель проверяется коротким синтезом: если он упал,
+        возвращаются исходные сети, а сохраненные удаляются.
+        """
+        os.makedirs(self.optimize_cache, exist_ok=True)
+        originals = {}
+        for name, module in list(vars(self.model).items()):
+            if not isinstance(module, torch.nn.Module):
+                continue
+            path = self._optimized_path(name)
+            try:
+                with TTS._optimize_lock:
+                    if os.path.isfile(path):
+                        optimized = torch.jit.load(path, map_location=self.device_init)
+                    else:
+                        with metrics.timer("tts_optimize"):
+                            optimized = self._optimize_module(module)
+                        if isinstance(optimized, torch.jit.ScriptModule):
+                            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+                            torch.jit.save(optimized, tmp_path)
+                            os.replace(tmp_path, path)
+            except Exception as error:
+                logger.warning("Silero: не удалось оптимизировать %s: %s", name, error)
+                continue
+            originals[name] = module
+            setattr(self.model, name, optimized)
+        if originals:
+            self._check_optimized(originals)
+        else:
+            logger.warning("Silero: режим %s не применен, используется исходная модель", self.optimize)
+
+    def _check_optimized(self, originals: dict) -> None:
+        """
+        Проверяет модель с оптимизированными сетями коротким синтезом.
+        Если он упал, возвращает исходные сети и удаляет сохраненные.
+
+        :arg originals: dict[str, torch.nn.Module]  имя -> исходная сеть
+        """
+        try:
+            with torch.inference_mode():
+                self.model.apply_tts(
+                    text=SMOKE_TEXT, speaker=self.speaker_voice, sample_rate=self.sample_rate
+                )
+            logger.info("Silero: режим %s применен к %s", self.optimize, ", ".join(originals))
+        except Exception as error:
+            logger.warning("Silero: оптимизированная модель не работает, используется исходная: %s", error)
+            with TTS._optimize_lock:
+                for name, module in originals.items():
+                    setattr(self.model, name, module)
+                    try:
+                        os.remove(self._optimized_path(name))
+                    except FileNotFoundError:
+                        pass
 
     def _check_model(self):
         """
@@ -81,23 +286,17 @@ class TTS:
                             )
         self.ffmpeg_path = self.ffmpeg_path + '/ffmpeg'
 
-    def wav_to_ogg(
-        self,
-        in_filename: str,
-        out_filename: str = None
-                   ) -> str:
+    def _wav_to_ogg_command(self, in_filename: str, out_filename: str = None) -> tuple:
         """
-        Конвертирует аудио в ogg формат.
+        Проверяет аргументы и готовит команду ffmpeg для wav_to_ogg.
 
-        :arg in_filename:  str  # путь до входного файла
-        :arg out_filename: str  # путь до выходного файла
-        :return: str  # путь до выходного файла
+        :return: tuple[list[str], str]  # команда и путь до выходного файла
         """
         if not in_filename:
             raise Exception("Укажите путь и имя файла in_filename")
 
         if out_filename is None:
-            out_filename = "test_1.ogg"
+            out_filename = scratch_file("ogg", self.scratch_root, prefix="tts_")
 
         if os.path.exists(out_filename):
             os.remove(out_filename)
@@ -106,34 +305,64 @@ class TTS:
             self.ffmpeg_path,
             "-loglevel", "quiet",
             "-i", in_filename,
-            "-acodec", "libvorbis",
+            *self.codec.encode_args(self.sample_rate),
             out_filename
         ]
-        proc = subprocess.Popen(
-            command,
-            stdout=subprocess.DEVNULL,
-            stderr=subprocess.DEVNULL
-                                )
-        proc.wait()
-        return out_filename
+        return command, out_filename
 
-    def ogg_to_wav(
+    def wav_to_ogg(
         self,
         in_filename: str,
         out_filename: str = None
                    ) -> str:
         """
-        Конвертирует аудио в wav формат.
+        Конвертирует аудио в ogg формат.
 
         :arg in_filename:  str  # путь до входного файла
         :arg out_filename: str  # путь до выходного файла
         :return: str  # путь до выходного файла
         """
+        command, out_filename = self._wav_to_ogg_command(in_filename, out_filename)
+        with metrics.timer("tts_wav_to_ogg"):
+            proc = subprocess.Popen(
+                command,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL
+                                    )
+            proc.wait()
+        return out_filename
+
+    async def wav_to_ogg_async(
+        self,
+        in_filename: str,
+        out_filename: str = None,
+        timeout: float = None
+                               ) -> str:
+        """
+        Асинхронный вариант wav_to_ogg.
+        При отмене задачи или по таймауту ffmpeg завершается.
+
+        :arg in_filename:  str    # путь до входного файла
+        :arg out_filename: str    # путь до выходного файла
+        :arg timeout:      float  # таймаут в секундах
+        :return: str  # путь до выходного файла
+        """
+        command, out_filename = self._wav_to_ogg_command(in_filename, out_filename)
+        with metrics.timer("tts_wav_to_ogg"):
+            await run_ffmpeg_async(command, timeout=timeout)
+        return out_filename
+
+    def _ogg_to_wav_command(self, in_filename: str, out_filename: str = None) -> tuple:
+        """
+        Проверяет аргументы и готовит команду ffmpeg для ogg_to_wav.
+
+        :return: tuple[list[str], str]  # команда и путь до выходного файла
+        """
         if not in_filename:
             raise Exception("Укажите путь и имя файла in_filename")
 
         if out_filename is None:
-            out_filename = "test_1.wav"
+            out_filename = scratch_file("wav", self.scratch_root, prefix="tts_")
 
         if os.path.exists(out_filename):
             os.remove(out_filename)
@@ -146,6 +375,21 @@ class TTS:
             "-c:a", "pcm_s16le",
             out_filename
         ]
+        return command, out_filename
+
+    def ogg_to_wav(
+        self,
+        in_filename: str,
+        out_filename: str = None
+                   ) -> str:
+        """
+        Конвертирует аудио в wav формат.
+
+        :arg in_filename:  str  # путь до входного файла
+        :arg out_filename: str  # путь до выходного файла
+        :return: str  # путь до выходного файла
+        """
+        command, out_filename = self._ogg_to_wav_command(in_filename, out_filename)
         proc = subprocess.Popen(
             command,
             stdout=subprocess.DEVNULL,
@@ -154,21 +398,40 @@ class TTS:
         proc.wait()
         return out_filename
 
-    def _get_wav(self, text: str, speaker_voice=None, sample_rate=None) -> str:
+    async def ogg_to_wav_async(
+        self,
+        in_filename: str,
+        out_filename: str = None,
+        timeout: float = None
+                               ) -> str:
+        """
+        Асинхронный вариант ogg_to_wav.
+        При отмене задачи или по таймауту ffmpeg завершается.
+
+        :arg in_filename:  str    # путь до входного файла
+        :arg out_filename: str    # путь до выходного файла
+        :arg timeout:      float  # таймаут в секундах
+        :return: str  # путь до выходного файла
+        """
+        command, out_filename = self._ogg_to_wav_command(in_filename, out_filename)
+        await run_ffmpeg_async(command, timeout=timeout)
+        return out_filename
+
+    def _get_wav(self, text: str, speaker_voice=None, sample_rate=None, out_filename: str = None) -> str:
         """
         Конвертирует текст в wav файл
 
         :arg text:  str  # текст до 1000 символов
         :arg speaker_voice:  str  # голос диктора
         :arg sample_rate: str  # качество выходного аудио
+        :arg out_filename: str  # путь до выходного файла, None - уникальный временный
         :return: str  # путь до выходного файла
         """
         if text is None:
             raise Exception("Передайте текст")
 
-        # Удаляем существующий файл чтобы все хорошо работало
-        if os.path.exists("test.wav"):
-            os.remove("test.wav")
+        if out_filename is None:
+            out_filename = scratch_file("wav", self.scratch_root, prefix="tts_")
 
         if speaker_voice is None:
             speaker_voice = self.speaker_voice
@@ -176,12 +439,14 @@ class TTS:
         if sample_rate is None:
             sample_rate = self.sample_rate
 
-        # Сохранение результата в файл test.wav
-        return self.model.save_wav(
-            text=text,
-            speaker=speaker_voice,
-            sample_rate=sample_rate
-        )
+        # Silero по умолчанию пишет в общий test.wav, путь задаем явно
+        with metrics.timer("tts_inference"), torch.inference_mode(self.optimize != "none"):
+            return self.model.save_wav(
+                text=text,
+                speaker=speaker_voice,
+                sample_rate=sample_rate,
+                audio_path=out_filename
+            )
 
     def _get_ogg(self, text: str, speaker_voice=None, sample_rate=None) -> str:
         """
@@ -192,53 +457,76 @@ class TTS:
         :arg sample_rate: str  # качество выходного аудио
         :return: str  # путь до выходного файла
         """
-        # Конвертируем текст в wav, возвращаем путь до wav
-        wav_audio_path = self._get_wav(text, speaker_voice, sample_rate)
+        with scratch_dir(self.scratch_root, prefix="tts_") as workdir:
+            # Конвертируем текст в wav, возвращаем путь до wav
+            wav_audio_path = self._get_wav(
+                text, speaker_voice, sample_rate, os.path.join(workdir, "audio.wav")
+            )
 
-        # Конвертируем wav в ogg, возвращаем путь до ogg
-        ogg_audio_path = self.wav_to_ogg(wav_audio_path)
+            # Конвертируем wav в ogg, возвращаем путь до ogg
+            return self.wav_to_ogg(wav_audio_path)
 
-        if os.path.exists(wav_audio_path):
-            os.remove(wav_audio_path)
+    def _get_audio(self, text: str, speaker_voice=None, sample_rate=None) -> torch.Tensor:
+        """
+        Конвертирует текст в аудио без сохранения на диск
 
-        return ogg_audio_path
+        :arg text:  str  # текст до 1000 символов
+        :arg speaker_voice:  str  # голос диктора
+        :arg sample_rate: str  # качество выходного аудио
+        :return: torch.Tensor  # аудио, float от -1 до 1
+        """
+        if text is None:
+            raise Exception("Передайте текст")
 
-    def _nums_to_text(self, text: str) -> str:
+        if speaker_voice is None:
+            speaker_voice = self.speaker_voice
+
+        if sample_rate is None:
+            sample_rate = self.sample_rate
+
+        with metrics.timer("tts_inference"), torch.inference_mode(self.optimize != "none"):
+            return self.model.apply_tts(
+                text=text,
+                speaker=speaker_voice,
+                sample_rate=sample_rate
+            )
+
+    def _audio_to_pcm(self, audio: torch.Tensor) -> bytes:
         """
-        Преобразует числа в буквы: 1 -> один, 23 -> двадцать три.
-        :arg text: str
-        :return: str
+        Конвертирует аудио в сырые байты PCM s16le.
+
+        :arg audio: torch.Tensor  # аудио, float от -1 до 1
+        :return: bytes  # PCM 16 бит, моно
         """
-        return re.sub(
-            r"(\d+)",
-            lambda x: num2words(int(x.group(0)), lang="ru"),
-            text)
+        audio = (audio * 32767).clamp(-32768, 32767).to(torch.int16)
+        return audio.numpy().tobytes()
 
-    def _merge_audio_n_to_1(
-        self,
-        in_filenames: list,
-        out_filename: str = None
-                            ) -> str:
+    def _merge_command(self, in_filenames: list, workdir: str, out_filename: str = None) -> tuple:
         """
-        Объединит несколько файлов в один файл без перекодирования.
-        Файлы должны быть одинакового формата.
+        Проверяет аргументы, пишет список файлов audiolist.txt
+        в папку workdir и готовит команду ffmpeg для _merge_audio_n_to_1.
 
-        :arg in_filenames: list[str]    # список файлов для склеивания
-        :arg out_filename: str          # имя выходного файла
-        :return out_filename: str       # имя выходного файла
+        :arg workdir: str  # временная папка вызова
+        :return: tuple[list[str], str]  # команда и имя выходного файла
         """
         if not in_filenames:
             raise Exception("Укажите пути и имя файла in_filenames")
 
         if out_filename is None:
             extension = in_filenames[0].split(sep=".")[-1]
-            out_filename = f"test_n_1.{extension}"
+            out_filename = scratch_file(extension, self.scratch_root, prefix="tts_")
 
         if os.path.exists(out_filename):
             os.remove(out_filename)
 
-        filenames = "\n".join([f"file '{filename}'" for filename in in_filenames])
-        with open("audiolist.txt", "wt") as file:
+        # Пути абсолютные: ffmpeg ищет файлы относительно списка.
+        # Кавычка в имени экранируется как '\''
+        filenames = "\n".join([
+            "file '{}'".format(os.path.abspath(filename).replace("'", "'\\''"))
+            for filename in in_filenames
+        ])
+        list_filename = os.path.join(workdir, "audiolist.txt")
+        with open(list_filename, "wt", encoding="utf8") as file:
             file.write(filenames)
 
         # region
@@ -256,15 +544,52 @@ class TTS:
             "-loglevel", "quiet",
             "-f", "concat",
             "-safe", "0",
-            "-i", "audiolist.txt",
+            "-i", list_filename,
             "-c", "copy",
             out_filename,
         ]
-        proc = subprocess.Popen(command)
-        proc.wait()
+        return command, out_filename
+
+    def _merge_audio_n_to_1(
+        self,
+        in_filenames: list,
+        out_filename: str = None
+                            ) -> str:
+        """
+        Объединит несколько файлов в один файл без перекодирования.
+        Файлы должны быть одинакового формата.
 
-        if os.path.exists("audiolist.txt"):
-            os.remove("audiolist.txt")
+        :arg in_filenames: list[str]    # список файлов для склеивания
+        :arg out_filename: str          # имя выходного файла
+        :return out_filename: str       # имя выходного файла
+        """
+        with scratch_dir(self.scratch_root, prefix="tts_") as workdir:
+            command, out_filename = self._merge_command(in_filenames, workdir, out_filename)
+            with metrics.timer("tts_merge"):
+                proc = subprocess.Popen(command)
+                proc.wait()
+
+        return out_filename
+
+    async def _merge_audio_n_to_1_async(
+        self,
+        in_filenames: list,
+        out_filename: str = None,
+        timeout: float = None
+                                        ) -> str:
+        """
+        Асинхронный вариант _merge_audio_n_to_1.
+        При отмене задачи или по таймауту ffmpeg завершается.
+
+        :arg in_filenames: list[str]    # список файлов для склеивания
+        :arg out_filename: str          # имя выходного файла
+        :arg timeout:      float        # таймаут в секундах
+        :return out_filename: str       # имя выходного файла
+        """
+        with scratch_dir(self.scratch_root, prefix="tts_") as workdir:
+            command, out_filename = self._merge_command(in_filenames, workdir, out_filename)
+            with metrics.timer("tts_merge"):
+                await run_ffmpeg_async(command, timeout=timeout)
 
         return out_filename
 
@@ -284,97 +609,186 @@ class TTS:
         os.rename(in_filename, out_filename)
         return out_filename
 
-    def text_to_ogg(self, text: str, out_filename: str = None) -> str:
+    def _split_text(self, text: str, limit: int = None) -> list:
         """
-        Конвертирует текст в файл ogg.
-        Модель игнорирует латиницу, но поддерживает цифры числами.
+        Разбивает текст на части не длиннее limit символов.
+        Сначала режет по границам предложений, длинные предложения
+        по знакам препинания внутри предложения, затем по пробелам.
+
+        :arg text: str  # текст
+        :arg limit: int  # максимальная длина части, по умолчанию text_limit
+        :return: list[str]  # части текста
+        """
+        if limit is None:
+            limit = self.text_limit
+        pieces = []
+        for sentence in re.split(r"(?<=[.!?…])\s+", text.strip()):
+            if len(sentence) <= limit:
+                pieces.append(sentence)
+                continue
+            for clause in re.split(r"(?<=[,;:—])\s+", sentence):
+                if len(clause) <= limit:
+                    pieces.append(clause)
+                    continue
+                for word in clause.split():
+                    # Слово длиннее лимита режем как есть
+                    pieces.extend(word[x:x+limit] for x in range(0, len(word), limit))
+
+        # Собираем соседние части в куски до лимита
+        chunks = []
+        for piece in pieces:
+            if not piece:
+                continue
+            if chunks and len(chunks[-1]) + 1 + len(piece) <= limit:
+                chunks[-1] = f"{chunks[-1]} {piece}"
+            else:
+                chunks.append(piece)
+        return chunks
+
+    def _text_to_audio(self, text: str) -> torch.Tensor:
+        """
+        Конвертирует текст любой длины в аудио в памяти.
+        Длинный текст разбивается на куски, которые синтезируются
+        параллельно и склеиваются в один тензор.
 
         :arg text: str  # текст кирилицей
-        :return: str    # имя выходного файла
+        :return: torch.Tensor  # аудио, float от -1 до 1
         """
-        if text is None:
+        chunks = self._text_chunks(text)
+        first = next(chunks, None)
+        if first is None:
             raise Exception("Передайте текст")
+        second = next(chunks, None)
+        if second is None:
+            return self._get_audio(first)
 
-        # Делаем числа буквами
-        text = self._nums_to_text(text)
+        # Синтез кусков начинается, пока следующие еще нормализуются
+        futures = [self._submit_audio(first), self._submit_audio(second)]
+        futures += [self._submit_audio(chunk) for chunk in chunks]
+        return torch.cat([future.result() for future in futures])
+
+    def _text_chunks(self, text: str):
+        """
+        Разбивает текст на куски для модели и нормализует их по одному,
+        поэтому первый кусок готов, не дожидаясь нормализации всего текста.
+        Нормализованный кусок длиннее исходного и режется еще раз.
+
+        :arg text: str  # текст
+        :return: generator[str]  # куски текста
+        :raises Exception: текст пустой
+        """
+        if not text:
+            raise Exception("Передайте текст")
+        chunks = self._split_text(text)
+        if not chunks:
+            raise Exception("Передайте текст")
+        return self._iter_normalized_chunks(chunks)
 
-        # Генерируем ogg если текст < 800 символов
-        if len(text) < 800:
-            # Возвращаем путь до ogg
-            ogg_audio_path = self._get_ogg(text)
+    def _iter_normalized_chunks(self, chunks: list):
+        """
+        Числа, даты, телефоны и латиницу делаем словами, см. iter_normalized.
+        Пробел после куска нужен, чтобы iter_normalized видел границу предложения.
+        """
+        for normalized in iter_normalized(f"{chunk} " for chunk in chunks):
+            yield from self._split_text(normalized)
 
-            if out_filename is None:
-                return ogg_audio_path
+    def _submit_audio(self, text: str) -> Future:
+        """
+        Запускает синтез куска текста в пуле synth_workers.
+        """
+        with self._synth_lock:
+            if self._synth_executor is None:
+                self._synth_executor = ThreadPoolExecutor(
+                    max_workers=self.synth_workers,
+                    thread_name_prefix="tts-synth"
+                )
+        # Контекст копируется, чтобы время попало в лог текущего запроса
+        return self._synth_executor.submit(
+            contextvars.copy_context().run, self._get_audio, text
+        )
 
-            return self._rename_file(ogg_audio_path, out_filename)
+    def iter_text_to_pcm(self, text: str):
+        """
+        Синтезирует текст по частям и выдает PCM каждой части,
+        как только она готова, не дожидаясь всего текста.
+        Первая часть - короткая, не длиннее first_chunk_limit,
+        чтобы первое аудио было готово быстро. Следующие части
+        синтезируются заранее, пока предыдущие отправляются.
 
-        # Разбиваем текст, конвертируем и склеиваем аудио в один файл
-        texts = [text[x:x+800] for x in range(0, len(text), 800)]
-        files = []
-        for index in range(len(texts)):
-            # Конвертируем текст в ogg, возвращаем путь до ogg
-            ogg_audio_path = self._get_ogg(texts[index])
-            # Переименовываем чтобы не затереть файл
-            new_ogg_audio_path = f"{index}_{ogg_audio_path}"
-            os.rename(ogg_audio_path, new_ogg_audio_path)
-            # Добавляем новый файл в список
-            files.append(new_ogg_audio_path)
+        :arg text: str  # текст кирилицей
+        :return: generator[bytes]  # PCM 16 бит, моно, по частям
+        """
+        normalized = self._text_chunks(text)
+        first = next(normalized, None)
+        if first is None:
+            raise Exception("Передайте текст")
+        head = self._split_text(first, self.first_chunk_limit)
+        chunks = itertools.chain(
+            head[:1], self._split_text(" ".join(head[1:])) if head[1:] else [], normalized
+        )
 
-        # Склеиваем все ogg файлы в один
-        ogg_audio_path = self._merge_audio_n_to_1(files, out_filename="test_n_1.ogg")
-        # Удаляем временные файлы
-        [os.remove(file) for file in files]
+        pending = deque()
+        try:
+            for chunk in chunks:
+                pending.append(self._submit_audio(chunk))
+                # Впереди не больше одной части на каждый поток синтеза
+                if len(pending) > self.synth_workers:
+                    yield self._audio_to_pcm(pending.popleft().result())
+            while pending:
+                yield self._audio_to_pcm(pending.popleft().result())
+        finally:
+            # Генератор закрыт раньше времени: не синтезируем лишнее
+            for future in pending:
+                future.cancel()
+
+    def _pcm_to_wav(self, pcm: bytes, out_filename: str, sample_rate=None) -> str:
+        """
+        Сохраняет сырые байты PCM s16le моно в wav файл.
 
-        if out_filename is None:
-            return ogg_audio_path
+        :arg pcm: bytes  # PCM 16 бит, моно
+        :arg out_filename: str  # путь до выходного файла
+        :arg sample_rate: int  # частота выборки PCM
+        :return: str  # путь до выходного файла
+        """
+        if sample_rate is None:
+            sample_rate = self.sample_rate
 
-        return self._rename_file(ogg_audio_path, out_filename)
+        with wave.open(out_filename, "wb") as file:
+            file.setnchannels(1)
+            file.setsampwidth(2)
+            file.setframerate(sample_rate)
+            file.writeframes(pcm)
+        return out_filename
 
-    def text_to_wav(self, text: str, out_filename: str = None) -> str:
+    def text_to_ogg(self, text: str, out_filename: str = None) -> str:
         """
-        Конвертирует текст в файл wav.
+        Конвертирует текст в файл ogg.
         Модель игнорирует латиницу, но поддерживает цифры числами.
 
         :arg text: str  # текст кирилицей
         :return: str    # имя выходного файла
         """
-        if text is None:
-            raise Exception("Передайте текст")
-
-        # Делаем числа буквами
-        text = self._nums_to_text(text)
-
-        # Передаем текст целиком
-        if len(text) < 800:
-            # Конвертируем текст в wav, возвращаем путь до wav
-            wav_audio_path = self._get_wav(text)
-
-            if out_filename is None:
-                return wav_audio_path
+        if out_filename is None:
+            out_filename = scratch_file("ogg", self.scratch_root, prefix="tts_")
 
-            return self._rename_file(wav_audio_path, out_filename)
+        ogg_bytes = self.text_to_ogg_bytes(text)
+        with open(out_filename, "wb") as file:
+            file.write(ogg_bytes)
+        return out_filename
 
-        # Разбиваем текст, конвертируем и склеиваем аудио в один файл
-        texts = [text[x:x+800] for x in range(0, len(text), 800)]
-        files = []
-        for index in range(len(texts)):
-            # Конвертируем текст в wav, возвращаем путь до wav
-            wav_audio_path = self._get_wav(texts[index])
-            # Переименовываем чтобы не затереть файл
-            new_wav_audio_path = f"{index}_{wav_audio_path}"
-            os.rename(wav_audio_path, new_wav_audio_path)
-            # Добавляем файл в список
-            files.append(new_wav_audio_path)
-
-        # Склеиваем все wav файлы в один
-        wav_audio_path = self._merge_audio_n_to_1(files, out_filename="test_n_1.wav")
-        # Удаляем временные файлы
-        [os.remove(file) for file in files]
+    def text_to_wav(self, text: str, out_filename: str = None) -> str:
+        """
+        Конвертирует текст в файл wav.
+        Модель игнорирует латиницу, но поддерживает цифры числами.
 
+        :arg text: str  # текст кирилицей
+        :return: str    # имя выходного файла
+        """
         if out_filename is None:
-            return wav_audio_path
+            out_filename = scratch_file("wav", self.scratch_root, prefix="tts_")
 
-        return self._rename_file(wav_audio_path, out_filename)
+        audio = self._text_to_audio(text)
+        return self._pcm_to_wav(self._audio_to_pcm(audio), out_filename)
 
 # region Может не работать!
     #     # Сохранение результата в файл ogg Не всегда работает!
@@ -408,29 +822,117 @@ class TTS:
     #     return buffer_
 # endregion
 
-    def wav_to_ogg_bytes(self, in_bytes: bytes) -> bytes:
+    def _wav_to_ogg_bytes_command(self, input_args: list = None) -> list:
         """
-        Конвертирует аудио в ogg формат без сохранения данных на диск.
+        Команда ffmpeg для wav_to_ogg_bytes.
 
-        :arg in_bytes: bytes  # входной файл в байтах
-        :return:       bytes  # выходной файл в байтах
+        :arg input_args: list[str]  # параметры ffmpeg для входных данных
+        :return: list[str]
         """
-        command = [
+        if input_args is None:
+            input_args = []
+
+        return [
             self.ffmpeg_path,
+            "-loglevel", "quiet",
+            *input_args,
             "-i", 'pipe:0',          # stdin
             "-f", "ogg",             # format
-            "-acodec", "libvorbis",  # codec
+            *self.codec.encode_args(self.sample_rate),  # codec
             "pipe:1"                 # stdout
         ]
-        proc = subprocess.Popen(
-            command,
-            stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE
-        )
-        out_bytes, err = proc.communicate(input=in_bytes)
+
+    def wav_to_ogg_bytes(self, in_bytes: bytes, input_args: list = None) -> bytes:
+        """
+        Конвертирует аудио в ogg формат без сохранения данных на диск.
+
+        :arg in_bytes:   bytes      # входной файл в байтах
+        :arg input_args: list[str]  # параметры ffmpeg для входных данных
+        :return:         bytes      # выходной файл в байтах
+        """
+        command = self._wav_to_ogg_bytes_command(input_args)
+        with metrics.timer("tts_encode"):
+            proc = subprocess.Popen(
+                command,
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE
+            )
+            out_bytes, err = proc.communicate(input=in_bytes)
         return out_bytes
 
+    async def wav_to_ogg_bytes_async(
+        self,
+        in_bytes: bytes,
+        input_args: list = None,
+        timeout: float = None
+    ) -> bytes:
+        """
+        Асинхронный вариант wav_to_ogg_bytes.
+        При отмене задачи или по таймауту ffmpeg завершается.
+
+        :arg in_bytes:   bytes      # входной файл в байтах
+        :arg input_args: list[str]  # параметры ffmpeg для входных данных
+        :arg timeout:    float      # таймаут в секундах
+        :return:         bytes      # выходной файл в байтах
+        """
+        command = self._wav_to_ogg_bytes_command(input_args)
+        with metrics.timer("tts_encode"):
+            return await run_ffmpeg_async(command, in_bytes, timeout)
+
+    def pcm_to_ogg_bytes(self, pcm: bytes, sample_rate=None) -> bytes:
+        """
+        Конвертирует сырые байты PCM s16le моно в ogg без сохранения на диск.
+
+        :arg pcm: bytes  # PCM 16 бит, моно
+        :arg sample_rate: int  # частота выборки PCM
+        :return: bytes  # ogg файл в байтах
+        """
+        if sample_rate is None:
+            sample_rate = self.sample_rate
+
+        with metrics.timer("tts_encode"):
+            return self.codec.encode_ogg(pcm, sample_rate)
+
+    async def pcm_to_ogg_bytes_async(self, pcm: bytes, sample_rate=None, timeout: float = None) -> bytes:
+        """
+        Асинхронный вариант pcm_to_ogg_bytes.
+        При отмене задачи или по таймауту ffmpeg завершается.
+
+        :arg pcm: bytes  # PCM 16 бит, моно
+        :arg sample_rate: int  # частота выборки PCM
+        :arg timeout: float  # таймаут в секундах
+        :return: bytes  # ogg файл в байтах
+        """
+        if sample_rate is None:
+            sample_rate = self.sample_rate
+
+        with metrics.timer("tts_encode"):
+            return await self.codec.encode_ogg_async(pcm, sample_rate, timeout)
+
+    def text_to_pcm(self, text: str) -> bytes:
+        """
+        Конвертирует текст в сырые байты PCM s16le моно с частотой sample_rate.
+        Модель игнорирует латиницу, но поддерживает цифры числами.
+
+        :arg text: str  # текст кирилицей
+        :return: bytes  # PCM 16 бит, моно
+        """
+        return self._audio_to_pcm(self._text_to_audio(text))
+
+    def text_to_ogg_bytes(self, text: str) -> bytes:
+        """
+        Конвертирует текст в ogg без временных файлов на диске.
+        Модель игнорирует латиницу, но поддерживает цифры числами.
+
+        :arg text: str  # текст кирилицей
+        :return: bytes  # ogg файл в байтах
+        """
+        audio = self._text_to_audio(text)
+
+        # Кодируем в ogg одним вызовом ffmpeg
+        return self.pcm_to_ogg_bytes(self._audio_to_pcm(audio))
+
 
 if __name__ == "__main__":
     # Генерирование аудио из текста
@@ -439,4 +941,5 @@ if __name__ == "__main__":
     print(tts.text_to_ogg("Привет,Хабр! Тэст 1 2 три четыре", "test-1.ogg"))
     print(tts.text_to_wav("Тэст! Как меня слышно? Пыш-пыш. Прием!", "test-2.wav"))
     print(tts.text_to_ogg("Слышу хорошо! Пыш-пыш.", "test-3.ogg"))
+    print(len(tts.text_to_ogg_bytes("Слышу хорошо! Пыш-пыш.")), "байт")
     print("Время выполнения:", datetime.now() - start_time)
@@ -0,0 +1,267 @@
+# -*- coding: utf8 -*-
+"""
+Определение речи по энергии сигнала (VAD) перед распознаванием.
+
+Длинные паузы вырезаются, и Vosk получает только речь с небольшими
+полями тишины. Timeline переводит время слов из урезанного аудио
+обратно во время исходного файла.
+"""
+from bisect import bisect_right
+
+import numpy as np
+
+
+class VAD:
+    """
+    Энергетический VAD для PCM s16le моно. Энергия считается сразу
+    для всех кадров куска через NumPy. Кадр считается речью, если его
+    громкость выше порога в dBFS. Паузы короче min_silence остаются
+    как есть, в более длинных остается только padding с каждой стороны.
+    """
+    default_init = {
+        "sample_rate": 16000,
+        "frame_ms": 30,         # длина кадра в миллисекундах
+        "threshold_db": -45,    # порог громкости речи в dBFS
+        "min_silence_ms": 600,  # паузы короче не вырезаются
+        "padding_ms": 200,      # сколько тишины оставить до и после речи
+    }
+
+    def __init__(self,
+                 sample_rate=None,
+                 frame_ms=None,
+                 threshold_db=None,
+                 min_silence_ms=None,
+                 padding_ms=None
+                 ) -> None:
+        """
+        Настройка VAD.
+
+        :arg sample_rate:    int    частота выборки PCM
+        :arg frame_ms:       int    длина кадра в миллисекундах
+        :arg threshold_db:   float  порог громкости речи в dBFS
+        :arg min_silence_ms: int    паузы короче не вырезаются
+        :arg padding_ms:     int    сколько тишины оставить до и после речи
+        """
+        self.sample_rate = sample_rate if sample_rate else VAD.default_init["sample_rate"]
+        self.frame_ms = frame_ms if frame_ms else VAD.default_init["frame_ms"]
+        self.threshold_db = threshold_db if threshold_db is not None else VAD.default_init["threshold_db"]
+        self.min_silence_ms = min_silence_ms if min_silence_ms else VAD.default_init["min_silence_ms"]
+        self.padding_ms = padding_ms if padding_ms is not None else VAD.default_init["padding_ms"]
+
+        self.frame_samples = self.sample_rate * self.frame_ms // 1000
+        self.min_silence_frames = max(1, self.min_silence_ms // self.frame_ms)
+        self.padding_frames = min(self.padding_ms // self.frame_ms, self.min_silence_frames // 2)
+        # Порог в единицах средней энергии кадра s16
+        self._threshold = (32768.0 ** 2) * 10 ** (self.threshold_db / 10)
+
+    def frame_energy(self, pcm: bytes) -> np.ndarray:
+        """
+        Средняя энергия каждого целого кадра куска PCM.
+
+        :arg pcm: bytes  PCM s16le моно, неполный кадр в конце отбрасывается
+        :return: np.ndarray[float32]
+        """
+        samples = np.frombuffer(pcm, dtype="<i2", count=len(pcm) // 2)
+        frames_count = len(samples) // self.frame_samples
+        frames = samples[:frames_count * self.frame_samples].astype(np.float32)
+        frames = frames.reshape(-1, self.frame_samples)
+        return np.einsum("ij,ij->i", frames, frames) / self.frame_samples
+
+    def speech_frames(self, pcm: bytes) -> np.ndarray:
+        """
+        Разметка целых кадров куска PCM: True - речь.
+
+        :arg pcm: bytes  PCM s16le моно, длина кратна кадру
+        :return: np.ndarray[bool]
+        """
+        return self.frame_energy(pcm) > self._threshold
+
+    def quietest_point(self, pcm: bytes) -> int:
+        """
+        Середина самого тихого участка куска PCM, место для разреза.
+        Громкость сглаживается по окну min_silence, чтобы разрез
+        попадал в паузу, а не в короткий провал внутри слова.
+
+        :arg pcm: bytes  PCM s16le моно
+        :return: int  смещение в сэмплах от начала куска
+        """
+        energy = self.frame_energy(pcm)
+        if not len(energy):
+            return len(pcm) // 2
+        window = min(self.min_silence_frames, len(energy))
+        smoothed = np.convolve(energy, np.ones(window) / window, mode="valid")
+        frame = int(np.argmin(smoothed)) + window // 2
+        return frame * self.frame_samples
+
+    def stream(self) -> "SpeechStream":
+        """
+        Новый поток для одного аудио.
+        """
+        return SpeechStream(self)
+
+    def split(self, pcm_chunks):
+        """
+        Фильтрует итератор кусков PCM.
+
+        :arg pcm_chunks: iterator[bytes]  PCM s16le моно
+        :return: generator[(int, bytes)]  (смещение в сэмплах в исходном аудио, PCM)
+        """
+        stream = self.stream()
+        for chunk in pcm_chunks:
+            yield from stream.push(chunk)
+        yield from stream.flush()
+
+
+class SpeechStream:
+    """
+    Состояние VAD для одного аудио. Куски PCM подаются по мере
+    декодирования, на выходе - куски речи с их смещением в исходном
+    аудио. Разрыв между смещениями означает вырезанную паузу.
+    """
+
+    def __init__(self, vad: VAD) -> None:
+        self.vad = vad
+        self.frame_bytes = vad.frame_samples * 2
+        self.skipped_samples = 0  # сколько тишины вырезано
+
+        self._rest = b""       # неполный кадр с прошлого куска
+        self._position = 0     # номер следующего кадра в исходном аудио
+        self._in_speech = False
+        self._pause = []       # кадры текущей паузы внутри речи
+        self._head = b""       # последние кадры тишины перед возможной речью
+
+    def _offset(self, frame: int) -> int:
+        return frame * self.vad.frame_samples
+
+    def push(self, pcm: bytes) -> list:
+        """
+        Обрабатывает очередной кусок PCM.
+
+        :arg pcm: bytes  PCM s16le моно
+        :return: list[(int, bytes)]  куски речи со смещением в сэмплах
+        """
+        data = self._rest + pcm
+        size = len(data) - len(data) % self.frame_bytes
+        self._rest = data[size:]
+        if not size:
+            return []
+
+        flags = self.vad.speech_frames(data[:size])
+        # Границы участков из одинаковых кадров, без цикла по кадрам
+        bounds = np.flatnonzero(np.diff(flags)) + 1
+        starts = np.concatenate(([0], bounds))
+        ends = np.concatenate((bounds, [len(flags)]))
+
+        pieces = []
+        for start, end in zip(starts.tolist(), ends.tolist()):
+            run = data[start * self.frame_bytes:end * self.frame_bytes]
+            if flags[start]:
+                self._speech(run, pieces)
+            else:
+                self._silence(run, pieces)
+            self._position += end - start
+        return pieces
+
+    def _speech(self, run: bytes, pieces: list) -> None:
+        if self._in_speech:
+            # Короткая пауза внутри речи остается как есть
+            pause = b"".join(self._pause)
+            frames = len(pause) // self.frame_bytes
+            pieces.append((self._offset(self._position - frames), pause + run))
+        else:
+            frames = len(self._head) // self.frame_bytes
+            pieces.append((self._offset(self._position - frames), self._head + run))
+            self._in_speech = True
+        self._pause = []
+        self._head = b""
+
+    def _silence(self, run: bytes, pieces: list) -> None:
+        padding = self.vad.padding_frames * self.frame_bytes
+        if not self._in_speech:
+            skipped = self._head + run
+            self._head = skipped[-padding:] if padding else b""
+            self.skipped_samples += (len(skipped) - len(self._head)) // 2
+            return
+
+        self._pause.append(run)
+        pause = b"".join(self._pause)
+        frames = len(pause) // self.frame_bytes
+        if frames < self.vad.min_silence_frames:
+            return
+        # Пауза достаточно длинная: речь закончилась
+        start = self._position + (len(run) // self.frame_bytes) - frames
+        if padding:
+            pieces.append((self._offset(start), pause[:padding]))
+        self._head = pause[-padding:] if padding else b""
+        self.skipped_samples += (len(pause) - padding - len(self._head)) // 2
+        self._pause = []
+        self._in_speech = False
+
+    def flush(self) -> list:
+        """
+        Завершает поток и возвращает оставшуюся речь.
+
+        :return: list[(int, bytes)]  куски речи со смещением в сэмплах
+        """
+        pieces = []
+        if self._in_speech:
+            tail = b"".join(self._pause) + self._rest
+            if tail:
+                frames = sum(len(run) for run in self._pause) // self.frame_bytes
+                pieces.append((self._offset(self._position - frames), tail))
+        self._rest = b""
+        self._pause = []
+        self._in_speech = False
+        return pieces
+
+
+class Timeline:
+    """
+    Соответствие времени в аудио, переданном распознавателю,
+    времени в исходном аудио.
+    """
+
+    def __init__(self, sample_rate: int) -> None:
+        self.sample_rate = sample_rate
+        self.fed = 0          # сколько сэмплов передано распознавателю
+        self.phrase_start = 0  # начало текущей фразы в переданном аудио
+        self._fed = []        # начало участка в переданном аудио
+        self._original = []   # начало участка в исходном аудио
+        self._end = None      # конец последнего куска в исходном аудио
+
+    def add(self, offset: int, samples: int) -> bool:
+        """
+        Отмечает кусок, переданный распознавателю.
+
+        :arg offset:  int  смещение куска в исходном аудио в сэмплах
+        :arg samples: int  длина куска в сэмплах
+        :return: bool  перед куском была вырезана пауза
+        """
+        gap = self._end is not None and offset != self._end
+        if self._end is None or gap:
+            self._fed.append(self.fed)
+            self._original.append(offset)
+        self.fed += samples
+        self._end = offset + samples
+        return gap
+
+    def to_original(self, seconds: float) -> float:
+        """
+        Переводит время из переданного аудио во время исходного.
+        """
+        position = seconds * self.sample_rate
+        index = bisect_right(self._fed, position) - 1
+        if index < 0:
+            return seconds
+        return (self._original[index] + position - self._fed[index]) / self.sample_rate
+
+    def remap(self, segment: dict) -> dict:
+        """
+        Переводит время слов фразы Vosk во время исходного аудио.
+        """
+        if len(self._fed) <= 1 and not any(self._original):
+            return segment
+        for word in segment.get("result", []):
+            word["start"] = round(self.to_original(word["start"]), 3)
+            word["end"] = round(self.to_original(word["end"]), 3)
+        return segment
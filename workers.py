@@ -0,0 +1,209 @@
+# -*- coding: utf8 -*-
+"""
+Несколько процессов с моделями за одним процессом, принимающим обновления.
+
+Фронт получает обновления Telegram (polling или webhook) и передает их
+в процессы-воркеры. Каждый воркер держит свои модели и обрабатывает
+обновления обычным Dispatcher. Обновления одного чата всегда попадают
+в один воркер, поэтому порядок сообщений в чате сохраняется.
+"""
+import asyncio
+import logging
+import multiprocessing
+import queue as queue_module
+
+from aiogram import types
+from aiogram.dispatcher.handler import CancelHandler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+
+logger = logging.getLogger(__name__)
+
+PARENT_POLL = 1.0  # как часто воркер проверяет, что фронт жив, сек
+
+
+def update_chat_id(update: types.Update):
+    """
+    Чат, к которому относится обновление, или None.
+    """
+    for name in ("message", "edited_message", "channel_post", "edited_channel_post"):
+        message = getattr(update, name)
+        if message is not None:
+            return message.chat.id
+    if update.callback_query is not None and update.callback_query.message is not None:
+        return update.callback_query.message.chat.id
+    if update.my_chat_member is not None:
+        return update.my_chat_member.chat.id
+    if update.chat_member is not None:
+        return update.chat_member.chat.id
+    return None
+
+
+class WorkerPool:
+    """
+    Процессы-воркеры с шардированием обновлений по chat id.
+    Процессы запускаются через spawn, чтобы модели и потоки torch
+    не копировались из фронта через fork.
+    """
+    default_init = {
+        "processes": 2,       # количество процессов-воркеров
+        "drain_timeout": 60,  # сколько ждать завершения задач при остановке, сек
+    }
+
+    def __init__(self, target, processes=None, drain_timeout=None) -> None:
+        """
+        Настройка пула.
+
+        :arg target:        функция воркера target(index, queue, drain_timeout, ready),
+            должна быть доступна на уровне модуля. ready - multiprocessing.Event,
+            воркер устанавливает его, когда загрузил модели
+        :arg processes:     int    количество процессов-воркеров
+        :arg drain_timeout: float  сколько ждать завершения задач при остановке
+        """
+        self.target = target
+        self.processes = processes if processes else WorkerPool.default_init["processes"]
+        self.drain_timeout = drain_timeout if drain_timeout else WorkerPool.default_init["drain_timeout"]
+
+        self._context = multiprocessing.get_context("spawn")
+        self._queues = []
+        self._ready = []
+        self._workers = []
+
+    @property
+    def ready(self) -> bool:
+        """
+        Все воркеры живы и загрузили модели.
+        """
+        return bool(self._workers) and all(
+            worker.is_alive() and ready.is_set()
+            for worker, ready in zip(self._workers, self._ready)
+        )
+
+    def start(self) -> None:
+        """
+        Запускает процессы-воркеры.
+        """
+        for index in range(self.processes):
+            queue = self._context.Queue()
+            ready = self._context.Event()
+            worker = self._context.Process(
+                target=self.target,
+                args=(index, queue, self.drain_timeout, ready),
+                name=f"worker-{index}",
+            )
+            worker.start()
+            self._queues.append(queue)
+            self._ready.append(ready)
+            self._workers.append(worker)
+
+    def shard(self, update: types.Update) -> int:
+        """
+        Номер воркера для обновления.
+        """
+        chat_id = update_chat_id(update)
+        key = chat_id if chat_id is not None else update.update_id
+        return key % self.processes
+
+    def dispatch(self, update: types.Update) -> None:
+        """
+        Передает обновление воркеру его чата.
+        """
+        index = self.shard(update)
+        if not self._workers[index].is_alive():
+            logger.error("Воркер %s остановлен, обновление %s пропущено", index, update.update_id)
+            return
+        self._queues[index].put(update.to_python())
+
+    def drain(self) -> None:
+        """
+        Плавная остановка: воркеры дорабатывают принятые обновления
+        и завершаются. Не успевшие за drain_timeout останавливаются.
+        """
+        for queue in self._queues:
+            queue.put(None)
+        for worker in self._workers:
+            worker.join(self.drain_timeout + 10)
+            if worker.is_alive():
+                logger.warning("Воркер %s не завершился, остановка", worker.name)
+                # SIGTERM воркер игнорирует, см. signals.ignore_interrupt
+                worker.kill()
+                worker.join()
+        for queue in self._queues:
+            queue.close()
+        self._queues = []
+        self._ready = []
+        self._workers = []
+
+
+class ShardMiddleware(BaseMiddleware):
+    """
+    Middleware фронта: вместо обработки передает обновление в пул воркеров.
+    """
+
+    def __init__(self, pool: WorkerPool) -> None:
+        super().__init__()
+        self.pool = pool
+
+    async def on_pre_process_update(self, update: types.Update, data: dict):
+        self.pool.dispatch(update)
+        raise CancelHandler()
+
+
+def _get_update(queue):
+    """
+    Ждет обновление от фронта. Если фронт завершился, не вызвав drain(),
+    например его убили, возвращает None, как сигнал остановки,
+    чтобы воркер не остался сиротой с загруженными моделями.
+    """
+    parent = multiprocessing.parent_process()
+    while True:
+        try:
+            return queue.get(timeout=PARENT_POLL)
+        except queue_module.Empty:
+            if parent is not None and not parent.is_alive():
+                logger.warning("Фронт завершился, остановка воркера")
+                return None
+
+
+async def serve(dp, queue, drain_timeout: float, on_startup=None, on_shutdown=None) -> None:
+    """
+    Цикл процесса-воркера: читает обновления из очереди и обрабатывает
+    их через dp. None в очереди - сигнал остановки: новые обновления
+    не принимаются, выполняемые дорабатывают не дольше drain_timeout.
+    Воркер останавливается так же, если фронт завершился.
+
+    :arg dp:            Dispatcher  диспетчер с хэндлерами
+    :arg queue:         multiprocessing.Queue  очередь обновлений от фронта
+    :arg drain_timeout: float  сколько ждать выполняемые обновления
+    :arg on_startup:    корутина-функция, вызывается с dp при запуске
+    :arg on_shutdown:   корутина-функция, вызывается с dp при остановке
+    """
+    from aiogram import Bot, Dispatcher
+
+    loop = asyncio.get_running_loop()
+    Bot.set_current(dp.bot)
+    Dispatcher.set_current(dp)
+    if on_startup is not None:
+        await on_startup(dp)
+
+    tasks = set()
+    try:
+        while True:
+            data = await loop.run_in_executor(None, _get_update, queue)
+            if data is None:
+                break
+            task = asyncio.ensure_future(dp.updates_handler.notify(types.Update(**data)))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+        if tasks:
+            logger.info("Остановка, ожидание %s обновлений", len(tasks))
+            _, pending = await asyncio.wait(tasks, timeout=drain_timeout)
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.wait(pending)
+    finally:
+        if on_shutdown is not None:
+            await on_shutdown(dp)
+        session = await dp.bot.get_session()
+        await session.close()